@@ -40,6 +40,9 @@
     <xsl:message terminate="yes">Parameter for docset missing.</xsl:message>
   </xsl:param>
   <xsl:param name="internal_mode" select="'false'"/>
+  <!-- Site section lists are the same for all docsets, they only need
+  to be generated once per navigation build -->
+  <xsl:param name="generate_site_sections" select="'true'"/>
 
   <xsl:param name="titleformat_deliverable">title subtitle</xsl:param>
   <xsl:param name="titleformat_link">title</xsl:param>
@@ -61,13 +64,15 @@
   <xsl:template match="node()|@*"/>
 
   <xsl:template match="/">
-    <!-- Generate list of all site sections -->
-    <xsl:call-template name="generate-site-section-list"/>
+    <xsl:if test="$generate_site_sections = 'true'">
+      <!-- Generate list of all site sections -->
+      <xsl:call-template name="generate-site-section-list"/>
 
-    <!-- Generate site sections themselves -->
-    <xsl:call-template name="generate-site-sections">
-      <xsl:with-param name="sections" select="$site_sections"/>
-    </xsl:call-template>
+      <!-- Generate site sections themselves -->
+      <xsl:call-template name="generate-site-sections">
+        <xsl:with-param name="sections" select="$site_sections"/>
+      </xsl:call-template>
+    </xsl:if>
 
     <!-- Generate JSON file for the requested docset -->
     <xsl:apply-templates select="//docset" mode="generate-docset-json"/>
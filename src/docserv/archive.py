@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger('docserv')
+
+
+class BuildArchive:
+    """
+    On-disk archive of past builds that are no longer kept in memory.
+    Records are appended as JSON lines and only read when the archive
+    is queried. When enough records were appended, the archive is
+    compacted so that only the most recent records of each build
+    instruction ID are kept.
+    """
+
+    def __init__(self, path, max_per_build_instruction=10, compaction_threshold=1000):
+        """
+        path -- path to the archive file
+        max_per_build_instruction -- number of records kept per build
+                                     instruction ID when compacting
+        compaction_threshold -- number of appended records after which
+                                the archive is compacted
+        """
+        self.path = path
+        self.max_per_build_instruction = max_per_build_instruction
+        self.compaction_threshold = compaction_threshold
+        self.appended = 0
+        self.lock = threading.Lock()
+
+    def append(self, build_instructions):
+        """
+        Add a list of build instruction dicts to the archive.
+        """
+        if not build_instructions:
+            return
+        lines = [json.dumps(build_instruction) for build_instruction in build_instructions]
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+            self.appended += len(lines)
+            if self.appended >= self.compaction_threshold:
+                self._compact()
+
+    def read(self):
+        records = []
+        if not os.path.isfile(self.path):
+            return records
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.decoder.JSONDecodeError:
+                    logger.warning("Ignoring damaged entry in %s.", self.path)
+        return records
+
+    def query(self, build_instruction_id=None, offset=0, limit=None):
+        """
+        Return archived records, newest first, optionally only those of
+        a single build instruction.
+        """
+        with self.lock:
+            records = self.read()
+        records.reverse()
+        if build_instruction_id is not None:
+            records = [record for record in records
+                       if record.get('id') == build_instruction_id]
+        end = None if limit is None else offset + limit
+        return records[offset:end]
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        records = self.read()
+        count = {}
+        kept = []
+        for record in reversed(records):
+            build_instruction_id = record.get('id')
+            count[build_instruction_id] = count.get(build_instruction_id, 0) + 1
+            if count[build_instruction_id] <= self.max_per_build_instruction:
+                kept.append(record)
+        kept.reverse()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, "w") as f:
+            for record in kept:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.appended = 0
+        logger.debug("Compacted build archive %s from %i to %i records.",
+                     self.path, len(records), len(kept))
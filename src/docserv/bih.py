@@ -1,3 +1,4 @@
+import glob
 import json
 import logging
 import os
@@ -8,11 +9,14 @@ import string
 import subprocess
 import tempfile
 import threading
-from lxml import etree
+import time
 
 from docserv.deliverable import Deliverable
-from docserv.functions import feedback_message, resource_to_filename
+from docserv.functions import feedback_message, resource_to_filename, run_command
+from docserv.metrics import command_name, metrics
+from docserv.navigation import template_key
 from docserv.repolock import RepoLock
+from docserv import staging
 
 BIN_DIR = os.getenv('DOCSERV_BIN_DIR', "/usr/bin/")
 CONF_DIR = os.getenv('DOCSERV_CONFIG_DIR', "/etc/docserv/")
@@ -21,6 +25,9 @@ CACHE_DIR = os.getenv('DOCSERV_CACHE_DIR', "/var/cache/docserv/")
 
 logger = logging.getLogger('docserv')
 
+# Docsets with a lower lifecycle value are built first.
+LIFECYCLE_PRIORITY = {'supported': 0, 'beta': 1, 'unsupported': 2, 'unpublished': 3}
+
 
 class BuildInstructionHandler:
     """
@@ -30,7 +37,7 @@ class BuildInstructionHandler:
     configuration creates a set of Deliverables.
     """
 
-    def __init__(self, build_instruction, config, stitch_tmp_dir, gitLocks, gitLocksLock, thread_id):
+    def __init__(self, build_instruction, config, stitch_tmp_dir, config_stitchers, gitLocks, gitLocksLock, repo_fetches, build_history, target_syncs, object_stores, navigation_caches, thread_id, state_changed=None):
         # A dict with meta information about a Deliverable.
         # It is filled with Deliverable.dict().
         self.deliverables = {}
@@ -48,11 +55,38 @@ class BuildInstructionHandler:
         # running daps for them.
         self.deliverables_building = []
         self.deliverables_building_lock = threading.Lock()
+        # Start times of the Deliverables that are currently
+        # building, mapped with the Deliverable ID.
+        self.deliverables_started = {}
 
         self.cleanup_done = False
         self.cleanup_lock = threading.Lock()
+        # Set when the build instruction was triggered again, the
+        # results of this build are outdated and are not published.
+        self.superseded = False
+        # Sort key for scheduling BIHs, set by update_priority()
+        self.priority_key = (0, len(LIFECYCLE_PRIORITY), 0)
+        # Result of publishing, set by cleanup()
+        self.overall_status = None
 
         self.stitch_tmp_dir = stitch_tmp_dir
+        # A dict of ConfigStitcher instances mapped with the target name.
+        self.config_stitchers = config_stitchers
+        # The FetchScheduler that knows when mirrors were last fetched.
+        self.repo_fetches = repo_fetches
+        # The BuildHistory with the durations of earlier builds.
+        self.build_history = build_history
+        # A dict of TargetSync instances mapped with the target name.
+        self.target_syncs = target_syncs
+        # A dict of ObjectStore instances mapped with the target name,
+        # only for targets with a dedup_store.
+        self.object_stores = object_stores
+        # A dict of NavigationCache instances mapped with the target name.
+        self.navigation_caches = navigation_caches
+
+        # Callback that marks this build instruction as changed in the
+        # DocservState and wakes up idle worker threads.
+        self.state_changed = state_changed
 
         if self.validate(build_instruction, config):
             self.initialized = True
@@ -104,9 +138,12 @@ class BuildInstructionHandler:
         # 2. initialization succeeded + product has no deliverables -> "success"
         # 3. all deliverables succeeded -> "success"
         # 4. one or more deliverables failed -> "fail"
+        # 5. build instruction was triggered again -> "superseded"
         bi_overall_status = 'success'
         if not self.initialized:
             bi_overall_status = 'fail'
+        elif self.superseded:
+            bi_overall_status = 'superseded'
         else:
             for deliverable in self.deliverables.keys():
                 if self.deliverables[deliverable]['status'] == 'fail':
@@ -117,15 +154,18 @@ class BuildInstructionHandler:
                     break
 
         logger.debug("Cleaning up after %s (%s)", json.dumps(self.build_instruction['id']), bi_overall_status)
+        self.overall_status = bi_overall_status
 
         commands = {}
         n = 0
+        section_pages_key = None
 
         if bi_overall_status == 'success':
             backup_path = self.config['targets'][self.build_instruction['target']]['backup_path']
             backup_docset_relative_path = os.path.join(backup_path, self.docset_relative_path)
 
-            if hasattr(self, 'tmp_bi_path') and os.listdir(self.tmp_bi_path):
+            has_content = hasattr(self, 'tmp_bi_path') and bool(os.listdir(self.tmp_bi_path))
+            if has_content:
 
                 # create zip archive
                 n += 1
@@ -142,10 +182,30 @@ class BuildInstructionHandler:
                     self.product,
                     self.docset,
                     self.lang)
+                # unchanged files are copied from the published archive
+                previous_archive = os.path.join(backup_docset_relative_path, zip_name)
+                if os.path.isfile(previous_archive):
+                    create_archive_cmd += ' --previous-archive %s' % previous_archive
                 commands[n]['cmd'] = create_archive_cmd
 
             tmp_dir_nav = tempfile.mkdtemp(prefix="docserv_navigation_")
             if self.navigation == 'linked' or self.navigation == 'hidden':
+                # only read the deliverable cache files that changed
+                navigation_cache = self.navigation_caches[self.build_instruction['target']]
+                n += 1
+                commands[n] = {}
+                commands[n]['cmd'] = "update-stitched-cache %s" % navigation_cache.path
+                commands[n]['function'] = self.update_navigation_cache
+
+                # the section pages only change with the templates and
+                # the settings of the target
+                target_config = self.config['targets'][self.build_instruction['target']]
+                section_pages_key = template_key(
+                    target_config['template_dir'], target_config['languages'],
+                    target_config['site_sections'], target_config['default_site_section'],
+                    target_config['default_lang'], target_config['omit_default_lang_path'],
+                    target_config['server_base_path'])
+
                 # (re-)generate navigation page
                 n += 1
                 commands[n] = {}
@@ -184,20 +244,28 @@ class BuildInstructionHandler:
                             self.config['targets'][self.build_instruction['target']]['fragment_l10n_dir']) if
                         self.config['targets'][self.build_instruction['target']]['enable_ssi_fragments'] == "yes" else "",
                 )
+                commands[n]['cmd'] += " --stitched-cache=\"%s\"" % navigation_cache.path
+                if navigation_cache.section_pages_current(section_pages_key):
+                    commands[n]['cmd'] += " --skip-section-pages"
 
             n += 1
             commands[n] = {}
             commands[n]['cmd'] = "rsync -r %s/ %s" % (
               self.config['targets'][self.build_instruction['target']]['server_root_files'], tmp_dir_nav)
 
-            # remove contents of backup path for current build instruction
-            n += 1
-            commands[n] = {}
-            commands[n]['cmd'] = "rm -rf %s" % (backup_docset_relative_path)
+            staged = self.config['targets'][self.build_instruction['target']]['publish_mode'] == 'staged'
+            if staged:
+                n = self.staged_publish_commands(commands, n, backup_docset_relative_path,
+                                                 zip_name if has_content else None, tmp_dir_nav)
+            else:
+                # remove contents of backup path for current build instruction
+                n += 1
+                commands[n] = {}
+                commands[n]['cmd'] = "rm -rf %s" % (backup_docset_relative_path)
 
             # ideally, we'd copy in one fell swoop, but I guess two separate
             # commands do work too..?
-            if hasattr(self, 'tmp_bi_path') and os.listdir(self.tmp_bi_path):
+            if not staged and has_content:
 
                 # copy temp build instruction directory to backup path;
                 # we only do that for products that are unpublished/beta/supported,
@@ -213,12 +281,29 @@ class BuildInstructionHandler:
                     n += 1
                     commands[n] = {}
                     commands[n]['cmd'] = "cp %s %s" % (os.path.join(self.tmp_bi_path, zip_name), backup_docset_relative_path)
+                n = self.deduplicate_command(commands, n, backup_docset_relative_path)
 
-            # rsync navigational pages dir to backup path
+            # rsync navigational pages dir to backup path, keeping the
+            # symlinks of staged docsets
             n += 1
             commands[n] = {}
-            commands[n]['cmd'] = "rsync -lr %s/ %s" % (
-                tmp_dir_nav, backup_path)
+            commands[n]['cmd'] = "rsync -lr%s %s/ %s" % (
+                "K" if staged else "", tmp_dir_nav, backup_path)
+
+            # rsync the changed parts of the local backup path with the web
+            # server target path, see TargetSync; this must run before
+            # the navigation pages are removed
+            if self.config['targets'][self.build_instruction['target']]['enable_target_sync'] == 'yes':
+                target_path = self.config['targets'][self.build_instruction['target']]['target_path']
+                # everything below the docset directory plus the regenerated
+                # navigation pages and server root files
+                sync_paths = [self.docset_relative_path]
+                n += 1
+                commands[n] = {}
+                commands[n]['cmd'] = "rsync --delete-after -lr %s/{%s} %s" % (
+                    backup_path, self.docset_relative_path, target_path)
+                commands[n]['function'] = lambda: self.target_syncs[self.build_instruction['target']].sync(
+                    sync_paths + self.relative_files(tmp_dir_nav))
 
             # remove temp directory for navigation page
             n += 1
@@ -240,24 +325,13 @@ class BuildInstructionHandler:
             commands[n]['cmd'] = "echo rm -rf %s" % self.local_repo_build_dir
             commands[n]['execute_after_error'] = True
 
-        # rsync local backup path with web server target path
-        if (bi_overall_status == 'success' and
-            self.config['targets'][self.build_instruction['target']]['enable_target_sync'] == 'yes'):
-            target_path = self.config['targets'][self.build_instruction['target']]['target_path']
-            n += 1
-            commands[n] = {}
-            commands[n]['cmd'] = "rsync --exclude-from '%s' --delete-after -lr %s/ %s" % (
-                os.path.join(SHARE_DIR, 'rsync', 'rsync_excludes.txt'),
-                backup_path,
-                target_path,
-            )
-
-
         if not commands:
             self.cleanup_done = True
             self.cleanup_lock.release()
             return
 
+        # resource usage of the publishing commands
+        self.build_instruction['publish_commands'] = []
         previous_error = False
         for i in range(1, n + 1):
             cmd = shlex.split(commands[i]['cmd'])
@@ -268,17 +342,103 @@ class BuildInstructionHandler:
             if execute_after_error or not previous_error:
                 logger.debug("Cleaning up %s, %s",
                     self.build_instruction['id'], commands[i]['cmd'])
-                s = subprocess.Popen(
-                    cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                out, err = s.communicate()
-                if int(s.returncode) != 0:
+                if 'function' in commands[i]:
+                    returncode, out, err, usage = commands[i]['function']()
+                else:
+                    returncode, out, err, usage = run_command(cmd)
+                labels = {'phase': 'publish', 'command': command_name(cmd)}
+                metrics.observe('docserv_command_duration_seconds',
+                                usage['wall_time'], labels)
+                usage['cmd'] = commands[i]['cmd']
+                usage['return_value'] = returncode
+                self.build_instruction['publish_commands'].append(usage)
+                if int(returncode) != 0:
+                    metrics.inc('docserv_command_failures_total', labels)
                     logger.warning("Cleanup failed! Unexpected return value %i for '%s'",
-                        s.returncode, commands[i]['cmd'])
+                        returncode, commands[i]['cmd'])
                     self.mail(commands[i]['cmd'], out, err)
                     previous_error = True
+        if section_pages_key is not None and not previous_error:
+            self.navigation_caches[self.build_instruction['target']].section_pages_published(
+                section_pages_key)
         self.cleanup_done = True
         self.cleanup_lock.release()
 
+    def staged_publish_commands(self, commands, n, docset_path, zip_name, tmp_dir_nav):
+        """
+        Add the commands that write the new docset directory next to the
+        current one and then switch to it atomically, see staging.
+        Returns the new number of commands.
+        """
+        version_path = staging.staged_dir(docset_path)
+        n += 1
+        commands[n] = {}
+        commands[n]['cmd'] = "mkdir -p %s" % version_path
+        if zip_name is not None:
+            n += 1
+            commands[n] = {}
+            if self.lifecycle != 'unsupported':
+                # files that did not change are hard links to the
+                # current version instead of copies
+                commands[n]['cmd'] = "rsync -lr --checksum %s %s/ %s" % (
+                    "--link-dest=%s" % os.path.realpath(docset_path) if os.path.isdir(docset_path) else "",
+                    self.tmp_bi_path, version_path)
+            else:
+                commands[n]['cmd'] = "cp %s %s" % (os.path.join(self.tmp_bi_path, zip_name), version_path)
+        # the navigational page of the docset itself must be there
+        # before switching
+        n += 1
+        commands[n] = {}
+        commands[n]['cmd'] = "rsync -lr --ignore-missing-args %s/ %s" % (
+            os.path.join(tmp_dir_nav, self.docset_relative_path), version_path)
+        n = self.deduplicate_command(commands, n, version_path)
+        n += 1
+        commands[n] = {}
+        commands[n]['cmd'] = "ln -sfn %s %s" % (os.path.basename(version_path), docset_path)
+        commands[n]['function'] = lambda: staging.publish(
+            docset_path, version_path,
+            self.config['targets'][self.build_instruction['target']]['publish_keep'])
+        return n
+
+    def deduplicate_command(self, commands, n, path):
+        """
+        Add a command that replaces the files below path with hard links
+        into the object store of the target, if it has one.
+        Returns the new number of commands.
+        """
+        object_store = self.object_stores.get(self.build_instruction['target'])
+        if object_store is None:
+            return n
+        n += 1
+        commands[n] = {}
+        commands[n]['cmd'] = "deduplicate %s %s" % (path, object_store.path)
+        commands[n]['function'] = lambda: object_store.deduplicate(path)
+        return n
+
+    def update_navigation_cache(self):
+        """
+        Update the stitched document cache of the target, returns a tuple
+        like run_command, so it can be used as a publishing command.
+        """
+        started_at = time.time()
+        returncode, err = 0, b''
+        try:
+            self.navigation_caches[self.build_instruction['target']].update()
+        except OSError as error:
+            returncode, err = 1, str(error).encode('utf-8')
+        usage = {'wall_time': round(time.time() - started_at, 3), 'cpu_time': 0, 'max_rss': 0}
+        return returncode, b'', err, usage
+
+    def relative_files(self, path):
+        """
+        List of all files below path, relative to path.
+        """
+        files = []
+        for root, dirs, filenames in os.walk(path):
+            for filename in filenames:
+                files.append(os.path.relpath(os.path.join(root, filename), path))
+        return files
+
     def __del__(self):
         if not self.cleanup_done:
             self.cleanup()
@@ -299,6 +459,14 @@ class BuildInstructionHandler:
     def __getitem__(self, arg):
         return self.build_instruction
 
+    def changed(self, event=None, **details):
+        """
+        Report a change of this build instruction, e.g. a finished
+        Deliverable, to the DocservState.
+        """
+        if self.state_changed is not None:
+            self.state_changed(self.build_instruction['id'], event, **details)
+
     def mail(self, command, out, err):
         if not hasattr(self, 'remote_repo'):
             self.remote_repo = "(none)"
@@ -356,9 +524,9 @@ These are the details:
 
     def read_conf_dir(self):
         """
-        Use the docserv-stitch command to stitch all single XML configuration
-        files to a big config file. Then parse it and extract required information
-        for the current build instruction.
+        Use the ConfigStitcher of the target to stitch all single XML
+        configuration files to a big config file. Then parse it and extract
+        required information for the current build instruction.
         """
         target = self.build_instruction['target']
         try:
@@ -373,45 +541,25 @@ These are the details:
             ('productconfig_simplified_%s.xml' % target))
         logger.debug("Stitching XML config directory to %s",
                      self.stitch_tmp_file)
-        cmd = ('%s --simplify --revalidate-only '
-               '--valid-languages="%s" '
-               '--valid-site-sections="%s" '
-               '%s %s'
-               ) % (
-            os.path.join(BIN_DIR, 'docserv-stitch'),
-            self.config['server']['valid_languages'],
-            self.config['targets'][target]['site_sections'],
-            self.config['targets'][target]['config_dir'],
-            self.stitch_tmp_file,
-            )
-        logger.debug("Stitching command: %s", cmd)
-        cmd = shlex.split(cmd)
-        s = subprocess.Popen(cmd,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        self.out, self.err = s.communicate()
-        rc = int(s.returncode)
-        if rc == 0:
+        # Only configuration files that changed since the last stitching
+        # are validated again.
+        if self.config_stitchers[target].stitch(self.stitch_tmp_file):
             logger.debug("Stitching of %s successful",
                          self.config['targets'][target]['config_dir'])
         else:
             logger.warning("Stitching of %s failed!",
                            self.config['targets'][target]['config_dir'])
-            logger.warning("Stitching STDOUT: %s", self.out.decode('utf-8'))
-            logger.warning("Stitching STDERR: %s", self.err.decode('utf-8'))
-
             self.initialized = False
             return False
 
         self.local_repo_build_dir = os.path.join(self.config['server']['temp_repo_dir'], ''.join(
             random.choices(string.ascii_uppercase + string.digits, k=12)))
 
-        # then read all files into an xml tree
-        self.tree = etree.parse(self.stitch_tmp_file)
-
-        try:
-            self.tree.xpath("//product[@productid='%s']/docset[@setid='%s']" % (self.product, self.docset))[0]
-        except (AttributeError, IndexError):
+        # The index of the stitched configuration is shared by all build
+        # instructions and only rebuilt when the configuration changes.
+        config_index = self.config_stitchers[target].index
+        docset = config_index.get_docset(self.product, self.docset)
+        if docset is None:
             logger.warning("%s/%s is not configured. Cancelling build instruction." % (self.product, self.docset))
             self.initialized = False
             return False
@@ -426,67 +574,40 @@ These are the details:
             self.initialized = False
             return False
 
-        try:
-            xpath = "//product[@productid='%s']/maintainers/contact" % (
-                self.product)
-            self.maintainers = []
-            contacts = self.tree.findall(xpath)
-            for contact in contacts:
-                self.maintainers.append(contact.text)
-            xpath = "//product[@productid='%s']/docset[@setid='%s']/@lifecycle" % (
-                self.product, self.docset)
-            self.lifecycle = str(self.tree.xpath(xpath)[0])
-        except (AttributeError, IndexError):
-            logger.warning("Failed to parse xpath: %s", xpath)
+        self.maintainers = list(config_index.get_product(self.product)['maintainers'])
+        if docset['lifecycle'] is None:
+            logger.warning("No lifecycle configured for %s/%s.", self.product, self.docset)
             self.initialized = False
             return False
+        self.lifecycle = docset['lifecycle']
 
         # check if there is any buildable documentation in the language
         # requested -- it's possible that there only are internal/external
         # sections but there is no builddocs section (or none for the language
         # in question).
         self.build_docs = True
-        xpath = "//product[@productid='%s']/docset[@setid='%s']/builddocs/language[@lang='%s']" % (
-            self.product, self.docset, self.lang)
-        if len(self.tree.xpath(xpath)) == 0:
+        self.language_config = docset['languages'].get(self.lang)
+        if self.language_config is None:
             logger.debug("No buildable documentation for %s/%s/%s. Will update navigation only." % (
                 self.product, self.docset, self.lang))
             self.build_docs = False
 
-        try:
-            xpath = "//product[@productid='%s']/docset[@setid='%s']/@navigation" % (
-                self.product, self.docset)
-            self.navigation = str(self.tree.xpath(xpath)[0])
-        except (AttributeError, IndexError):
-            self.navigation = 'linked'
+        self.navigation = docset['navigation']
 
         if self.build_docs:
-            try:
-                xpath = "//product[@productid='%s']/docset[@setid='%s']/builddocs/language[@lang='%s']/branch" % (
-                    self.product, self.docset, self.lang)
-                self.branch = self.tree.find(xpath).text
-
-                xpath = "//product[@productid='%s']/docset[@setid='%s']/builddocs/git/@remote" % (
-                    self.product, self.docset)
-                self.remote_repo = str(self.tree.xpath(xpath)[0])
-            except AttributeError:
-                logger.warning("Failed to parse xpath: %s", xpath)
+            if self.language_config['branch'] is None or docset['remote'] is None:
+                logger.warning("No branch or remote repository configured for %s/%s/%s.",
+                               self.product, self.docset, self.lang)
                 return False
+            self.branch = self.language_config['branch']
+            self.remote_repo = docset['remote']
+            self.build_container = docset['build_container']
 
-            try:
-                xpath = "//product[@productid='%s']/docset[@setid='%s']/builddocs/buildcontainer/@image" % (
-                    self.product, self.docset)
-                self.build_container = str(self.tree.xpath(xpath)[0])
-            except (AttributeError, IndexError):
-                self.build_container = False
-
-            try:
-                xpath = "//product[@productid='%s']/docset[@setid='%s']/builddocs/language[@lang='%s']/subdir" % (
-                    self.product, self.docset, self.lang)
+            if self.language_config['subdir'] is not None:
                 self.build_source_dir = os.path.join(
                     self.local_repo_build_dir,
-                    self.tree.find(xpath).text)
-            except AttributeError:
+                    self.language_config['subdir'])
+            else:
                 self.build_source_dir = self.local_repo_build_dir
 
 
@@ -504,63 +625,118 @@ These are the details:
     def prepare_repo(self, thread_id):
         """
         Prepare the repository required for building the deliverables.
-        This function updates the local clone of the repository, then
-        clones the required branch into another local and temporary
-        repository. With this, multiple builds of different branches
-        can run at the same time.
+        This function updates the local bare mirror of the repository,
+        then clones the required commit of the branch into another local
+        and temporary repository. With this, multiple builds of different
+        branches can run at the same time.
+        Only updating the mirror and resolving the branch to a commit
+        need the lock on the Git repo. The temporary repository shares
+        the objects of the mirror and is created without holding the
+        lock, so all languages/branches of a repository can be prepared
+        concurrently.
+        If enabled, the temporary repository only checks out the subdir
+        of the language (sparse checkout), and the mirror only contains
+        the file contents that were needed so far (partial clone).
         """
 
         # for a few commands below, we assume a default remote named "origin"
         default_branch="origin"
         commands = {}
-        # clone locally cached repository, does nothing if exists
+        # create locally cached bare mirror, does nothing if exists
         n = 0
-        local_repo_cache_dir = os.path.join(
-            self.config['server']['repo_dir'], resource_to_filename(self.remote_repo))
+        local_repo_cache_dir = self.repo_fetches.mirror_dir(self.remote_repo)
         commands[n] = {}
-        commands[n]['cmd'] = "git clone \'%s\' \'%s\'" % (
-            self.remote_repo, local_repo_cache_dir)
+        commands[n]['cmd'] = self.repo_fetches.clone_mirror_cmd(self.remote_repo)
         commands[n]['ret_val'] = None
+        commands[n]['locked'] = True
 
-        # fetch default remote for locally cached repo
+        # fetch default remote for locally cached repo, a mirror always
+        # force-updates all branches, so force-pushes are not a problem
         n += 1
         commands[n] = {}
         commands[n]['cmd'] = "git -C \'%s\' fetch --prune \'%s\'" % (local_repo_cache_dir, default_branch)
         commands[n]['ret_val'] = 0
+        commands[n]['locked'] = True
+        # skip if another BI fetched after we were queued
+        commands[n]['fetch'] = local_repo_cache_dir
 
-        # check out the required branch
+        # resolve the branch to a commit, later fetches by competing BIs
+        # must not change what we build
         n += 1
         commands[n] = {}
-        commands[n]['cmd'] = "git -C \'%s\' checkout \'%s\'" % (
+        commands[n]['cmd'] = "git -C \'%s\' rev-parse --verify \'refs/heads/%s^{commit}\'" % (
             local_repo_cache_dir, self.branch)
         commands[n]['ret_val'] = 0
+        commands[n]['locked'] = True
+        commands[n]['output'] = 'resolved_commit'
 
-        # reset the local branch, to be able to deal with force-pushes etc.
+        # Create local copy in temp build dir that borrows the objects of
+        # the mirror instead of copying them
         n += 1
         commands[n] = {}
-        commands[n]['cmd'] = "git -C \'%s\' reset --hard \'%s/%s\'" % (
-            local_repo_cache_dir, default_branch, self.branch)
+        commands[n]['cmd'] = "git clone --shared --no-checkout --single-branch --branch \'%s\' \'%s\' \'%s\'" % (
+            self.branch, local_repo_cache_dir, self.local_repo_build_dir)
         commands[n]['ret_val'] = 0
 
-        # Create local copy in temp build dir
+        # If the mirror is a partial clone, file contents it does not have
+        # are fetched from the remote directly into the temp build dir
+        promisor_config = [
+            ('core.repositoryformatversion', '1'),
+            ('extensions.partialClone', 'upstream'),
+            ('remote.upstream.url', self.remote_repo),
+            ('remote.upstream.promisor', 'true'),
+            ('remote.upstream.partialclonefilter', 'blob:none'),
+        ]
+        for key, value in promisor_config:
+            n += 1
+            commands[n] = {}
+            commands[n]['cmd'] = "git -C \'%s\' config \'%s\' \'%s\'" % (
+                self.local_repo_build_dir, key, value)
+            commands[n]['ret_val'] = 0
+            commands[n]['skip_unless'] = 'mirror_is_partial'
+
+        # only check out the subdir of the language
         n += 1
         commands[n] = {}
-        commands[n]['cmd'] = "git clone --single-branch --branch \'%s\' \'%s\' \'%s\'" % (
-            self.branch, local_repo_cache_dir, self.local_repo_build_dir)
+        commands[n]['cmd'] = "git -C \'%s\' sparse-checkout set --cone \'%s\'" % (
+            self.local_repo_build_dir, self.language_config['subdir'])
+        commands[n]['ret_val'] = 0
+        commands[n]['skip_unless'] = 'use_sparse_checkout'
+
+        # check out the resolved commit
+        n += 1
+        commands[n] = {}
+        commands[n]['cmd'] = "git -C \'%s\' checkout --quiet --detach __RESOLVED_COMMIT__" % (
+            self.local_repo_build_dir)
         commands[n]['ret_val'] = 0
 
-        # The lock on the Git repo needs to be acquired early, otherwise a
-        # competing BI may lead to us intermittently checking out a different
-        # branch and thus failing to include the most recent changes in our
-        # the single-branch repo we clone at the end.
-        self.git_lock.acquire()
         for i in range(0, n + 1):
+            if commands[i].get('locked') and not self.git_lock.acquired:
+                self.git_lock.acquire()
+            elif not commands[i].get('locked') and self.git_lock.acquired:
+                self.git_lock.release()
+            if 'skip_unless' in commands[i] and \
+                    not getattr(self, commands[i]['skip_unless'])(local_repo_cache_dir):
+                continue
+            if 'fetch' in commands[i] and self.repo_fetches.is_fresh(
+                    commands[i]['fetch'], self.build_instruction.get('queued_at')):
+                logger.debug("Thread %i: %s was fetched recently, not fetching again.",
+                             thread_id, commands[i]['fetch'])
+                continue
+            started_at = time.time()
+            if hasattr(self, 'resolved_commit'):
+                commands[i]['cmd'] = commands[i]['cmd'].replace(
+                    '__RESOLVED_COMMIT__', self.resolved_commit)
             cmd = shlex.split(commands[i]['cmd'])
             logger.debug("Thread %i: %s", thread_id, commands[i]['cmd'])
             s = subprocess.Popen(
                 cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             out, err = s.communicate()
+            labels = {'phase': 'prepare', 'command': command_name(cmd)}
+            metrics.observe('docserv_command_duration_seconds',
+                            time.time() - started_at, labels)
             if commands[i]['ret_val'] is not None and not commands[i]['ret_val'] == int(s.returncode):
+                metrics.inc('docserv_command_failures_total', labels)
                 logger.warning("Build failed! Unexpected return value %i for '%s'",
                                s.returncode, commands[i]['cmd'])
                 self.mail(commands[i]['cmd'], out.decode(
@@ -568,8 +744,68 @@ These are the details:
                 self.initialized = False
                 self.git_lock.release()
                 return False
+            if 'fetch' in commands[i]:
+                self.repo_fetches.fetched(commands[i]['fetch'], started_at)
+            if 'output' in commands[i]:
+                setattr(self, commands[i]['output'], out.decode('utf-8').strip())
         self.git_lock.release()
 
+        if self.use_sparse_checkout(local_repo_cache_dir):
+            return self.add_sparse_symlink_targets(thread_id)
+        return True
+
+    def mirror_is_partial(self, local_repo_cache_dir):
+        """
+        Whether the mirror is a partial clone, i.e. has promisor packs.
+        """
+        return len(glob.glob(os.path.join(local_repo_cache_dir, 'objects', 'pack', '*.promisor'))) > 0
+
+    def use_sparse_checkout(self, local_repo_cache_dir):
+        return (self.config['server']['sparse_checkout'] == 'yes' and
+                self.language_config['subdir'] is not None)
+
+    def add_sparse_symlink_targets(self, thread_id):
+        """
+        Documents often use symlinks to share entities or images with
+        other directories of the repository. Add the targets of symlinks
+        that point outside of the sparse checkout to it, until all
+        symlinks resolve.
+        """
+        repo_dir = os.path.realpath(self.local_repo_build_dir)
+        added = set()
+        # symlinks in added directories can point elsewhere again,
+        # but don't follow such chains forever
+        for _ in range(5):
+            missing = set()
+            for rootdir, subdirs, files in os.walk(repo_dir):
+                if os.path.join(repo_dir, '.git') == rootdir:
+                    subdirs[:] = []
+                    continue
+                for name in subdirs + files:
+                    path = os.path.join(rootdir, name)
+                    if not os.path.islink(path) or os.path.exists(path):
+                        continue
+                    target = os.path.relpath(os.path.realpath(path), repo_dir)
+                    if target.startswith('..'):
+                        continue
+                    # add the directory, so files next to the target that
+                    # are referenced relative to it are there, too
+                    target_dir = os.path.dirname(target) or target
+                    if target_dir not in added:
+                        missing.add(target_dir)
+            if not missing:
+                return True
+            cmd = ['git', '-C', self.local_repo_build_dir, 'sparse-checkout', 'add'] + sorted(missing)
+            logger.debug("Thread %i: %s", thread_id, ' '.join(cmd))
+            s = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = s.communicate()
+            if int(s.returncode) != 0:
+                logger.warning("Build failed! Unexpected return value %i for '%s'",
+                               s.returncode, ' '.join(cmd))
+                self.mail(' '.join(cmd), out.decode('utf-8'), err.decode('utf-8'))
+                self.initialized = False
+                return False
+            added |= missing
         return True
 
     def get_commit_hash(self):
@@ -606,6 +842,9 @@ These are the details:
         if not isinstance(build_instruction['target'], str):
             logger.warning("Validation: target is not a string")
             return False
+        if not isinstance(build_instruction.get('priority', 0), int):
+            logger.warning("Validation: priority is not an integer")
+            return False
         logger.debug("Valid build instruction: %s", build_instruction['id'])
         return True
 
@@ -630,28 +869,24 @@ These are the details:
             pass
 
         logger.debug("Generating deliverables.")
-        xpath = "//product[@productid='%s']/docset[@setid='%s']/builddocs/language[@lang='%s']/deliverable" % (
-            self.product, self.docset, self.lang)
-        for xml_deliverable in self.tree.findall(xpath):
-            dc = xml_deliverable.find(".//dc").text
-            build_formats = xml_deliverable.find(".//format").attrib
-            try:
+        for config_deliverable in self.language_config['deliverables']:
+            dc = config_deliverable['dc']
+            build_formats = config_deliverable['formats']
+            if config_deliverable['subdir'] is not None:
                 source_dir = os.path.join(
                     self.build_source_dir,
-                    xml_deliverable.find(".//subdir").text)
-            except AttributeError:
+                    config_deliverable['subdir'])
+            else:
                 source_dir = self.build_source_dir
 
             for build_format in build_formats:
                 if build_formats[build_format] == "false":
                     continue
-                subdeliverables = []
-                for subdeliverable in xml_deliverable.findall("subdeliverable"):
-                    subdeliverables.append(subdeliverable.text)
+                subdeliverables = list(config_deliverable['subdeliverables'])
 
                 xslt_params = []
-                for param in xml_deliverable.findall("param"):
-                    xslt_params.append("%s='%s'" % (param.xpath("./@name")[0], param.text))
+                for name, value in config_deliverable['params']:
+                    xslt_params.append("%s='%s'" % (name, value))
 
                 deliverable = Deliverable(self,
                                           dc,
@@ -666,8 +901,6 @@ These are the details:
                 self.deliverables[deliverable.id] = deliverable.dict()
                 self.deliverable_objects[deliverable.id] = deliverable
                 self.deliverables_open.append(deliverable.id)
-        # after all deliverables are generated, we don't need the xml tree anymore
-        self.tree = None
         return True
 
     def get_deliverable(self):
@@ -680,12 +913,15 @@ These are the details:
         deliverable_id = None
         with self.deliverables_open_lock:
             if len(self.deliverables_open) > 0:
+                # longest job first, short ones fill the gaps at the end,
+                # see update_priority
                 deliverable_id = self.deliverables_open.pop()
                 with self.deliverable_objects_lock:
                     retval = self.deliverable_objects.pop(deliverable_id)
         if retval is not None:
             with self.deliverables_building_lock:
                 self.deliverables_building.append(deliverable_id)
+                self.deliverables_started[deliverable_id] = time.time()
             return retval
         with self.deliverables_building_lock:
             retval = len(self.deliverables_building)
@@ -693,3 +929,93 @@ These are the details:
             return 'done'
         else:
             return None
+
+    def supersede(self):
+        """
+        Cancel all deliverables that have not started building yet,
+        because a newer build of this build instruction is pending.
+        Deliverables that are building are finished, but nothing is
+        published.
+        """
+        with self.deliverables_open_lock:
+            for deliverable_id in self.deliverables_open:
+                self.deliverables[deliverable_id]['status'] = 'superseded'
+                with self.deliverable_objects_lock:
+                    self.deliverable_objects.pop(deliverable_id, None)
+            logger.debug("Cancelled %i deliverables of superseded build instruction %s",
+                         len(self.deliverables_open), self.build_instruction['id'])
+            self.deliverables_open.clear()
+        self.superseded = True
+        self.changed('superseded')
+
+    def newer_commit_available(self):
+        """
+        Whether the branch points to a different commit on the remote
+        than the one this BIH builds. While the commit is not resolved
+        yet, the fetch that is still to come gets the newest commit
+        anyway, so this returns False.
+        """
+        if not hasattr(self, 'resolved_commit'):
+            return False
+        cmd = "git ls-remote \'%s\' \'refs/heads/%s\'" % (self.remote_repo, self.branch)
+        try:
+            s = subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, timeout=60)
+        except subprocess.TimeoutExpired:
+            logger.warning("Timeout while looking up the commit of %s in %s.",
+                           self.branch, self.remote_repo)
+            return False
+        if s.returncode != 0:
+            logger.warning("Could not look up the commit of %s in %s: %s",
+                           self.branch, self.remote_repo, s.stderr.decode('utf-8'))
+            return False
+        refs = s.stdout.decode('utf-8').split()
+        return len(refs) > 0 and refs[0] != self.resolved_commit
+
+    def estimate_duration(self, deliverable_id):
+        """
+        Expected build duration of a deliverable of this BIH in seconds.
+        """
+        return self.build_history.estimate(
+            deliverable_id, self.deliverables[deliverable_id]['build_format'])
+
+    def update_priority(self):
+        """
+        Compute the sort key for scheduling BIHs, lower values are built
+        first: the priority from the build instruction (higher is more
+        important), then the lifecycle of the docset and then the
+        longest open deliverable. Also sorts the open deliverables by
+        their expected duration. Called once, when the BIH is queued
+        for building.
+        """
+        with self.deliverables_open_lock:
+            self.deliverables_open.sort(key=self.estimate_duration)
+            longest = 0
+            if self.deliverables_open:
+                longest = self.estimate_duration(self.deliverables_open[-1])
+        self.priority_key = (
+            -self.build_instruction.get('priority', 0),
+            LIFECYCLE_PRIORITY.get(getattr(self, 'lifecycle', None), len(LIFECYCLE_PRIORITY)),
+            -longest)
+
+    def priority(self):
+        """
+        Sort key for scheduling BIHs, see update_priority.
+        """
+        return self.priority_key
+
+    def remaining_work(self):
+        """
+        Expected durations of the open deliverables and expected remaining
+        durations of the building deliverables, in seconds.
+        """
+        now = time.time()
+        with self.deliverables_open_lock:
+            open_durations = [self.estimate_duration(deliverable_id) for
+                              deliverable_id in self.deliverables_open]
+        with self.deliverables_building_lock:
+            building_durations = [
+                max(0, self.estimate_duration(deliverable_id) -
+                    (now - self.deliverables_started.get(deliverable_id, now)))
+                for deliverable_id in self.deliverables_building]
+        return open_durations, building_durations
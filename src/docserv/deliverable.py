@@ -1,13 +1,16 @@
 import hashlib
+import json
 import logging
 import os
 import shlex
+import shutil
 import subprocess
 import tempfile
 import time
 from lxml import etree
 
-from docserv.functions import feedback_message, parse_d2d_filelist, resource_to_filename
+from docserv.functions import deliverable_id, feedback_message, parse_d2d_filelist, resource_to_filename, run_command
+from docserv.metrics import command_name, metrics
 from docserv.repolock import RepoLock
 
 logger = logging.getLogger('docserv')
@@ -36,6 +39,9 @@ class Deliverable:
         self.last_build_attempt_commit = None
         self.root_id = None  # False if no root id exists
         self.cleanup_done = False
+        # Restored from the build cache, the duration says nothing
+        # about how long a build takes
+        self.build_cache_hit = False
 
         self.source_dir, self.tmp_dir_bi, self.docset_relative_path = dir_struct_paths
         self.parent = parent  # Reference to the parent BuildInstructionHandler
@@ -85,13 +91,12 @@ class Deliverable:
         """
         Generate an ID (hash) from a unique tuple of parameters.
         """
-        return hashlib.md5((self.parent.build_instruction['target'] +
-                            self.parent.build_instruction['docset'] +
-                            self.parent.build_instruction['lang'] +
-                            self.parent.build_instruction['product'] +
-                            self.dc_file +
-                            self.build_format).encode('utf-8')
-                           ).hexdigest()[:9]
+        return deliverable_id(self.parent.build_instruction['target'],
+                              self.parent.build_instruction['docset'],
+                              self.parent.build_instruction['lang'],
+                              self.parent.build_instruction['product'],
+                              self.dc_file,
+                              self.build_format)
 
     def run(self, thread_id):
         """
@@ -99,6 +104,8 @@ class Deliverable:
         """
         with self.parent.deliverables_open_lock:
             self.parent.deliverables[self.id]['last_build_attempt_commit'] = self.parent.build_instruction['commit']
+            # resource usage of the commands of this build
+            self.parent.deliverables[self.id]['commands'] = []
         logger.info("Building deliverable %s (%s, %s) for BI %s. Commit: %s",
                     self.id,
                     self.dc_file,
@@ -197,6 +204,7 @@ class Deliverable:
             use_build_container = "--container=%s" % self.parent.config['targets'][self.parent.build_instruction['target']]['build_container']
         if self.build_container:
             use_build_container = "--container=%s" % self.build_container
+        d2d_command = n
         commands[n] = {}
         commands[n]['cmd'] = "d2d_runner --create-bigfile=1 --json-filelist=1 --auto-validate=1 --validate-tables=0 --container-update=1 %s --xslt-param-file=%s --daps-param-file=%s --out=%s --in=%s --formats=%s %s" % (
             use_build_container,
@@ -249,6 +257,45 @@ class Deliverable:
         # write configuration for overview page
         commands[n]['post_cmd_hook'] = 'write_deliverable_cache'
 
+        # If the inputs of the build did not change since the last
+        # successful build, restore its results instead of running
+        # d2d_runner. Otherwise, store the results for the next build.
+        build_cache_entry = self.get_build_cache_entry(
+            commands[0]['cmd'].replace(xslt_params_file[1], ''),
+            default_xslt_params,
+            daps_params,
+            use_build_container)
+        if build_cache_entry is not None:
+            if os.path.isfile(os.path.join(build_cache_entry, 'deliverable.json')):
+                logger.info("Restoring deliverable %s from build cache %s",
+                            self.id, build_cache_entry)
+                commands = {}
+                n = 0
+                commands[n] = {}
+                commands[n]['cmd'] = "mkdir -p %s" % (tmp_build_full_path)
+                commands[n]['build_cache_entry'] = build_cache_entry
+                commands[n]['pre_cmd_hook'] = 'read_build_cache'
+
+                n += 1
+                commands[n] = {}
+                commands[n]['cmd'] = "rsync -lr %s/ %s" % (
+                    os.path.join(build_cache_entry, 'output'), tmp_build_full_path)
+
+                n += 1
+                commands[n] = {}
+                commands[n]['cmd'] = "mkdir -p %s" % self.deliverable_cache_dir
+                commands[n]['post_cmd_hook'] = 'write_deliverable_cache'
+            else:
+                # the container image was updated while computing the key
+                commands[d2d_command]['cmd'] = commands[d2d_command]['cmd'].replace(
+                    '--container-update=1', '--container-update=0')
+                n += 1
+                commands[n] = {}
+                commands[n]['cmd'] = "mkdir -p %s" % os.path.dirname(build_cache_entry)
+                commands[n]['optional'] = True
+                commands[n]['build_cache_entry'] = build_cache_entry
+                commands[n]['post_cmd_hook'] = 'write_build_cache'
+
         # remove daps parameter file
         n += 1
         commands[n] = {}
@@ -269,6 +316,191 @@ class Deliverable:
         #
         self.iterate_commands(commands, n, thread_id)
 
+    def command_output(self, cmd):
+        """
+        Run a command and return its stripped stdout or None if the
+        command failed.
+        """
+        try:
+            s = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+        except OSError:
+            return None
+        out, err = s.communicate()
+        if int(s.returncode) != 0:
+            logger.debug("Command failed: %s => %s", cmd, err)
+            return None
+        return out.decode('utf-8').strip()
+
+    def get_build_cache_entry(self, xslt_params_cmd, default_xslt_params, daps_params, use_build_container):
+        """
+        Return the directory of the build cache entry for the current
+        inputs of this deliverable or None if the build cache is disabled
+        or the inputs can not be determined. The key of the entry is a
+        hash of the Git tree of the source directory, the normalized DC
+        file, the resolved XSLT and DAPS parameters, the Git objects that
+        symlinks in the source directory point to and the ID of the
+        container image. The container image is updated first, so it is
+        only used without a configured container.
+        """
+        build_cache_dir = self.parent.config['server']['build_cache_dir']
+        if not build_cache_dir:
+            return None
+
+        source_subdir = os.path.relpath(self.source_dir,
+                                        self.parent.local_repo_build_dir)
+        if source_subdir == '.':
+            source_subdir = ''
+        tree_hash = self.command_output("git -C \'%s\' rev-parse \'HEAD:%s\'" % (
+            self.parent.local_repo_build_dir, source_subdir))
+        dc_hash = self.command_output("%s \'%s\'" % (
+            os.path.join(BIN_DIR, 'docserv-dchash'),
+            os.path.join(self.source_dir, self.dc_file)))
+        if tree_hash is None or dc_hash is None:
+            return None
+        symlink_target_hashes = self.symlink_target_hashes()
+        if symlink_target_hashes is None:
+            logger.debug("Not using the build cache for %s, symlinks point outside of the repository.",
+                         self.id)
+            return None
+
+        try:
+            with open(default_xslt_params, 'rb') as f:
+                default_xslt_params_hash = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+
+        # Without an explicitly configured container, d2d_runner picks its
+        # default image, updates of which can not be detected.
+        if not use_build_container:
+            return None
+        # d2d_runner updates the container image before every build, a
+        # build cache hit must not skip that
+        image = use_build_container.replace('--container=', '')
+        if self.command_output("docker pull --quiet \'%s\'" % image) is None:
+            logger.warning("Failed to update container image %s, not using the build cache.", image)
+            return None
+        container_image = self.command_output(
+            "docker image inspect --format='{{.Id}}' \'%s\'" % image)
+        if container_image is None:
+            return None
+
+        key = hashlib.sha256(json.dumps([
+            tree_hash,
+            symlink_target_hashes,
+            dc_hash,
+            self.dc_file,
+            self.build_format,
+            self.subdeliverables,
+            xslt_params_cmd,
+            default_xslt_params_hash,
+            daps_params,
+            container_image,
+            self.parent.lifecycle,
+            self.deliverable_relative_path,
+        ]).encode('utf-8')).hexdigest()
+        return os.path.join(build_cache_dir, self.id, key)
+
+    def symlink_target_hashes(self):
+        """
+        The Git object hashes of all files and directories outside of the
+        source directory that symlinks in it point to, since the Git tree
+        of the source directory only contains the symlinks themselves.
+        Targets are searched for further symlinks. Returns None if a
+        symlink points outside of the repository.
+        """
+        repo_dir = os.path.realpath(self.parent.local_repo_build_dir)
+        source_dir = os.path.realpath(self.source_dir)
+        targets = set()
+        directories = [source_dir]
+        while directories:
+            for rootdir, subdirs, files in os.walk(directories.pop()):
+                if os.path.join(repo_dir, '.git') == rootdir:
+                    subdirs[:] = []
+                    continue
+                for name in subdirs + files:
+                    path = os.path.realpath(os.path.join(rootdir, name))
+                    if not os.path.islink(os.path.join(rootdir, name)) or \
+                            path == source_dir or path.startswith(source_dir + os.sep):
+                        continue
+                    target = os.path.relpath(path, repo_dir)
+                    if target.startswith('..'):
+                        return None
+                    if target not in targets:
+                        targets.add(target)
+                        if os.path.isdir(path):
+                            directories.append(path)
+        hashes = []
+        for target in sorted(targets):
+            target_hash = self.command_output("git -C \'%s\' rev-parse \'HEAD:%s\'" % (
+                self.parent.local_repo_build_dir, target))
+            if target_hash is None:
+                return None
+            hashes.append([target, target_hash])
+        return hashes
+
+    def read_build_cache(self, command, thread_id):
+        """
+        Restore the document information of a cached build.
+        """
+        try:
+            with open(os.path.join(command['build_cache_entry'], 'deliverable.json')) as f:
+                cached = json.loads(f.read())
+        except (OSError, json.decoder.JSONDecodeError):
+            logger.warning("Failed to read build cache entry %s",
+                           command['build_cache_entry'])
+            return False
+        self.title = cached['title']
+        self.subtitle = cached['subtitle']
+        self.product_from_document = cached['product_from_document']
+        self.root_id = cached['root_id']
+        self.dc_hash = cached['dc_hash']
+        self.path = cached['path']
+        self.subdeliverable_info = cached['subdeliverable_info']
+        self.build_cache_hit = True
+        with self.parent.deliverables_open_lock:
+            self.parent.deliverables[self.id]['title'] = self.title
+            self.parent.deliverables[self.id]['path'] = self.path
+        return command
+
+    def write_build_cache(self, command, thread_id):
+        """
+        Copy the build results and the document information to a new
+        build cache entry and move it into place. Only the most recent
+        entry of each deliverable is kept. Failing to write to the build
+        cache does not fail the build.
+        """
+        entry = command['build_cache_entry']
+        tmp_entry = None
+        try:
+            tmp_entry = tempfile.mkdtemp(prefix="tmp_", dir=os.path.dirname(entry))
+            os.makedirs(os.path.join(tmp_entry, 'output'))
+            returncode, out, err, usage = run_command(shlex.split("rsync -lr %s %s/" % (
+                self.d2d_out_dir, os.path.join(tmp_entry, 'output'))))
+            if returncode != 0:
+                raise OSError(err.decode('utf-8').strip())
+            with open(os.path.join(tmp_entry, 'deliverable.json'), 'w') as f:
+                f.write(json.dumps({
+                    'title': self.title,
+                    'subtitle': self.subtitle,
+                    'product_from_document': self.product_from_document,
+                    'root_id': self.root_id,
+                    'dc_hash': self.dc_hash,
+                    'path': self.path,
+                    'subdeliverable_info': self.subdeliverable_info,
+                }))
+            os.rename(tmp_entry, entry)
+        except OSError as error:
+            logger.warning("Failed to write build cache entry %s: %s", entry, error)
+            if tmp_entry is not None:
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+            return True
+        deliverable_dir = os.path.dirname(entry)
+        for old_entry in os.listdir(deliverable_dir):
+            if os.path.join(deliverable_dir, old_entry) != entry:
+                shutil.rmtree(os.path.join(deliverable_dir, old_entry), ignore_errors=True)
+        return True
+
     def iterate_commands(self, commands, n, thread_id):
         """
         Iterate through a dict containing commands. Also execute
@@ -282,6 +514,11 @@ class Deliverable:
                     return self.finish(False)
 
             result = self.execute(commands[i], thread_id)
+            if not result and commands[i].get('optional'):
+                # optional commands, like filling the build cache, do not
+                # fail the build, but their hooks are not run
+                result = True
+                continue
             if not result:  # abort if one command failed
                 return self.finish(False)
 
@@ -297,16 +534,27 @@ class Deliverable:
         """
         cmd = shlex.split(command['cmd'])
         logger.debug("Thread %i: %s" % (thread_id, command))
-        s = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        self.out, self.err = s.communicate()
+        returncode, self.out, self.err, usage = run_command(cmd)
+        labels = {'phase': 'build', 'command': command_name(cmd)}
+        metrics.observe('docserv_command_duration_seconds',
+                        usage['wall_time'], labels)
+        usage['cmd'] = command['cmd']
+        usage['return_value'] = returncode
+        with self.parent.deliverables_open_lock:
+            self.parent.deliverables[self.id].setdefault('commands', []).append(usage)
 
         logging.debug("Command executed: %s => %s || %s", cmd, self.out, self.err)
 
-        if int(s.returncode) != 0:
+        if int(returncode) != 0:
+            metrics.inc('docserv_command_failures_total', labels)
+            if command.get('optional'):
+                logger.warning("Thread %i: Ignoring unexpected return value %i for '%s': %s",
+                               thread_id, returncode, command['cmd'],
+                               self.err.decode('utf-8'))
+                return False
             self.failed_command = command['cmd']
             logger.warning("Thread %i: Build failed! Unexpected return value %i for '%s'",
-                           thread_id, s.returncode, command['cmd'])
+                           thread_id, returncode, command['cmd'])
             logger.warning("Thread %i STDOUT: %s", thread_id,
                            self.out.decode('utf-8'))
             logger.warning("Thread %i STDERR: %s", thread_id,
@@ -324,11 +572,20 @@ class Deliverable:
                 self.parent.deliverables[self.id]['status'] = "success"
             else:
                 self.parent.deliverables[self.id]['status'] = "fail"
+            self.parent.deliverables[self.id]['last_build'] = time.time()
         with self.parent.deliverables_building_lock:
             self.parent.deliverables_building.remove(self.id)
+            started = self.parent.deliverables_started.pop(self.id, None)
+        metrics.inc('docserv_deliverables_total',
+                    {'status': 'success' if result else 'fail'})
+        if result and started is not None and not self.build_cache_hit:
+            self.parent.build_history.record(self.id, self.build_format,
+                                             time.time() - started)
         if result:
             with self.parent.deliverables_open_lock:
                 self.parent.deliverables[self.id]['successful_build_commit'] = self.parent.build_instruction['commit']
+        self.parent.changed('deliverable_finished', deliverable=self.id,
+                            status='success' if result else 'fail')
         return result
 
     def mail(self):
@@ -0,0 +1,121 @@
+import glob
+import logging
+import os
+import threading
+from lxml import etree
+
+from docserv.functions import deliverable_id
+
+logger = logging.getLogger('docserv')
+
+
+class DeliverableIndex:
+    """
+    Index of all known deliverables and their latest build, so questions
+    like "where is the latest PDF of X" can be answered without going
+    through the whole state. Besides the records, there is a set of
+    deliverable IDs for every value of the fields that can be queried,
+    so a query only touches deliverables that match one of its fields.
+
+    Structure of a record:
+    {'id': ..., 'target': ..., 'product': ..., 'docset': ..., 'lang': ...,
+     'format': ..., 'dc': ..., 'status': ..., 'path': ..., 'title': ...,
+     'commit': ..., 'last_build': ...}
+    path, title and commit are those of the last successful build.
+    """
+
+    FIELDS = ['target', 'product', 'docset', 'lang', 'format', 'status']
+
+    def __init__(self):
+        self.records = {}
+        self.by_field = {field: {} for field in self.FIELDS}
+        self.lock = threading.Lock()
+
+    def update(self, record):
+        """
+        Add or update the record of a deliverable. If the build failed,
+        path, title and commit of the previous successful build are kept.
+        """
+        with self.lock:
+            old = self.records.get(record['id'])
+            if old is not None:
+                for field in self.FIELDS:
+                    self.by_field[field][old[field]].discard(record['id'])
+                if record['status'] != 'success':
+                    for field in ['path', 'title', 'commit']:
+                        if record.get(field) is None:
+                            record[field] = old[field]
+            self.records[record['id']] = record
+            for field in self.FIELDS:
+                self.by_field[field].setdefault(record[field], set()).add(record['id'])
+
+    def update_from_build_instruction(self, build_instruction):
+        """
+        Index all deliverables of a build instruction dict.
+        """
+        for deliverable, value in build_instruction.get('deliverables', {}).items():
+            if value.get('status') not in ['success', 'fail']:
+                continue
+            self.update({
+                'id': deliverable,
+                'target': build_instruction['target'],
+                'product': build_instruction['product'],
+                'docset': build_instruction['docset'],
+                'lang': build_instruction['lang'],
+                'format': value['build_format'],
+                'dc': value['dc'],
+                'status': value['status'],
+                'path': value.get('path') if value['status'] == 'success' else None,
+                'title': value.get('title') if value['status'] == 'success' else None,
+                'commit': value.get('successful_build_commit'),
+                'last_build': value.get('last_build'),
+            })
+
+    def load_deliverable_cache(self, cache_dir):
+        """
+        Index the deliverable cache files that are written for building
+        the navigation, to know about deliverables of build instructions
+        that are no longer in the state.
+        Layout: cache_dir/TARGET/LANG/PRODUCT/DOCSET/FORMAT/DC.xml
+        """
+        for path in glob.glob(os.path.join(cache_dir, '*', '*', '*', '*', '*', '*.xml')):
+            target = os.path.relpath(path, cache_dir).split(os.sep)[0]
+            try:
+                root = etree.parse(path).getroot()
+            except etree.XMLSyntaxError:
+                logger.warning("Ignoring unreadable deliverable cache file %s.", path)
+                continue
+            path_element = root.find('path')
+            if path_element is None:
+                continue
+            build_format = path_element.get('format')
+            record = {
+                'target': target,
+                'product': root.get('productid'),
+                'docset': root.get('setid'),
+                'lang': root.get('lang'),
+                'format': build_format,
+                'dc': root.get('dc'),
+                'status': 'success',
+                'path': path_element.text,
+                'title': root.findtext('title'),
+                'commit': root.findtext('commit'),
+                'last_build': int(root.get('cachedate', 0)),
+            }
+            record['id'] = deliverable_id(target, record['docset'], record['lang'],
+                                          record['product'], record['dc'], build_format)
+            self.update(record)
+
+    def query(self, filters):
+        """
+        Return the records of all deliverables that match all filters.
+        filters -- dict mapping fields from FIELDS to values
+        """
+        with self.lock:
+            if not filters:
+                return list(self.records.values())
+            candidates = min([self.by_field[field].get(value, set())
+                              for field, value in filters.items()], key=len)
+            return [self.records[candidate] for candidate in candidates
+                    if all(self.records[candidate][field] == value
+                           for field, value in filters.items())]
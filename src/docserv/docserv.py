@@ -1,22 +1,34 @@
+import collections
 from datetime import datetime
 import hashlib
+import heapq
 import json
 import logging
 import multiprocessing
 import os
 import queue
-import shlex
-import subprocess
 import sys
 import threading
 import tempfile
 import time
+import uuid
 from configparser import ConfigParser as configparser
 
+from docserv.archive import BuildArchive
 from docserv.bih import BuildInstructionHandler
 from docserv.deliverable import Deliverable
+from docserv.deliverableindex import DeliverableIndex
+from docserv.fetch import FetchScheduler
 from docserv.functions import print_help
-from docserv.rest import RESTServer, ThreadedRESTServer
+from docserv.history import BuildHistory
+from docserv.journal import StateJournal
+from docserv.metrics import metrics
+from docserv.navigation import NavigationCache
+from docserv.objectstore import ObjectStore
+from docserv.rest import BoundedRESTServer, RESTServer, ThreadedRESTServer
+from docserv import staging
+from docserv.stitch import ConfigStitcher
+from docserv.targetsync import TargetSync
 
 
 class DocservState:
@@ -55,18 +67,75 @@ class DocservState:
     #
     bih_queue = queue.Queue()
 
+    #
+    # 3.3 A queue that contains BUILD_INSTRUCTION_IDs whose deliverables
+    #     are all finished. Publishing workers take them from here and
+    #     run the cleanup (ZIPs, navigation, syncing to the target).
+    #
+    publish_queue = queue.Queue()
+
     #
     # 4. When a BuildInstructionHandler is finished, its
     #    status is dumped into a dict and kept for the future.
     #
     past_builds = {}
     past_builds_lock = threading.Lock()
+    # IDs of build instructions that were moved from past_builds to the
+    # archive and must be removed from the persisted state.
+    retired_build_instructions = set()
+
+    #
+    # 5. Build instructions that were triggered again while they were
+    #    being prepared or built. Any number of triggers result in a
+    #    single follow-up build once the current build is finished.
+    #
+    pending_rebuilds = {}
+    pending_rebuilds_lock = threading.Lock()
+    # A build that is running is only superseded if its branch moved to
+    # a newer commit. IDs of build instructions whose commit is being
+    # checked map to the checking thread, IDs that were triggered again
+    # during a check are checked once more. Also uses the
+    # pending_rebuilds_lock.
+    supersede_checks = {}
+    supersede_rechecks = set()
 
     # Access to git repositories must be controlled.
     # gitLocks is a dict of repoLock instances.
     gitLocks = {}
     gitLocksLock = threading.Lock()
 
+    # Idle workers block on this condition instead of polling. Every
+    # change that may produce work for a worker increments
+    # work_generation and wakes all waiting workers.
+    work_condition = threading.Condition()
+    work_generation = 0
+
+    # IDs of build instructions that changed since the state was last
+    # written to disk. The state saver thread is woken up through the
+    # state_dirty event and only writes these build instructions.
+    dirty_build_instructions = set()
+    dirty_build_instructions_lock = threading.Lock()
+    state_dirty = threading.Event()
+    # Seconds to wait after a change before writing, so bursts of
+    # changes end up in a single journal write.
+    save_state_delay = 1
+
+    # Incremented on every change of a build instruction. The REST API
+    # serializes the state only once per version and uses the version
+    # for ETags. The epoch keeps ETags from before a restart from
+    # matching.
+    state_version = 0
+    state_epoch = uuid.uuid4().hex[:8]
+    status_cache = None
+    status_cache_lock = threading.Lock()
+
+    # The most recent state transitions of build instructions and
+    # deliverables, for clients that wait for builds on the REST API.
+    # Every event has a sequence number that clients use as a cursor.
+    events = collections.deque(maxlen=10000)
+    event_sequence = 0
+    events_condition = threading.Condition()
+
     def __str__(self):
         return json.dumps(self.dict())
 
@@ -107,24 +176,211 @@ class DocservState:
                            ).hexdigest()[:9]
 
     def queue_build_instruction(self, build_instruction):
+        """
+        Puts a newly arrived build instruction in a dict that queues
+        build instructions, see queue_build_instructions. Returns False
+        if the same build instruction was already queued and nothing
+        new was scheduled.
+        """
+        [(build_instruction_id, result)] = self.queue_build_instructions([build_instruction])
+        return result != 'coalesced'
+
+    def queue_build_instructions(self, build_instructions):
         """
         Puts newly arrived build instructions in a dict that queues
-        build instructions.
+        build instructions. All build instructions are queued with a
+        single acquisition of the locks.
+        If the same build instruction is already queued and has not
+        started, nothing needs to be done. If it is already being prepared
+        or built, a single follow-up build is scheduled for when it is
+        finished. If the branch moved to a newer commit, deliverables that
+        have not started building yet are cancelled, since they would
+        build an outdated commit, see check_superseded.
+        Returns a list with one tuple of the build instruction ID and
+        'queued', 'coalesced' or 'rebuild' per build instruction.
         """
-        retval = False
-        build_instruction['id'] = self.generate_id(build_instruction)
-        if build_instruction['id'] in self.past_builds.keys():
-            with self.past_builds_lock:
-                build_instruction = self.past_builds.pop(
-                    build_instruction['id'])
+        archived = []
+        with self.past_builds_lock:
+            for i, build_instruction in enumerate(build_instructions):
+                build_instruction['id'] = self.generate_id(build_instruction)
+                if build_instruction['id'] in self.past_builds:
+                    build_instructions[i] = self.past_builds.pop(
+                        build_instruction['id'])
+                    # the dict is reused for the new build, keep a copy of
+                    # the previous build in the archive
+                    archived.append(json.loads(json.dumps(build_instructions[i])))
+        self.archive.append(archived)
+
+        # Git fetches that start after this point contain everything
+        # these build instructions were sent for.
+        queued_at = time.time()
+        results = []
         with self.bih_dict_lock:
-            if build_instruction['id'] not in self.bih_dict:
-                with self.scheduled_build_instruction_lock:
-                    if build_instruction['id'] not in self.scheduled_build_instruction:
+            with self.scheduled_build_instruction_lock:
+                for build_instruction in build_instructions:
+                    build_instruction['queued_at'] = queued_at
+                    if build_instruction['id'] in self.bih_dict:
+                        result = 'rebuild'
+                    elif build_instruction['id'] not in self.scheduled_build_instruction:
                         self.scheduled_build_instruction[build_instruction['id']
                                                          ] = build_instruction
-                        retval = True
-        return retval
+                        result = 'queued'
+                    elif build_instruction['id'] in self.updating_build_instruction:
+                        result = 'rebuild'
+                    else:
+                        # the queued copy must not skip the fetch of
+                        # what this build instruction was sent for
+                        self.scheduled_build_instruction[build_instruction['id']
+                                                         ]['queued_at'] = queued_at
+                        result = 'coalesced'
+                    results.append((build_instruction['id'], result))
+
+        for build_instruction, (build_instruction_id, result) in zip(build_instructions, results):
+            if result == 'coalesced':
+                logger.debug("Build instruction %s is already queued.",
+                             build_instruction_id)
+                # queued_at changed
+                self.build_instruction_changed(build_instruction_id)
+            elif result == 'rebuild':
+                logger.info("Build instruction %s is already building, scheduling a rebuild.",
+                            build_instruction_id)
+                with self.pending_rebuilds_lock:
+                    self.pending_rebuilds[build_instruction_id] = build_instruction
+                self.build_instruction_changed(build_instruction_id, 'rebuild_pending')
+                with self.bih_dict_lock:
+                    bih = self.bih_dict.get(build_instruction_id)
+                if bih is not None:
+                    self.check_superseded(bih)
+            else:
+                self.build_instruction_changed(build_instruction_id, 'queued')
+        return results
+
+    def check_superseded(self, bih):
+        """
+        Look up in the background whether the branch of a building BIH
+        moved to a newer commit and supersede the BIH if so. Triggers for
+        the commit that is being built leave the build alone, it is
+        published and followed by the pending rebuild.
+        """
+        build_instruction_id = bih.build_instruction['id']
+        with self.pending_rebuilds_lock:
+            if bih.superseded:
+                return
+            if build_instruction_id in self.supersede_checks:
+                self.supersede_rechecks.add(build_instruction_id)
+                return
+            thread = threading.Thread(target=self.supersede_if_outdated,
+                                      args=(bih,), daemon=True)
+            self.supersede_checks[build_instruction_id] = thread
+        thread.start()
+
+    def supersede_if_outdated(self, bih):
+        build_instruction_id = bih.build_instruction['id']
+        while True:
+            try:
+                outdated = bih.newer_commit_available()
+            except Exception as error:
+                logger.warning("Could not check build instruction %s for newer commits: %s",
+                               build_instruction_id, error)
+                outdated = False
+            if outdated:
+                logger.info("Build instruction %s builds an outdated commit, superseding it.",
+                            build_instruction_id)
+                bih.supersede()
+            with self.pending_rebuilds_lock:
+                if outdated or build_instruction_id not in self.supersede_rechecks:
+                    self.supersede_rechecks.discard(build_instruction_id)
+                    del self.supersede_checks[build_instruction_id]
+                    return
+                self.supersede_rechecks.discard(build_instruction_id)
+
+    def queue_pending_rebuild(self, build_instruction_id):
+        """
+        Queue the follow-up build of a build instruction that was
+        triggered again while it was building.
+        """
+        with self.pending_rebuilds_lock:
+            build_instruction = self.pending_rebuilds.pop(build_instruction_id, None)
+        if build_instruction is not None:
+            logger.info("Queueing rebuild of build instruction %s", build_instruction_id)
+            self.queue_build_instruction(build_instruction)
+
+    def build_instruction_changed(self, build_instruction_id, event=None, **details):
+        """
+        Mark a build instruction as changed, so it will be persisted,
+        and wake up idle workers. If event is set, the change is also
+        reported to clients waiting for events.
+        """
+        if event is not None:
+            self.add_event(event, build_instruction_id, **details)
+        if event == 'deliverable_finished':
+            with self.bih_dict_lock:
+                bih = self.bih_dict.get(build_instruction_id)
+            if bih is not None:
+                self.deliverable_index.update_from_build_instruction(
+                    {'target': bih.build_instruction['target'],
+                     'product': bih.product, 'docset': bih.docset, 'lang': bih.lang,
+                     'deliverables': {details['deliverable']:
+                                      dict(bih.deliverables[details['deliverable']])}})
+        with self.dirty_build_instructions_lock:
+            self.dirty_build_instructions.add(build_instruction_id)
+            self.state_version += 1
+        self.state_dirty.set()
+        self.notify_workers()
+
+    def add_event(self, event, build_instruction_id, **details):
+        with self.events_condition:
+            self.event_sequence += 1
+            self.events.append(dict(details, seq=self.event_sequence,
+                                    time=time.time(), event=event,
+                                    id=build_instruction_id))
+            self.events_condition.notify_all()
+
+    def get_events(self, cursor, timeout, build_instruction_id=None):
+        """
+        Return the events after the sequence number cursor, waiting up to
+        timeout seconds for the first one. Also returns the new cursor
+        and whether events after the cursor were already discarded.
+        build_instruction_id -- only return events of this build instruction
+        """
+        deadline = time.monotonic() + timeout
+        with self.events_condition:
+            while True:
+                missed = len(self.events) > 0 and self.events[0]['seq'] > cursor + 1
+                events = [event for event in self.events if event['seq'] > cursor and
+                          (build_instruction_id is None or event['id'] == build_instruction_id)]
+                remaining = deadline - time.monotonic()
+                if events or missed or remaining <= 0 or not self.end_all.empty():
+                    return events, self.event_sequence, missed
+                # new events only arrive after the cursor is up to date
+                cursor = self.event_sequence
+                self.events_condition.wait(remaining)
+
+    def notify_workers(self):
+        """
+        Wake up all workers that are waiting for work.
+        """
+        with self.work_condition:
+            self.work_generation += 1
+            self.work_condition.notify_all()
+
+    def wait_for_work(self, generation):
+        """
+        Block until notify_workers() was called after the worker took the
+        snapshot `generation` of work_generation or until the server
+        is shutting down.
+        """
+        with self.work_condition:
+            while (self.work_generation == generation and
+                   self.end_all.empty()):
+                self.work_condition.wait()
+
+    def queued_build_instructions(self):
+        """
+        Number of build instructions that wait to be prepared.
+        """
+        with self.scheduled_build_instruction_lock:
+            return len(self.scheduled_build_instruction) - len(self.updating_build_instruction)
 
     def get_scheduled_build_instruction(self):
         """
@@ -164,8 +420,13 @@ class DocservState:
                 build_instruction = self.bih_dict.pop(
                     build_instruction_id).dict()
         if build_instruction is not None:
+            build_instruction['finished_at'] = time.time()
+            build_instruction['overall_status'] = 'fail'
             with self.past_builds_lock:
                 self.past_builds[build_instruction_id] = build_instruction
+        self.build_instruction_changed(build_instruction_id, 'aborted')
+        self.apply_retention()
+        self.queue_pending_rebuild(build_instruction_id)
 
     def finish_build_instruction(self, build_instruction_id):
         """
@@ -178,55 +439,293 @@ class DocservState:
             build_instruction = self.bih_dict.pop(build_instruction_id)
         with self.past_builds_lock:
             self.past_builds[build_instruction_id] = build_instruction.dict()
+            self.past_builds[build_instruction_id]['finished_at'] = time.time()
+            self.past_builds[build_instruction_id]['overall_status'] = build_instruction.overall_status
+        self.build_instruction_changed(build_instruction_id, 'finished',
+                                       status=build_instruction.overall_status)
+        self.apply_retention()
+        self.queue_pending_rebuild(build_instruction_id)
+
+    def fail_build_instruction(self, build_instruction_id):
+        """
+        If publishing a build instruction failed unexpectedly, move it
+        to the past_builds dict as failed.
+        """
+        with self.bih_dict_lock:
+            bih = self.bih_dict.pop(build_instruction_id, None)
+        with self.past_builds_lock:
+            if bih is not None:
+                self.past_builds[build_instruction_id] = bih.dict()
+            build_instruction = self.past_builds.get(build_instruction_id)
+            if build_instruction is not None:
+                build_instruction['finished_at'] = time.time()
+                build_instruction['overall_status'] = 'fail'
+        self.build_instruction_changed(build_instruction_id, 'finished', status='fail')
+        self.apply_retention()
+        self.queue_pending_rebuild(build_instruction_id)
+
+    def apply_retention(self):
+        """
+        Move past builds that are older than past_builds_max_age seconds
+        or exceed past_builds_max_count to the archive.
+        """
+        max_age = self.config['server']['past_builds_max_age']
+        max_count = self.config['server']['past_builds_max_count']
+        if not max_age and not max_count:
+            return
+        now = time.time()
+        with self.past_builds_lock:
+            # oldest first
+            past = sorted(self.past_builds.items(),
+                          key=lambda item: item[1].get('finished_at', item[1].get('queued_at', 0)))
+            expired = []
+            for build_instruction_id, build_instruction in past:
+                finished_at = build_instruction.get('finished_at', build_instruction.get('queued_at', 0))
+                if ((max_age and finished_at < now - max_age) or
+                        (max_count and len(past) - len(expired) > max_count)):
+                    expired.append(build_instruction_id)
+                else:
+                    break
+            retired = [self.past_builds.pop(build_instruction_id)
+                       for build_instruction_id in expired]
+        if not retired:
+            return
+        logger.debug("Archiving %i past builds.", len(retired))
+        self.archive.append(retired)
+        with self.dirty_build_instructions_lock:
+            self.retired_build_instructions.update(expired)
+        for build_instruction_id in expired:
+            self.build_instruction_changed(build_instruction_id)
 
     def get_deliverable(self, thread_id):
         """
-        Get an ID from the bih_queue (currently building BIHs). With that
-        get a deliverable from the BIH itself. If no more deliverables are
-        available, the BIH is finished.
+        Get the IDs from the bih_queue (currently building BIHs). With those
+        get a deliverable from the BIHs themselves. If no more deliverables
+        are available, the BIH is handed over to the publishing workers.
+        BIHs are tried in the order of their priority (see
+        BuildInstructionHandler.priority), so a BIH whose deliverables
+        are all building does not hide open deliverables of other BIHs.
         """
-        try:
-            build_instruction_id = self.bih_queue.get(False)
-        except queue.Empty:
-            return None
-        else:
+        build_instruction_ids = []
+        while True:
+            try:
+                build_instruction_ids.append(self.bih_queue.get(False))
+            except queue.Empty:
+                break
+        build_instruction_ids.sort(
+            key=lambda build_instruction_id: self.bih_dict[build_instruction_id].priority())
+        retval = None
+        for build_instruction_id in build_instruction_ids:
+            if retval is not None:
+                self.bih_queue.put(build_instruction_id)
+                continue
             deliverable = self.bih_dict[build_instruction_id].get_deliverable()
             if deliverable == 'done':
-                self.finish_build_instruction(build_instruction_id)
-                deliverable = None
-            else:  # build instruction is not yet finished, put its ID back on the queue
-                self.bih_queue.put(build_instruction_id)
-        return deliverable
+                self.publish_queue.put(build_instruction_id)
+                continue
+            # build instruction is not yet finished, put its ID back on the queue
+            self.bih_queue.put(build_instruction_id)
+            retval = deliverable
+        if retval is not None:
+            # the deliverable is building now, and there may be more
+            # open deliverables for other workers
+            self.build_instruction_changed(retval.parent.build_instruction['id'],
+                                           'deliverable_started', deliverable=retval.id)
+        return retval
 
-    def save_state(self):
+    def schedule(self):
         """
-        Save status to JSON file.
-        The JSON file usually resides in /var/cache/docserv/[SERVER_NAME].json
+        Estimate when the building build instructions will be finished,
+        based on the durations of earlier builds. Simulates the build
+        threads working through all open deliverables in the order they
+        are scheduled in. This is usually returned on the REST API.
         """
-        f = open(os.path.join(CACHE_DIR, self.config['server']['name'] + '.json'), "w")
-        f.write(json.dumps(self.dict()))
+        with self.bih_dict_lock:
+            bihs = list(self.bih_dict.items())
+        bihs.sort(key=lambda item: item[1].priority())
+        now = time.time()
+        # times at which the build threads become free
+        threads = [0] * self.build_threads
+        work = []
+        for build_instruction_id, bih in bihs:
+            open_durations, building_durations = bih.remaining_work()
+            for duration in building_durations:
+                heapq.heapreplace(threads, threads[0] + duration)
+            work.append((build_instruction_id, sorted(open_durations, reverse=True),
+                         max(building_durations, default=0)))
+        retval = []
+        for build_instruction_id, open_durations, finished in work:
+            for duration in open_durations:
+                start = heapq.heappop(threads)
+                heapq.heappush(threads, start + duration)
+                finished = max(finished, start + duration)
+            retval.append({'id': build_instruction_id,
+                           'open': len(open_durations),
+                           'remaining': finished,
+                           'estimated_completion': now + finished})
+        return retval
+
+    def status_snapshot(self):
+        """
+        Return the state version and a copy of all build instructions,
+        each with an additional 'status': 'queued', 'building', 'success',
+        'fail' or 'superseded'. The copy is only created again after the state
+        changed, so frequent status queries neither serialize the whole
+        state nor hold the locks of the workers.
+        """
+        with self.status_cache_lock:
+            version = self.state_version
+            if self.status_cache is not None and self.status_cache[0] == version:
+                return self.status_cache
+            entries = []
+            with self.scheduled_build_instruction_lock:
+                for build_instruction in self.scheduled_build_instruction.values():
+                    entries.append(('queued', json.dumps(build_instruction)))
+            with self.bih_dict_lock:
+                for bih in self.bih_dict.values():
+                    entries.append(('building', json.dumps(bih.dict())))
+            with self.past_builds_lock:
+                for build_instruction in self.past_builds.values():
+                    entries.append((None, json.dumps(build_instruction)))
+            snapshot = []
+            for status, serialized in entries:
+                build_instruction = json.loads(serialized)
+                if status is None:
+                    status = build_instruction.get('overall_status')
+                if status is None:
+                    # past build from a state file that was written
+                    # before the overall status was recorded
+                    status = 'success'
+                    for deliverable in build_instruction.get('deliverables', {}).values():
+                        if deliverable.get('status') == 'fail':
+                            status = 'fail'
+                            break
+                build_instruction['status'] = status
+                snapshot.append(build_instruction)
+            self.status_cache = (version, snapshot)
+            return self.status_cache
+
+    def query_build_instructions(self, filters, offset=0, limit=None):
+        """
+        Return the state version, the number of matching build instructions
+        and one page of them.
+        filters -- dict with any of the keys product, docset, lang, target,
+                   status (values must match exactly) and since (only build
+                   instructions queued at or after this Unix time)
+        """
+        version, snapshot = self.status_snapshot()
+        since = filters.get('since')
+        matches = []
+        for build_instruction in snapshot:
+            if since is not None and build_instruction.get('queued_at', 0) < since:
+                continue
+            if any(build_instruction.get(key) != value for key, value in filters.items()
+                   if key != 'since'):
+                continue
+            matches.append(build_instruction)
+        end = None if limit is None else offset + limit
+        return version, len(matches), matches[offset:end]
+
+    def get_build_instruction_dict(self, build_instruction_id):
+        """
+        Get a copy of the dict of a single build instruction, independent
+        of whether it is queued, building or finished. The copy is taken
+        while holding the lock of the dict the build instruction is in, so
+        it can be serialized while the workers change the original.
+        Returns None if the build instruction is unknown.
+        """
+        serialized = None
+        with self.scheduled_build_instruction_lock:
+            if build_instruction_id in self.scheduled_build_instruction:
+                serialized = json.dumps(self.scheduled_build_instruction[build_instruction_id])
+        if serialized is None:
+            with self.bih_dict_lock:
+                if build_instruction_id in self.bih_dict:
+                    serialized = json.dumps(self.bih_dict[build_instruction_id].dict())
+        if serialized is None:
+            with self.past_builds_lock:
+                if build_instruction_id in self.past_builds:
+                    serialized = json.dumps(self.past_builds[build_instruction_id])
+        if serialized is None:
+            return None
+        return json.loads(serialized)
+
+    def copy_state(self):
+        """
+        Like dict(), but returns copies that are taken while holding the
+        locks, see get_build_instruction_dict.
+        """
+        serialized = []
+        with self.scheduled_build_instruction_lock:
+            for build_instruction in self.scheduled_build_instruction.values():
+                serialized.append(json.dumps(build_instruction))
+        with self.bih_dict_lock:
+            for bih in self.bih_dict.values():
+                serialized.append(json.dumps(bih.dict()))
+        with self.past_builds_lock:
+            for build_instruction in self.past_builds.values():
+                serialized.append(json.dumps(build_instruction))
+        return [json.loads(build_instruction) for build_instruction in serialized]
+
+    def save_state(self, compact=False):
+        """
+        Append all build instructions that changed since the last call to
+        the state journal. If the journal has grown too large or compact
+        is set, write a new snapshot of the complete state instead.
+        The snapshot usually resides in /var/cache/docserv/[SERVER_NAME].json
+        """
+        with self.dirty_build_instructions_lock:
+            dirty = self.dirty_build_instructions
+            self.dirty_build_instructions = set()
+            retired = self.retired_build_instructions
+            self.retired_build_instructions = set()
+            self.state_dirty.clear()
+        changes = {}
+        for build_instruction_id in dirty:
+            build_instruction = self.get_build_instruction_dict(build_instruction_id)
+            # A build instruction that is moving between the scheduled
+            # dict and the bih_dict is marked dirty again afterwards.
+            if build_instruction is not None:
+                changes[build_instruction_id] = build_instruction
+            elif build_instruction_id in retired:
+                changes[build_instruction_id] = None
+        try:
+            self.journal.append(changes)
+            if compact or self.journal.needs_compaction():
+                self.journal.compact(self.copy_state())
+        except Exception:
+            # write the changes again next time
+            with self.dirty_build_instructions_lock:
+                self.dirty_build_instructions.update(dirty)
+                self.retired_build_instructions.update(retired)
+            self.state_dirty.set()
+            raise
 
     def load_state(self):
         """
-        Load status from JSON file.
-        The JSON file usually resides in /var/cache/docserv/[SERVER_NAME].json
+        Load status from the snapshot and the state journal.
+        The snapshot usually resides in /var/cache/docserv/[SERVER_NAME].json
         """
         logger.info("Reading previous state.")
-        filepath = os.path.join(CACHE_DIR, self.config['server']['name'] + '.json')
-        if os.path.isfile(filepath):
-            file = open(filepath, "r")
-            try:
-                state = json.loads(file.read())
-            except json.decoder.JSONDecodeError:
-                return False
-            for build_instruction in state:
-                if ('building' in build_instruction and len(build_instruction['building']) > 0) or ('open' in build_instruction and len(build_instruction['open']) > 0):
-                    self.queue_build_instruction(build_instruction)
-                else:
-                    self.past_builds[build_instruction['id']
-                                     ] = build_instruction
-            return True
-        return False
+        self.journal = StateJournal(
+            os.path.join(CACHE_DIR, self.config['server']['name'] + '.json'))
+        state = self.journal.load()
+        self.deliverable_index.load_deliverable_cache(
+            os.path.join(CACHE_DIR, self.config['server']['name']))
+        if state is None:
+            return False
+        for build_instruction in state:
+            self.deliverable_index.update_from_build_instruction(build_instruction)
+        for build_instruction in state:
+            if ('building' in build_instruction and len(build_instruction['building']) > 0) or ('open' in build_instruction and len(build_instruction['open']) > 0):
+                self.queue_build_instruction(build_instruction)
+            else:
+                self.past_builds[build_instruction['id']
+                                 ] = build_instruction
+        self.apply_retention()
+        # Start with a fresh snapshot and an empty journal.
+        self.save_state(compact=True)
+        return True
 
     def parse_build_instruction(self, thread_id):
         build_instruction = self.get_scheduled_build_instruction()
@@ -235,17 +734,28 @@ class DocservState:
             myBIH = BuildInstructionHandler(
                 build_instruction,
                 self.config,
-                self.stitch_tmp_dir, self.gitLocks, self.gitLocksLock, thread_id)
+                self.stitch_tmp_dir, self.config_stitchers, self.gitLocks, self.gitLocksLock,
+                self.repo_fetches, self.build_history, self.target_syncs, self.object_stores,
+                self.navigation_caches, thread_id,
+                self.build_instruction_changed)
             # If the initialization failed, immediately delete the BuildInstructionHandler
             if myBIH.initialized == False:
                 self.abort_build_instruction(build_instruction['id'])
                 return
             if myBIH.build_docs:
                 myBIH.generate_deliverables()
+            myBIH.update_priority()
             self.remove_scheduled_build_instruction(build_instruction['id'])
             with self.bih_dict_lock:
                 self.bih_dict[build_instruction['id']] = myBIH
+            # triggered again while the repository was prepared
+            with self.pending_rebuilds_lock:
+                rebuild_pending = build_instruction['id'] in self.pending_rebuilds
+            if rebuild_pending:
+                self.check_superseded(myBIH)
             self.bih_queue.put(build_instruction['id'])
+            self.build_instruction_changed(build_instruction['id'], 'repo_ready',
+                                           commit=build_instruction.get('commit'))
 
 
 class DocservConfig:
@@ -279,8 +789,69 @@ class DocservConfig:
             self.config['server']['port'] = int(config['server']['port'])
             self.config['server']['enable_mail'] = config['server']['enable_mail']
             self.config['server']['repo_dir'] = join_conf_dir(config['server']['repo_dir'])
+            # Both are optional, by default every build instruction fetches
+            # unless another fetch started after it was queued, and there is
+            # no background fetching.
+            self.config['server']['fetch_freshness'] = 0
+            if 'fetch_freshness' in list(config['server'].keys()):
+                self.config['server']['fetch_freshness'] = int(config['server']['fetch_freshness'])
+            self.config['server']['prefetch_interval'] = 0
+            if 'prefetch_interval' in list(config['server'].keys()):
+                self.config['server']['prefetch_interval'] = int(config['server']['prefetch_interval'])
+            self.config['server']['sparse_checkout'] = 'no'
+            if 'sparse_checkout' in list(config['server'].keys()):
+                self.config['server']['sparse_checkout'] = config['server']['sparse_checkout']
+            self.config['server']['partial_clone'] = 'no'
+            if 'partial_clone' in list(config['server'].keys()):
+                self.config['server']['partial_clone'] = config['server']['partial_clone']
+            # Threads for preparing repositories and for publishing are
+            # separate from the build threads, so Git and rsync do not
+            # block builds.
+            self.config['server']['prepare_threads'] = 1
+            if 'prepare_threads' in list(config['server'].keys()):
+                self.config['server']['prepare_threads'] = int(config['server']['prepare_threads'])
+            self.config['server']['publish_threads'] = 1
+            if 'publish_threads' in list(config['server'].keys()):
+                self.config['server']['publish_threads'] = int(config['server']['publish_threads'])
+            # without threads, the stage would never process anything
+            for stage_threads in ['prepare_threads', 'publish_threads']:
+                if self.config['server'][stage_threads] < 1:
+                    logger.warning(
+                        "Invalid configuration file, %s must be at least 1. Exiting.", stage_threads)
+                    sys.exit(1)
+            # Past builds are kept in memory without limits unless
+            # configured otherwise, the archive keeps 10 per build
+            # instruction by default.
+            self.config['server']['past_builds_max_age'] = 0
+            if 'past_builds_max_age' in list(config['server'].keys()):
+                self.config['server']['past_builds_max_age'] = int(config['server']['past_builds_max_age'])
+            self.config['server']['past_builds_max_count'] = 0
+            if 'past_builds_max_count' in list(config['server'].keys()):
+                self.config['server']['past_builds_max_count'] = int(config['server']['past_builds_max_count'])
+            self.config['server']['archive_max_per_build_instruction'] = 10
+            if 'archive_max_per_build_instruction' in list(config['server'].keys()):
+                self.config['server']['archive_max_per_build_instruction'] = int(config['server']['archive_max_per_build_instruction'])
+            # By default, the REST API uses a new thread per connection
+            # and accepts build instructions regardless of the queue.
+            self.config['server']['rest_threads'] = 0
+            if 'rest_threads' in list(config['server'].keys()):
+                self.config['server']['rest_threads'] = int(config['server']['rest_threads'])
+            self.config['server']['rest_max_event_clients'] = 100
+            if 'rest_max_event_clients' in list(config['server'].keys()):
+                self.config['server']['rest_max_event_clients'] = int(config['server']['rest_max_event_clients'])
+            self.config['server']['rest_max_request_size'] = 1048576
+            if 'rest_max_request_size' in list(config['server'].keys()):
+                self.config['server']['rest_max_request_size'] = int(config['server']['rest_max_request_size'])
+            self.config['server']['max_queued_build_instructions'] = 0
+            if 'max_queued_build_instructions' in list(config['server'].keys()):
+                self.config['server']['max_queued_build_instructions'] = int(config['server']['max_queued_build_instructions'])
             self.config['server']['temp_repo_dir'] = join_conf_dir(config['server']['temp_repo_dir'])
             self.config['server']['valid_languages'] = config['server']['valid_languages']
+            # The build cache is optional, it is disabled if no directory
+            # is configured.
+            self.config['server']['build_cache_dir'] = False
+            if 'build_cache_dir' in list(config['server'].keys()):
+                self.config['server']['build_cache_dir'] = join_conf_dir(config['server']['build_cache_dir'])
             if config['server']['max_threads'] == 'max':
                 self.config['server']['max_threads'] = multiprocessing.cpu_count()
             else:
@@ -305,6 +876,21 @@ class DocservConfig:
                 self.config['targets'][secname]['enable_target_sync'] = sec['enable_target_sync']
                 if sec['enable_target_sync'] == 'yes':
                     self.config['targets'][secname]['target_path'] = sec['target_path']
+                self.config['targets'][secname]['target_sync_scope'] = 'docset'
+                if 'target_sync_scope' in list(sec.keys()):
+                    self.config['targets'][secname]['target_sync_scope'] = sec['target_sync_scope']
+                self.config['targets'][secname]['target_sync_window'] = 0
+                if 'target_sync_window' in list(sec.keys()):
+                    self.config['targets'][secname]['target_sync_window'] = int(sec['target_sync_window'])
+                self.config['targets'][secname]['publish_mode'] = 'copy'
+                if 'publish_mode' in list(sec.keys()):
+                    self.config['targets'][secname]['publish_mode'] = sec['publish_mode']
+                self.config['targets'][secname]['publish_keep'] = 1
+                if 'publish_keep' in list(sec.keys()):
+                    self.config['targets'][secname]['publish_keep'] = int(sec['publish_keep'])
+                self.config['targets'][secname]['dedup_store'] = False
+                if 'dedup_store' in list(sec.keys()):
+                    self.config['targets'][secname]['dedup_store'] = join_conf_dir(sec['dedup_store'])
                 self.config['targets'][secname]['backup_path'] = join_conf_dir(sec['backup_path'])
                 self.config['targets'][secname]['config_dir'] = join_conf_dir(sec['config_dir'])
                 self.config['targets'][secname]['languages'] = sec['languages']
@@ -348,6 +934,39 @@ class Docserv(DocservState, DocservConfig):
                      2: logging.DEBUG,
                      }
         logger.setLevel(LOGLEVELS[self.config['server']['loglevel']])
+        self.repo_fetches = FetchScheduler(
+            self.config['server']['repo_dir'],
+            self.gitLocks, self.gitLocksLock,
+            self.config['server']['fetch_freshness'],
+            self.config['server']['prefetch_interval'],
+            self.config['server']['partial_clone'] == 'yes')
+        self.deliverable_index = DeliverableIndex()
+        self.archive = BuildArchive(
+            os.path.join(CACHE_DIR, self.config['server']['name'] + '-archive.jsonl'),
+            self.config['server']['archive_max_per_build_instruction'])
+        self.build_history = BuildHistory(
+            os.path.join(CACHE_DIR, self.config['server']['name'] + '-history.json'))
+        self.navigation_caches = {}
+        for target in self.config['targets']:
+            self.navigation_caches[target] = NavigationCache(
+                os.path.join(CACHE_DIR, self.config['server']['name'], target),
+                os.path.join(CACHE_DIR, self.config['server']['name'],
+                             target + '-navigation-cache.xml'))
+        self.object_stores = {}
+        for target in self.config['targets']:
+            if self.config['targets'][target]['dedup_store']:
+                self.object_stores[target] = ObjectStore(
+                    self.config['targets'][target]['dedup_store'])
+        self.target_syncs = {}
+        for target in self.config['targets']:
+            if self.config['targets'][target]['enable_target_sync'] == 'yes':
+                self.target_syncs[target] = TargetSync(
+                    self.config['targets'][target]['backup_path'],
+                    self.config['targets'][target]['target_path'],
+                    self.config['targets'][target]['target_sync_scope'],
+                    self.config['targets'][target]['target_sync_window'],
+                    self.config['targets'][target]['publish_mode'] == 'staged',
+                    target in self.object_stores)
         self.load_state()
 
     def start(self):
@@ -360,6 +979,7 @@ class Docserv(DocservState, DocservConfig):
             logger.info("Reducing number of build threads to avoid using more threads than there are cores.")
 
         logger.info("Will use %i build threads.", self.config['server']['max_threads'])
+        self.build_threads = min([os.cpu_count(), self.config['server']['max_threads']])
 
         try:
             # After starting docserv, make sure to stitch as the first thing,
@@ -371,91 +991,360 @@ class Docserv(DocservState, DocservConfig):
             os.makedirs(self.stitch_tmp_dir, exist_ok=True)
 
             # Notably, the config dir can be different for different targets.
-            # So, stitch for each.
+            # So, stitch for each. The stitchers are kept for the lifetime
+            # of the process, so later stitching only needs to validate
+            # configuration files that changed.
+            self.config_stitchers = {}
             for target in self.config['targets']:
                 stitch_tmp_file = os.path.join(self.stitch_tmp_dir,
                     ('productconfig_simplified_%s.xml' % target))
-                # Largely copypasta from bih.py cuz I dunno how to share stuff
                 logger.debug("Stitching XML config directory to %s",
                              stitch_tmp_file)
-                # Don't use --revalidate-only parameter: after starting we
+                # A new stitcher validates everything: after starting we
                 # really want to make sure that the config is alright.
-                cmd = ('%s --simplify '
-                       '--valid-languages="%s" '
-                       '--valid-site-sections="%s" '
-                       '%s %s') % (
-                    os.path.join(BIN_DIR, 'docserv-stitch'),
+                self.config_stitchers[target] = ConfigStitcher(
+                    self.config['targets'][target]['config_dir'],
                     self.config['server']['valid_languages'],
                     self.config['targets'][target]['site_sections'],
-                    self.config["targets"][target]['config_dir'],
-                    stitch_tmp_file)
-                logger.debug("Stitching command: %s", cmd)
-                cmd = shlex.split(cmd)
-                s = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-                self.out, self.err = s.communicate()
-                rc = int(s.returncode)
-                if rc == 0:
+                    self.config['server']['max_threads'])
+                if self.config_stitchers[target].stitch(stitch_tmp_file):
                     logger.debug("Stitching of %s successful",
                                  self.config['targets'][target]['config_dir'])
                 else:
                     logger.warning("Stitching of %s failed!",
                                    self.config['targets'][target]['config_dir'])
-                    logger.warning("Stitching STDOUT: %s", self.out.decode('utf-8'))
-                    logger.warning("Stitching STDERR: %s", self.err.decode('utf-8'))
-                # End copypasta
 
             thread_receive = threading.Thread(target=self.listen)
             thread_receive.start()
+            thread_state_saver = threading.Thread(target=self.state_saver,
+                                                  name="state-saver")
+            thread_state_saver.start()
+            thread_prefetch = threading.Thread(target=self.repo_fetches.prefetch,
+                                               name="prefetch",
+                                               args=(self.configured_remotes,))
+            thread_prefetch.start()
+            # Every stage of the pipeline has its own pool of threads, the
+            # thread IDs are unique across all pools.
             workers = []
-            for i in range(0, min([os.cpu_count(), self.config['server']['max_threads']])):
-                logger.info("Starting build thread %i", i)
-                worker = threading.Thread(target=self.worker,
-                                          name=f"worker-{i}",
-                                          args=(i,))
-                worker.start()
-                workers.append(worker)
+            stages = [('build', self.build_worker, self.build_threads),
+                      ('prepare', self.prepare_worker,
+                       self.config['server']['prepare_threads']),
+                      ('publish', self.publish_worker,
+                       self.config['server']['publish_threads'])]
+            for stage, target, count in stages:
+                for _ in range(0, count):
+                    i = len(workers)
+                    logger.info("Starting %s thread %i", stage, i)
+                    worker = threading.Thread(target=target,
+                                              name=f"{stage}-{i}",
+                                              args=(i,))
+                    worker.start()
+                    workers.append(worker)
             # to have a clean shutdown, wait for all threads to finish
             thread_receive.join()
         except KeyboardInterrupt:
             self.exit()
         for worker in workers:
             worker.join()
+        thread_state_saver.join()
+        thread_prefetch.join()
         self.rest.shutdown()
-        self.save_state()
+        self.save_state(compact=True)
+        self.build_history.flush()
 
     def exit(self):
         logger.warning(
             "Received SIGINT. Telling all threads to end. Please wait.")
         self.end_all.put("now")
+        self.notify_workers()
+        # end requests that wait for events
+        with self.events_condition:
+            self.events_condition.notify_all()
+        for _ in range(0, self.config['server']['publish_threads']):
+            self.publish_queue.put(None)
+        self.state_dirty.set()
+        self.repo_fetches.stop()
 
-    def worker(self, thread_id):
+    def prepare_worker(self, thread_id):
+        """
+        First stage: take build instructions that arrived on the REST API,
+        read the configuration, prepare the Git repository and put the
+        BIH on the bih_queue.
+        """
         while(True):
+            # 0. remember the current work generation, any change to the
+            #    state after this point will wake us up again in step 2
+            with self.work_condition:
+                generation = self.work_generation
+
             # 1. parse input from rest api and put the instance of the doc class on the currently building queue
+            started = time.monotonic()
             self.parse_build_instruction(thread_id)
+            metrics.inc('docserv_worker_busy_seconds_total', {'stage': 'prepare'},
+                        time.monotonic() - started)
+
+            # 2. sleep until there is something new to do
+            self.wait_for_work(generation)
+
+            # 3. end thread if sigint
+            if not self.end_all.empty():
+                return True
 
-            # 2. get doc from currently_building queue and then a deliverable from doc.
+    def build_worker(self, thread_id):
+        """
+        Second stage: build deliverables of prepared build instructions.
+        """
+        while(True):
+            # 0. remember the current work generation, any change to the
+            #    state after this point will wake us up again in step 2
+            with self.work_condition:
+                generation = self.work_generation
+
+            # 1. get doc from currently_building queue and then a deliverable from doc.
             #    after that, put doc back on the currently building queue. unless it was
             #    the last deliverable.
             deliverable = self.get_deliverable(thread_id)
             if deliverable is not None:
+                started = time.monotonic()
                 deliverable.run(thread_id)
+                metrics.inc('docserv_worker_busy_seconds_total', {'stage': 'build'},
+                            time.monotonic() - started)
+
+            # 2. sleep until there is something new to do
+            self.wait_for_work(generation)
 
             # 3. end thread if sigint
             if not self.end_all.empty():
                 return True
 
-            # 4. wait for a short while, then repeat
-            time.sleep(0.1)
+    def publish_worker(self, thread_id):
+        """
+        Third stage: publish build instructions whose deliverables are
+        all finished.
+        """
+        while(True):
+            build_instruction_id = self.publish_queue.get()
+            # exit() puts one None per publishing thread on the queue
+            if build_instruction_id is None:
+                return True
+            started = time.monotonic()
+            try:
+                self.finish_build_instruction(build_instruction_id)
+            except Exception as error:
+                # keep the thread, the stage would lose it for good
+                logger.warning("Publishing build instruction %s failed: %s",
+                               build_instruction_id, error)
+                self.fail_build_instruction(build_instruction_id)
+            metrics.inc('docserv_worker_busy_seconds_total', {'stage': 'publish'},
+                        time.monotonic() - started)
 
-            # Thread 0 is frequently saving the state
-            if thread_id == 0:
+    def state_saver(self):
+        """
+        Write changed build instructions to the state journal whenever
+        something changed.
+        """
+        while(True):
+            self.state_dirty.wait()
+            if not self.end_all.empty():
+                return True
+            # give concurrent changes a moment to accumulate
+            time.sleep(self.save_state_delay)
+            try:
                 self.save_state()
+            except Exception as error:
+                logger.warning("Failed to save the state, trying again: %s", error)
+
+    def configured_remotes(self):
+        """
+        Set of all Git remotes in the product configuration of all
+        active targets.
+        """
+        remotes = set()
+        for target in self.config_stitchers:
+            if self.config['targets'][target]['active'] != "yes":
+                continue
+            index = self.config_stitchers[target].index
+            if index is None:
+                continue
+            for product in index.products.values():
+                for docset in product['docsets'].values():
+                    if docset['remote'] is not None:
+                        remotes.add(docset['remote'])
+        return remotes
+
+    def get_metrics(self):
+        """
+        Return the current metrics in the Prometheus text format. This is
+        usually returned on the REST API.
+        """
+        with self.scheduled_build_instruction_lock:
+            scheduled = len(self.scheduled_build_instruction) - len(self.updating_build_instruction)
+            preparing = len(self.updating_build_instruction)
+        open_deliverables = 0
+        building_deliverables = 0
+        with self.bih_dict_lock:
+            building = len(self.bih_dict)
+            for bih in self.bih_dict.values():
+                open_deliverables += len(bih.deliverables_open)
+                building_deliverables += len(bih.deliverables_building)
+        publishing = self.publish_queue.qsize()
+        with self.past_builds_lock:
+            past = len(self.past_builds)
+        gauges = [
+            ('docserv_build_instructions', 'Build instructions by state.',
+             {(('state', 'scheduled'),): scheduled,
+              (('state', 'preparing'),): preparing,
+              (('state', 'building'),): building - publishing,
+              (('state', 'publishing'),): publishing,
+              (('state', 'past'),): past}),
+            ('docserv_deliverables', 'Deliverables of building build instructions by state.',
+             {(('state', 'open'),): open_deliverables,
+              (('state', 'building'),): building_deliverables}),
+            ('docserv_worker_threads', 'Number of worker threads by pipeline stage.',
+             {(('stage', 'prepare'),): self.config['server']['prepare_threads'],
+              (('stage', 'build'),): self.build_threads,
+              (('stage', 'publish'),): self.config['server']['publish_threads']}),
+        ]
+        return metrics.render(gauges)
+
+    def queue_push(self, remote, branch, paths=None):
+        """
+        Queue build instructions for everything that is built from a
+        branch of a remote in all active targets. Returns the list of
+        build instructions that were queued.
+        """
+        build_instructions = []
+        for target in self.config_stitchers:
+            if self.config['targets'][target]['active'] != "yes":
+                continue
+            index = self.config_stitchers[target].index
+            if index is None:
+                continue
+            for productid, setid, lang in index.get_affected_languages(remote, branch, paths):
+                build_instructions.append({
+                    'target': target,
+                    'product': productid,
+                    'docset': setid,
+                    'lang': lang,
+                })
+        self.queue_build_instructions([dict(build_instruction) for
+                                       build_instruction in build_instructions])
+        logger.info("Push to %s (%s) queued %i build instructions.",
+                    remote, branch, len(build_instructions))
+        return build_instructions
+
+    def expand_build_instruction(self, pattern):
+        """
+        Return the list of build instructions matching a build instruction
+        that can contain wildcards: a missing or "*" target, product,
+        docset or lang matches all values in the product configuration.
+        Only active targets match the target wildcard. An optional
+        'lifecycle' (string or list) restricts the matching docsets.
+        Returns None if the pattern is invalid or matches nothing.
+        """
+        if not isinstance(pattern, dict):
+            return None
+        lifecycles = pattern.get('lifecycle')
+        if isinstance(lifecycles, str):
+            lifecycles = [lifecycles]
+        for key in ['target', 'product', 'docset', 'lang']:
+            if not isinstance(pattern.get(key, '*'), str):
+                return None
+        if not isinstance(pattern.get('priority', 0), int):
+            return None
+        if pattern.get('target', '*') == '*':
+            targets = [target for target in self.config_stitchers
+                       if self.config['targets'][target]['active'] == "yes"]
+        elif pattern['target'] in self.config_stitchers:
+            targets = [pattern['target']]
+        else:
+            return None
+
+        def matches(key, value):
+            return pattern.get(key, '*') in ['*', value]
+
+        build_instructions = []
+        for target in targets:
+            index = self.config_stitchers[target].index
+            if index is None:
+                continue
+            for productid, product in index.products.items():
+                if not matches('product', productid):
+                    continue
+                for setid, docset in product['docsets'].items():
+                    if not matches('docset', setid):
+                        continue
+                    if lifecycles is not None and docset['lifecycle'] not in lifecycles:
+                        continue
+                    for lang in docset['languages']:
+                        if not matches('lang', lang):
+                            continue
+                        build_instruction = {'target': target, 'product': productid,
+                                             'docset': setid, 'lang': lang}
+                        if 'priority' in pattern:
+                            build_instruction['priority'] = pattern['priority']
+                        build_instructions.append(build_instruction)
+        return build_instructions or None
+
+    def queue_bulk(self, patterns):
+        """
+        Expand a list of build instructions with wildcards and queue all
+        resulting build instructions at once. Returns a dict with the
+        lists of queued, coalesced and rebuilding build instructions and
+        the invalid patterns.
+        """
+        retval = {'queued': [], 'coalesced': [], 'rebuild': [], 'invalid': []}
+        build_instructions = []
+        for pattern in patterns:
+            expanded = self.expand_build_instruction(pattern)
+            if expanded is None:
+                retval['invalid'].append(pattern)
+            else:
+                build_instructions += expanded
+        results = self.queue_build_instructions(
+            [dict(build_instruction) for build_instruction in build_instructions])
+        for build_instruction, (build_instruction_id, result) in zip(build_instructions, results):
+            build_instruction['id'] = build_instruction_id
+            retval[result].append(build_instruction)
+        logger.info("Bulk request queued %i, coalesced %i and rebuilds %i build instructions.",
+                    len(retval['queued']), len(retval['coalesced']), len(retval['rebuild']))
+        return retval
+
+    def rollback(self, build_instruction):
+        """
+        Switch a docset that was published with publish_mode = staged
+        back to the previously published version and synchronize it to
+        the target. Returns the name of that version or None if there
+        is nothing to roll back to.
+        """
+        target = build_instruction.get('target')
+        if target not in self.config['targets'] or \
+                self.config['targets'][target]['publish_mode'] != 'staged':
+            return None
+        parts = [build_instruction.get(key) for key in ['lang', 'product', 'docset']]
+        for part in parts:
+            if not isinstance(part, str) or not part or part.startswith('.') or os.sep in part:
+                return None
+        docset_relative_path = os.path.join(*parts)
+        version = staging.rollback(os.path.join(
+            self.config['targets'][target]['backup_path'], docset_relative_path))
+        if version is None:
+            return None
+        logger.info("Rolled back %s of target %s to %s.", docset_relative_path,
+                    target, os.path.basename(version))
+        if target in self.target_syncs:
+            self.target_syncs[target].sync([docset_relative_path])
+        return os.path.basename(version)
 
     def listen(self):
         server_address = (self.config['server']['host'], int(
             self.config['server']['port']))
-        self.rest = ThreadedRESTServer(server_address, RESTServer, self)
+        if self.config['server']['rest_threads'] > 0:
+            self.rest = BoundedRESTServer(server_address, RESTServer, self,
+                                          self.config['server']['rest_threads'],
+                                          self.config['server']['rest_max_event_clients'])
+        else:
+            self.rest = ThreadedRESTServer(server_address, RESTServer, self)
         self.rest.serve_forever()
         return True
 
@@ -484,4 +1373,5 @@ def main():
         sys.exit(0)
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import logging
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+from docserv.functions import resource_to_filename
+from docserv.repolock import RepoLock
+
+logger = logging.getLogger('docserv')
+
+
+class FetchScheduler:
+    """
+    Keeps track of when the cached Git mirrors were fetched, so build
+    instructions for the same repository that arrive together do not
+    all fetch one after another. A build instruction can skip fetching
+    if another fetch of the same mirror started after the build
+    instruction was queued (minus the configurable freshness window),
+    because that fetch already includes everything the build instruction
+    was sent for.
+    Optionally, all remotes of the product configuration are fetched
+    periodically in the background, so build instructions start from an
+    already fresh mirror.
+    """
+
+    def __init__(self, repo_dir, gitLocks, gitLocksLock, freshness=0, prefetch_interval=0, partial_clone=False):
+        """
+        repo_dir -- directory containing the cached mirrors
+        gitLocks -- dict of all existing gitLocks
+        gitLocksLock -- Lock for accessing gitLocks
+        freshness -- seconds a fetch that started before a build
+                     instruction was queued still counts as fresh
+        prefetch_interval -- seconds between background fetches of all
+                             remotes, 0 disables background fetching
+        partial_clone -- create new mirrors without file contents, these
+                         are fetched when they are needed
+        """
+        self.repo_dir = repo_dir
+        self.gitLocks = gitLocks
+        self.gitLocksLock = gitLocksLock
+        self.freshness = freshness
+        self.prefetch_interval = prefetch_interval
+        self.partial_clone = partial_clone
+        # Per mirror directory: time the last successful fetch started,
+        # number of fetches, number of skipped (coalesced) fetches
+        self.last_fetch = {}
+        self.fetch_count = {}
+        self.coalesced_count = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def mirror_dir(self, remote_repo):
+        # The ".git" suffix keeps mirrors apart from the non-bare clones
+        # that were used as a cache by earlier versions.
+        return os.path.join(self.repo_dir, resource_to_filename(remote_repo) + '.git')
+
+    def clone_mirror_cmd(self, remote_repo):
+        return "git clone --mirror %s\'%s\' \'%s\'" % (
+            "--filter=blob:none " if self.partial_clone else "",
+            remote_repo, self.mirror_dir(remote_repo))
+
+    def is_fresh(self, mirror_dir, queued_at):
+        """
+        Whether a fetch of mirror_dir started late enough to include all
+        changes pushed before queued_at. Counts the skipped fetch if so.
+        Must be called while holding the RepoLock of the mirror.
+        """
+        with self.lock:
+            if mirror_dir not in self.last_fetch or queued_at is None:
+                return False
+            if self.last_fetch[mirror_dir] < queued_at - self.freshness:
+                return False
+            self.coalesced_count[mirror_dir] = self.coalesced_count.get(mirror_dir, 0) + 1
+            return True
+
+    def fetched(self, mirror_dir, started_at):
+        """
+        Record a successful fetch of mirror_dir that started at started_at.
+        """
+        with self.lock:
+            self.last_fetch[mirror_dir] = max(started_at, self.last_fetch.get(mirror_dir, 0))
+            self.fetch_count[mirror_dir] = self.fetch_count.get(mirror_dir, 0) + 1
+
+    def dict(self):
+        """
+        Fetch statistics per mirror, usually returned on the REST API.
+        """
+        now = time.time()
+        retval = {}
+        with self.lock:
+            for mirror_dir in set(self.fetch_count) | set(self.coalesced_count):
+                retval[os.path.basename(mirror_dir)] = {
+                    'fetches': self.fetch_count.get(mirror_dir, 0),
+                    'coalesced': self.coalesced_count.get(mirror_dir, 0),
+                    'age': (now - self.last_fetch[mirror_dir]) if mirror_dir in self.last_fetch else None,
+                }
+        return retval
+
+    def prefetch(self, get_remotes):
+        """
+        Fetch all remotes returned by get_remotes() every prefetch_interval
+        seconds until stop() is called. Meant to run in its own thread.
+        """
+        if not self.prefetch_interval:
+            return True
+        while not self.stop_event.wait(self.prefetch_interval):
+            for remote_repo in sorted(get_remotes()):
+                if self.stop_event.is_set():
+                    break
+                self.update_mirror(remote_repo)
+        return True
+
+    def update_mirror(self, remote_repo):
+        """
+        Create or fetch the mirror of a remote in the background.
+        """
+        mirror_dir = self.mirror_dir(remote_repo)
+        git_lock = RepoLock(resource_to_filename(remote_repo), -1,
+                            self.gitLocks, self.gitLocksLock)
+        git_lock.acquire()
+        try:
+            if not os.path.isdir(mirror_dir):
+                cmd = self.clone_mirror_cmd(remote_repo)
+            else:
+                cmd = "git -C \'%s\' fetch --prune origin" % mirror_dir
+            logger.debug("Prefetching: %s", cmd)
+            started_at = time.time()
+            s = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            out, err = s.communicate()
+            if int(s.returncode) == 0:
+                self.fetched(mirror_dir, started_at)
+            else:
+                logger.warning("Prefetching %s failed: %s", remote_repo,
+                               err.decode('utf-8'))
+        finally:
+            git_lock.release()
+
+    def stop(self):
+        self.stop_event.set()
@@ -1,9 +1,12 @@
 import datetime
+import hashlib
 import json
 import logging
 import os
 import subprocess
 import tempfile
+import threading
+import time
 from email.mime.text import MIMEText
 
 my_env = os.environ
@@ -27,6 +30,63 @@ def resource_to_filename(url):
     return url
 
 
+def deliverable_id(target, docset, lang, product, dc_file, build_format):
+    """
+    Generate the ID (hash) of a deliverable from a unique tuple of
+    parameters.
+    """
+    return hashlib.md5((target + docset + lang + product + dc_file +
+                        build_format).encode('utf-8')).hexdigest()[:9]
+
+
+def normalize_remote(url):
+    """
+    Make different spellings of the same Git remote comparable: push
+    notifications of hosting services often differ from the configured
+    remote in a trailing slash or ".git" suffix or in the case of the
+    host name.
+    """
+    url = str(url).strip().rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-4]
+    if '://' in url:
+        scheme, rest = url.split('://', 1)
+        host, _, path = rest.partition('/')
+        url = '%s://%s/%s' % (scheme.lower(), host.lower(), path)
+    return url
+
+
+def run_command(cmd, env=None):
+    """
+    Run a command and collect its resource usage. Returns the return
+    code, stdout, stderr and a dict with the wall time and CPU time in
+    seconds and the peak RSS in KiB of the child process.
+    Only the command itself is accounted for, not processes that it
+    merely talks to, such as a Docker daemon.
+    cmd -- command as a list of arguments
+    """
+    started = time.monotonic()
+    s = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, env=env)
+    # Like Popen.communicate(), but the child must be reaped with wait4()
+    # to get its resource usage.
+    err = []
+    err_reader = threading.Thread(target=lambda: err.append(s.stderr.read()))
+    err_reader.start()
+    out = s.stdout.read()
+    err_reader.join()
+    s.stdout.close()
+    s.stderr.close()
+    _, status, rusage = os.wait4(s.pid, 0)
+    s.returncode = os.waitstatus_to_exitcode(status)
+    usage = {
+        'wall_time': round(time.monotonic() - started, 3),
+        'cpu_time': round(rusage.ru_utime + rusage.ru_stime, 3),
+        'max_rss': rusage.ru_maxrss,
+    }
+    return s.returncode, out, err[0], usage
+
+
 def feedback_message(text, subject, to, send_mail = False):
     """
     If mail is enabled, send mail via the local sendmail command.
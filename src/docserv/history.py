@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('docserv')
+
+
+class BuildHistory:
+    """
+    Remembers how long deliverables took to build, so the longest
+    deliverables can be started first. Durations are kept per deliverable
+    ID (see Deliverable.generate_id) as a moving average and are
+    persisted across restarts in a small JSON file. The file is written
+    at most once per save_interval and by flush().
+    """
+
+    def __init__(self, path, weight=0.5, save_interval=60):
+        """
+        path -- JSON file the history is stored in
+        weight -- weight of the newest duration in the moving average
+        save_interval -- minimum number of seconds between writes
+        """
+        self.path = path
+        self.weight = weight
+        self.save_interval = save_interval
+        # Map of deliverable IDs to dicts with the keys 'duration'
+        # (average in seconds), 'format' and 'builds'
+        self.deliverables = {}
+        # Sums and counts of the durations per format and of all
+        # deliverables, for estimates of deliverables without history
+        self.format_totals = {}
+        self.totals = [0, 0]
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "r") as f:
+            try:
+                self.deliverables = json.loads(f.read())
+            except json.decoder.JSONDecodeError:
+                logger.warning("Ignoring unreadable build history %s.", self.path)
+        for entry in self.deliverables.values():
+            self.add_to_totals(entry['format'], entry['duration'], 1)
+
+    def add_to_totals(self, build_format, duration, count):
+        for totals in [self.format_totals.setdefault(build_format, [0, 0]), self.totals]:
+            totals[0] += duration
+            totals[1] += count
+
+    def flush(self):
+        """
+        Write the history if it changed since it was last written.
+        """
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+    def save(self):
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps(self.deliverables))
+            os.replace(tmp_path, self.path)
+        except OSError as error:
+            logger.warning("Failed to write build history %s: %s", self.path, error)
+
+    def record(self, deliverable_id, build_format, duration):
+        """
+        Add the duration of a successful build.
+        """
+        with self.lock:
+            if deliverable_id in self.deliverables:
+                entry = self.deliverables[deliverable_id]
+                average = (self.weight * duration +
+                           (1 - self.weight) * entry['duration'])
+                self.add_to_totals(entry['format'], average - entry['duration'], 0)
+                entry['duration'] = average
+                entry['builds'] += 1
+            else:
+                self.deliverables[deliverable_id] = {
+                    'duration': duration,
+                    'format': build_format,
+                    'builds': 1,
+                }
+                self.add_to_totals(build_format, duration, 1)
+            self.dirty = True
+            if time.monotonic() - self.saved_at >= self.save_interval:
+                self.save()
+
+    def estimate(self, deliverable_id, build_format):
+        """
+        Expected build duration of a deliverable in seconds. Deliverables
+        that were never built are assumed to take as long as the average
+        deliverable of the same format. Returns 0 without any history.
+        """
+        with self.lock:
+            if deliverable_id in self.deliverables:
+                return self.deliverables[deliverable_id]['duration']
+            total, count = self.format_totals.get(build_format, self.totals)
+            if not count:
+                total, count = self.totals
+            if not count:
+                return 0
+            return total / count
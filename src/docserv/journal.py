@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger('docserv')
+
+
+class StateJournal:
+    """
+    Persist the state of all build instructions without rewriting
+    everything on every change. The state consists of a snapshot file
+    (a JSON list of build instruction dicts, the format that was
+    previously written on every save) and an append-only journal with
+    one JSON line per changed build instruction. When the journal grows
+    too large, it is compacted into a new snapshot.
+    Snapshots are written to a temporary file first and then renamed,
+    so a crash never leaves a half-written snapshot behind. A truncated
+    last line in the journal is ignored on load.
+    """
+
+    def __init__(self, snapshot_path, compaction_threshold=1000):
+        """
+        snapshot_path -- path to the JSON snapshot, the journal is stored
+                         next to it with the suffix .journal
+        compaction_threshold -- number of journal entries after which the
+                                journal is folded into the snapshot
+        """
+        self.snapshot_path = snapshot_path
+        self.journal_path = os.path.splitext(snapshot_path)[0] + '.journal'
+        self.compaction_threshold = compaction_threshold
+        self.journal_entries = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Read the snapshot and replay the journal on top of it. Returns
+        a list of build instruction dicts or None if there is no
+        readable state.
+        """
+        state = {}
+        found = False
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, "r") as f:
+                try:
+                    for build_instruction in json.loads(f.read()):
+                        state[build_instruction['id']] = build_instruction
+                    found = True
+                except (json.decoder.JSONDecodeError, KeyError, TypeError):
+                    logger.warning("Ignoring unreadable state file %s.",
+                                   self.snapshot_path)
+        if os.path.isfile(self.journal_path):
+            found = True
+            with open(self.journal_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        # most likely the last line of a journal that was
+                        # being written during a crash
+                        logger.warning("Ignoring damaged entry in %s.",
+                                       self.journal_path)
+                        continue
+                    if entry.get('build_instruction') is None:
+                        state.pop(entry['id'], None)
+                    else:
+                        state[entry['id']] = entry['build_instruction']
+                    self.journal_entries += 1
+        if not found:
+            return None
+        return list(state.values())
+
+    def append(self, changes):
+        """
+        Append changed build instructions to the journal.
+        changes -- dict mapping build instruction IDs to their dict or to
+                   None if the build instruction was removed
+        """
+        if not changes:
+            return
+        lines = []
+        for build_instruction_id, build_instruction in changes.items():
+            lines.append(json.dumps({'id': build_instruction_id,
+                                     'build_instruction': build_instruction}))
+        with self.lock:
+            with open(self.journal_path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_entries += len(lines)
+
+    def needs_compaction(self):
+        return self.journal_entries >= self.compaction_threshold
+
+    def compact(self, state):
+        """
+        Atomically write a new snapshot of the complete state and
+        truncate the journal.
+        state -- list of build instruction dicts
+        """
+        with self.lock:
+            tmp_path = self.snapshot_path + '.tmp'
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps(state))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            # Only after the snapshot is in place, the journal can go.
+            try:
+                os.remove(self.journal_path)
+            except FileNotFoundError:
+                pass
+            self.journal_entries = 0
+        logger.debug("Compacted state journal into %s.", self.snapshot_path)
@@ -0,0 +1,115 @@
+import bisect
+import os
+import threading
+
+# Upper bounds of the histogram buckets in seconds, from quick Git
+# commands to long PDF builds
+BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600]
+
+
+class Metrics:
+    """
+    Minimal thread-safe collection of counters and histograms that is
+    returned in the Prometheus text format on the REST API. A single
+    instance (metrics) is shared by all modules, like the logger.
+    Values are kept in memory only and start from zero after a restart.
+    """
+
+    def __init__(self):
+        # Map of metric names to (type, help text)
+        self.descriptions = {}
+        # Map of metric names to dicts mapping label tuples to values.
+        # Histogram values are [bucket counts..., count above the last
+        # bucket, sum, count].
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, metric_type, text):
+        self.descriptions[name] = (metric_type, text)
+
+    def inc(self, name, labels=None, value=1):
+        key = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            if key not in series:
+                series[key] = [0] * (len(BUCKETS) + 3)
+            histogram = series[key]
+            # the bucket after the last bound counts values above it
+            histogram[bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self, gauges=None):
+        """
+        Return all metrics in the Prometheus text format.
+        gauges -- list of (name, help text, {label tuple: value}) with
+                  values that are calculated when rendering
+        """
+        lines = []
+        for name, text, series in (gauges or []):
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s gauge' % name)
+            for key, value in sorted(series.items()):
+                lines.append('%s%s %s' % (name, self.format_labels(key), value))
+        with self.lock:
+            for name in sorted(self.values):
+                metric_type, text = self.descriptions.get(name, ('untyped', ''))
+                lines.append('# HELP %s %s' % (name, text))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                for key, value in sorted(self.values[name].items()):
+                    if metric_type != 'histogram':
+                        lines.append('%s%s %s' % (name, self.format_labels(key), value))
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, value):
+                        cumulative += count
+                        lines.append('%s_bucket%s %i' % (
+                            name, self.format_labels(key + (('le', str(bound)),)), cumulative))
+                    lines.append('%s_bucket%s %i' % (
+                        name, self.format_labels(key + (('le', '+Inf'),)), value[-1]))
+                    lines.append('%s_sum%s %s' % (name, self.format_labels(key), value[-2]))
+                    lines.append('%s_count%s %i' % (name, self.format_labels(key), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def format_labels(self, key):
+        if not key:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for label, value in key)
+
+
+def command_name(cmd):
+    """
+    Short name of a command for use as a label, e.g. 'git' or 'rsync'.
+    cmd -- command as a list of arguments
+    """
+    if not cmd:
+        return 'none'
+    if cmd[0] == 'echo' and len(cmd) > 1:
+        return os.path.basename(cmd[1])
+    return os.path.basename(cmd[0])
+
+
+metrics = Metrics()
+metrics.describe('docserv_command_duration_seconds', 'histogram',
+                 'Wall time of commands run by Docserv, by phase and command.')
+metrics.describe('docserv_command_failures_total', 'counter',
+                 'Commands that failed, by phase and command.')
+metrics.describe('docserv_repo_lock_wait_seconds', 'histogram',
+                 'Time spent waiting for the lock of a Git repository.')
+metrics.describe('docserv_repo_lock_hold_seconds', 'histogram',
+                 'Time the lock of a Git repository was held.')
+metrics.describe('docserv_stitch_duration_seconds', 'histogram',
+                 'Duration of stitching the product configuration, by target config directory.')
+metrics.describe('docserv_stitch_failures_total', 'counter',
+                 'Failed stitching runs, by target config directory.')
+metrics.describe('docserv_worker_busy_seconds_total', 'counter',
+                 'Time worker threads spent working, by pipeline stage.')
+metrics.describe('docserv_deliverables_total', 'counter',
+                 'Finished deliverables, by status.')
@@ -0,0 +1,108 @@
+import logging
+import os
+import threading
+from lxml import etree
+
+logger = logging.getLogger('docserv')
+
+
+class NavigationCache:
+    """
+    Keeps the stitched document cache of a target up to date for
+    docserv-build-navigation. The cache directory contains one small
+    XML file per deliverable and archive; instead of concatenating all
+    of them for every navigation build, only files that were added,
+    changed or removed since the last build are read again.
+    Also remembers for which templates and settings the section pages
+    of the target were last published, so they are only rendered again
+    when those changed.
+    """
+
+    def __init__(self, cache_dir, path):
+        """
+        cache_dir -- document metadata cache directory of the target
+        path -- file the stitched cache is written to, must not be
+                inside cache_dir
+        """
+        self.cache_dir = cache_dir
+        self.path = path
+        # Map of cache file paths to (mtime, serialized element)
+        self.entries = {}
+        self.section_pages_key = None
+        self.lock = threading.Lock()
+
+    def update(self):
+        """
+        Bring the stitched cache file up to date and return its path.
+        """
+        with self.lock:
+            seen = set()
+            changed = not os.path.isfile(self.path)
+            for root, dirs, files in os.walk(self.cache_dir):
+                for filename in files:
+                    if not filename.endswith('.xml'):
+                        continue
+                    path = os.path.join(root, filename)
+                    try:
+                        mtime = os.stat(path).st_mtime_ns
+                    except FileNotFoundError:
+                        continue
+                    seen.add(path)
+                    if path in self.entries and self.entries[path][0] == mtime:
+                        continue
+                    self.entries[path] = (mtime, self.read(path))
+                    changed = True
+            for path in set(self.entries) - seen:
+                del self.entries[path]
+                changed = True
+            if changed:
+                self.write()
+        return self.path
+
+    def read(self, path):
+        try:
+            root = etree.parse(path).getroot()
+        except etree.XMLSyntaxError:
+            logger.warning("Ignoring unreadable deliverable cache file %s.", path)
+            return b''
+        if root.tag not in ['document', 'archive']:
+            return b''
+        root.tail = None
+        return etree.tostring(root, encoding='UTF-8', xml_declaration=False)
+
+    def write(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<docservcache>\n')
+            for path in sorted(self.entries):
+                f.write(self.entries[path][1] + b'\n')
+            f.write(b'</docservcache>\n')
+        os.replace(tmp_path, self.path)
+        logger.debug("Updated stitched document cache %s with %i entries.",
+                     self.path, len(self.entries))
+
+    def section_pages_current(self, key):
+        """
+        Whether the section pages were published for key, a value that
+        changes when the templates or the settings of the target change.
+        """
+        with self.lock:
+            return self.section_pages_key == key
+
+    def section_pages_published(self, key):
+        with self.lock:
+            self.section_pages_key = key
+
+
+def template_key(template_dir, *settings):
+    """
+    Key for NavigationCache.section_pages_current: the modification
+    times of all templates and the given settings.
+    """
+    mtimes = []
+    for root, dirs, files in os.walk(template_dir):
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            mtimes.append((path, os.stat(path).st_mtime_ns))
+    return (tuple(sorted(mtimes)),) + settings
@@ -0,0 +1,130 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('docserv')
+
+
+class ObjectStore:
+    """
+    Content-addressed store of the files in a backup path. Every file
+    with the same content is a hard link to the same object, so images,
+    CSS and JavaScript that are identical across builds and languages
+    only take up disk space once. Objects are stored as
+    STORE/AB/CDEF... by their SHA-256 sum. The store must be on the same
+    file system as the backup path.
+    Files in the backup path are never modified in place, they are
+    replaced by rsync or removed, so sharing them is safe. Objects that
+    are not linked from anywhere else anymore are removed by
+    collect_garbage().
+    """
+
+    def __init__(self, path, min_size=1024, gc_interval=3600):
+        """
+        path -- directory of the object store
+        min_size -- smaller files are not deduplicated
+        gc_interval -- minimum number of seconds between garbage
+                       collections
+        """
+        self.path = path
+        self.min_size = min_size
+        self.gc_interval = gc_interval
+        self.last_gc = time.time()
+        # Map of (device, inode, size, mtime) to the SHA-256 sum, so
+        # files that are already linked are not read again
+        self.known = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def object_path(self, checksum):
+        return os.path.join(self.path, checksum[:2], checksum[2:])
+
+    def checksum(self, path, stat):
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if key in self.known:
+                return self.known[key]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        with self.lock:
+            self.known[key] = sha.hexdigest()
+        return self.known[key]
+
+    def add(self, path):
+        """
+        Replace the file at path with a hard link to the object with the
+        same content, or make it the object if there is none yet.
+        Returns the number of bytes saved.
+        """
+        stat = os.lstat(path)
+        checksum = self.checksum(path, stat)
+        object_path = self.object_path(checksum)
+        try:
+            object_stat = os.lstat(object_path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            try:
+                os.link(path, object_path)
+                return 0
+            except FileExistsError:
+                # another thread added the same content
+                object_stat = os.lstat(object_path)
+        if object_stat.st_ino == stat.st_ino and object_stat.st_dev == stat.st_dev:
+            return 0
+        tmp_path = path + '.dedup'
+        try:
+            os.link(object_path, tmp_path)
+        except FileNotFoundError:
+            # removed by a garbage collection in the meantime
+            return 0
+        os.replace(tmp_path, path)
+        return stat.st_size
+
+    def deduplicate(self, directory):
+        """
+        Deduplicate all files below directory. Returns a tuple like
+        run_command, so it can be used as a publishing command.
+        """
+        started_at = time.time()
+        saved = 0
+        files = 0
+        try:
+            for root, dirs, filenames in os.walk(directory):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    if os.path.islink(path) or os.path.getsize(path) < self.min_size:
+                        continue
+                    saved += self.add(path)
+                    files += 1
+        except OSError as error:
+            return 1, b'', str(error).encode('utf-8'), self.usage(started_at)
+        logger.debug("Deduplicated %i files in %s, saved %i bytes.", files, directory, saved)
+        if time.time() - self.last_gc > self.gc_interval:
+            self.collect_garbage()
+        return 0, b'', b'', self.usage(started_at)
+
+    def usage(self, started_at):
+        return {'wall_time': round(time.time() - started_at, 3), 'cpu_time': 0, 'max_rss': 0}
+
+    def collect_garbage(self):
+        """
+        Remove objects that are only linked from the store.
+        """
+        self.last_gc = time.time()
+        removed = 0
+        for root, dirs, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    if os.lstat(path).st_nlink == 1:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        with self.lock:
+            self.known = {}
+        logger.debug("Removed %i unused objects from %s.", removed, self.path)
@@ -0,0 +1,142 @@
+import logging
+
+from docserv.functions import normalize_remote
+
+logger = logging.getLogger('docserv')
+
+
+class ProductConfigIndex:
+    """
+    Read-only index of the information from the stitched product
+    configuration that build instructions need. It is built once per
+    stitched configuration and shared by all threads, so looking up
+    a product/docset/language is a dict access instead of parsing the
+    stitched configuration and running XPaths for every build
+    instruction. Never modify an index after it was built, create a
+    new one instead.
+
+    Structure of products:
+    {productid: {'maintainers': [...],
+                 'docsets': {setid: {'lifecycle': ...,
+                                     'navigation': ...,
+                                     'remote': ... or None,
+                                     'build_container': ... or False,
+                                     'languages': {lang: {'branch': ...,
+                                                          'subdir': ... or None,
+                                                          'deliverables': [...]}}}}}}
+
+    Structure of branches, the reverse index from Git branches to the
+    languages that are built from them:
+    {(normalized remote, branch): [(productid, setid, lang, subdir), ...]}
+    """
+
+    def __init__(self, tree):
+        """
+        tree -- the stitched and simplified product configuration
+                (lxml ElementTree)
+        """
+        self.products = {}
+        self.branches = {}
+        for product in tree.getroot().iterfind('product'):
+            productid = product.get('productid')
+            self.products[productid] = {
+                'maintainers': [contact.text for contact in
+                                product.iterfind('maintainers/contact')],
+                'docsets': {},
+            }
+            for docset in product.iterfind('docset'):
+                setid = docset.get('setid')
+                self.products[productid]['docsets'][setid] = \
+                    self.index_docset(docset)
+                self.index_branches(productid, setid)
+
+    def index_docset(self, docset):
+        value = {
+            'lifecycle': docset.get('lifecycle'),
+            'navigation': docset.get('navigation', 'linked'),
+            'remote': None,
+            'build_container': False,
+            'languages': {},
+        }
+        builddocs = docset.find('builddocs')
+        if builddocs is None:
+            return value
+        git = builddocs.find('git')
+        if git is not None:
+            value['remote'] = git.get('remote')
+        buildcontainer = builddocs.find('buildcontainer')
+        if buildcontainer is not None and buildcontainer.get('image') is not None:
+            value['build_container'] = buildcontainer.get('image')
+        for language in builddocs.iterfind('language'):
+            lang = language.get('lang')
+            # like an XPath lookup, the first language element wins
+            if lang in value['languages']:
+                continue
+            branch = language.find('branch')
+            subdir = language.find('subdir')
+            value['languages'][lang] = {
+                'branch': branch.text if branch is not None else None,
+                'subdir': subdir.text if subdir is not None else None,
+                'deliverables': [self.index_deliverable(deliverable) for
+                                 deliverable in language.iterfind('deliverable')],
+            }
+        return value
+
+    def index_branches(self, productid, setid):
+        docset = self.products[productid]['docsets'][setid]
+        if docset['remote'] is None:
+            return
+        for lang, language in docset['languages'].items():
+            key = (normalize_remote(docset['remote']), language['branch'])
+            self.branches.setdefault(key, []).append(
+                (productid, setid, lang, language['subdir']))
+
+    def index_deliverable(self, deliverable):
+        subdir = deliverable.find('.//subdir')
+        return {
+            'dc': deliverable.find('.//dc').text,
+            'formats': dict(deliverable.find('.//format').attrib),
+            'subdir': subdir.text if subdir is not None else None,
+            'subdeliverables': [subdeliverable.text for subdeliverable in
+                                deliverable.iterfind('subdeliverable')],
+            'params': [(param.get('name'), param.text) for param in
+                       deliverable.iterfind('param')],
+        }
+
+    def get_product(self, productid):
+        return self.products.get(productid)
+
+    def get_docset(self, productid, setid):
+        product = self.products.get(productid)
+        if product is None:
+            return None
+        return product['docsets'].get(setid)
+
+    def get_affected_languages(self, remote, branch, paths=None):
+        """
+        Return a list of (productid, setid, lang) tuples that are built
+        from a branch of a remote. If a list of changed paths is given,
+        only languages whose subdir contains one of the paths are
+        returned. Paths outside of all configured subdirs (for example
+        shared entities) affect all languages of the branch.
+        """
+        languages = self.branches.get((normalize_remote(remote), branch), [])
+        if paths is None:
+            return [(productid, setid, lang) for productid, setid, lang, subdir in languages]
+        subdirs = [subdir.strip('/') + '/' for _, _, _, subdir in languages
+                   if subdir is not None]
+        affected = []
+        for productid, setid, lang, subdir in languages:
+            for path in paths:
+                path = path.lstrip('/')
+                if (subdir is None or path.startswith(subdir.strip('/') + '/') or
+                        not any(path.startswith(other) for other in subdirs)):
+                    affected.append((productid, setid, lang))
+                    break
+        return affected
+
+    def get_language(self, productid, setid, lang):
+        docset = self.get_docset(productid, setid)
+        if docset is None:
+            return None
+        return docset['languages'].get(lang)
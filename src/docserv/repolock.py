@@ -1,8 +1,10 @@
 import logging
 import os
 import threading
+import time
 
 from docserv.functions import resource_to_filename
+from docserv.metrics import metrics
 
 my_env = os.environ
 
@@ -37,7 +39,11 @@ class RepoLock:
         self.thread_id = thread_id
 
     def acquire(self, blocking=True):
+        started = time.monotonic()
         if self.gitLocks[self.resource_name].acquire(blocking):
+            self.acquired_at = time.monotonic()
+            metrics.observe('docserv_repo_lock_wait_seconds',
+                            self.acquired_at - started)
             self.acquired = True
             logger.debug("Thread %i: Acquired lock %s.",
                          self.thread_id,
@@ -48,6 +54,8 @@ class RepoLock:
     def release(self):
         if self.acquired:
             self.gitLocks[self.resource_name].release()
+            metrics.observe('docserv_repo_lock_hold_seconds',
+                            time.monotonic() - self.acquired_at)
             self.acquired = False
             logger.debug("Thread %i: Released lock %s.",
                          self.thread_id,
@@ -1,38 +1,238 @@
+import hashlib
 import json
 import logging
+import queue
+import threading
+from urllib.parse import parse_qs, urlsplit
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 
 logger = logging.getLogger('docserv')
 
+# Maximum seconds a request for events waits
+MAX_EVENT_TIMEOUT = 30
+# Seconds an idle keep-alive connection is kept open
+KEEPALIVE_TIMEOUT = 5
+
 
 class RESTServer(BaseHTTPRequestHandler):
-    def _set_headers(self, code=200):
+    # Keep connections open between requests. This requires a
+    # Content-Length header on every response.
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = KEEPALIVE_TIMEOUT
+        BaseHTTPRequestHandler.setup(self)
+
+    def _set_headers(self, code=200, content_type='application/json', body=b'', headers=None):
+        """
+        Send a complete response.
+        """
         self.send_response(code)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
         self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data, headers=None):
+        self._set_headers(body=bytes(json.dumps(data), "utf-8"), headers=headers)
+
+    def _read_body(self):
+        """
+        Read the body of a POST request. Returns None and answers the
+        request if the body is missing or too large.
+        """
+        max_size = self.server.docserv.config['server']['rest_max_request_size']
+        try:
+            content_length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.close_connection = True
+            self._set_headers(411)
+            return None
+        if content_length > max_size:
+            # the body is not read, so the connection can not be reused
+            self.close_connection = True
+            self._set_headers(413)
+            return None
+        return self.rfile.read(content_length)
+
+    def _too_many_waiting(self):
+        """
+        Answer with 503 if too many clients are waiting for events.
+        """
+        if self.server.start_waiting():
+            return False
+        logger.info("Too many clients are waiting for events, rejecting request.")
+        self._set_headers(503, headers={'Retry-After': '1'})
+        return True
+
+    def _queue_full(self):
+        """
+        Answer with 429 if too many build instructions are waiting.
+        """
+        max_queued = self.server.docserv.config['server']['max_queued_build_instructions']
+        if max_queued and self.server.docserv.queued_build_instructions() >= max_queued:
+            logger.info("Build queue is full, rejecting request.")
+            self._set_headers(429, headers={'Retry-After': '60'})
+            return True
+        return False
 
     def do_GET(self):
-        if self.path == '/' or self.path == '/build_instructions/':
-            self._set_headers()
-            self.wfile.write(
-                bytes(json.dumps(self.server.docserv.dict()), "utf-8"))
-        elif self.path == '/deliverables/':
-            self._set_headers()
-            self.wfile.write(
-                bytes(json.dumps(self.server.docserv.deliverables), "utf-8"))
+        url = urlsplit(self.path)
+        if url.path == '/' or url.path == '/build_instructions/':
+            self.build_instructions(url.query)
+        elif url.path == '/archive/':
+            self.archive(url.query)
+        elif url.path == '/events/':
+            self.events(url.query)
+        elif url.path == '/events/stream':
+            self.event_stream(url.query)
+        elif url.path == '/fetches/':
+            self._send_json(self.server.docserv.repo_fetches.dict())
+        elif url.path == '/metrics':
+            self._set_headers(content_type='text/plain; version=0.0.4',
+                              body=bytes(self.server.docserv.get_metrics(), "utf-8"))
+        elif url.path == '/schedule/':
+            self._send_json(self.server.docserv.schedule())
+        elif url.path == '/deliverables/':
+            self.deliverables(url.query)
+        else:
+            self._set_headers(404)
+
+    def build_instructions(self, query):
+        """
+        Return build instructions, optionally filtered and paginated:
+        ?product=sles&status=fail&since=1700000000&offset=0&limit=50
+        Unchanged results are answered with 304 if the client sends the
+        ETag of the previous response.
+        """
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        filters = {key: params[key] for key in
+                   ['product', 'docset', 'lang', 'target', 'status'] if key in params}
+        try:
+            if 'since' in params:
+                filters['since'] = float(params['since'])
+            offset = int(params.get('offset', 0))
+            limit = int(params['limit']) if 'limit' in params else None
+            if offset < 0 or (limit is not None and limit < 0):
+                raise ValueError
+        except ValueError:
+            self._set_headers(400)
+            return
+        docserv = self.server.docserv
+        version, total, build_instructions = docserv.query_build_instructions(
+            filters, offset, limit)
+        etag = '"%s-%i-%s"' % (docserv.state_epoch, version,
+                               hashlib.md5(query.encode('utf-8')).hexdigest()[:8])
+        if self.headers.get('If-None-Match') == etag:
+            self._set_headers(304, headers={'ETag': etag})
+            return
+        self._send_json(build_instructions,
+                        headers={'ETag': etag, 'X-Total-Count': str(total)})
+
+    def deliverables(self, query):
+        """
+        Return the latest build of all deliverables that match the query:
+        ?product=sles&docset=15-SP6&lang=en-us&format=pdf&status=success
+        """
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        filters = {key: params[key] for key in
+                   ['target', 'product', 'docset', 'lang', 'format', 'status'] if key in params}
+        self._send_json(self.server.docserv.deliverable_index.query(filters))
+
+    def archive(self, query):
+        """
+        Return archived past builds, newest first: ?id=abcdef123&offset=0&limit=50
+        """
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        try:
+            offset = int(params.get('offset', 0))
+            limit = int(params.get('limit', 100))
+            if offset < 0 or limit < 0:
+                raise ValueError
+        except ValueError:
+            self._set_headers(400)
+            return
+        self._send_json(self.server.docserv.archive.query(params.get('id'), offset, limit))
+
+    def events(self, query):
+        """
+        Long-poll for events: ?cursor=12&timeout=30&id=abcdef123
+        Returns as soon as there are events after the cursor, or after
+        the timeout. Use the returned cursor for the next request.
+        Without a cursor, only events that happen from now on are returned.
+        """
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        try:
+            cursor = int(params.get('cursor', self.server.docserv.event_sequence))
+            timeout = min(float(params.get('timeout', 30)), MAX_EVENT_TIMEOUT)
+        except ValueError:
+            self._set_headers(400)
+            return
+        if self._too_many_waiting():
+            return
+        events, cursor, missed = self.server.docserv.get_events(
+            cursor, timeout, params.get('id'))
+        self._send_json({'events': events, 'cursor': cursor, 'missed': missed})
+
+    def event_stream(self, query):
+        """
+        Stream events as server-sent events until the client disconnects.
+        Reconnecting clients continue after the Last-Event-ID.
+        """
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        docserv = self.server.docserv
+        try:
+            cursor = int(self.headers.get('Last-Event-ID', params.get('cursor', docserv.event_sequence)))
+        except ValueError:
+            self._set_headers(400)
+            return
+        if self._too_many_waiting():
+            return
+        # the stream has no length, it ends when the connection is closed
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            while docserv.end_all.empty():
+                events, cursor, missed = docserv.get_events(
+                    cursor, MAX_EVENT_TIMEOUT, params.get('id'))
+                if missed:
+                    self.wfile.write(b"event: missed\ndata: {}\n\n")
+                for event in events:
+                    self.wfile.write(bytes("id: %i\nevent: %s\ndata: %s\n\n" % (
+                        event['seq'], event['event'], json.dumps(event)), "utf-8"))
+                if not events and not missed:
+                    # keep proxies from closing the idle connection
+                    self.wfile.write(b": keep-alive\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
 
     def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
+        post_data = self._read_body()
+        if post_data is None:
+            return
+        if self.path == '/rollback/':
+            return self.rollback(post_data)
+        if self._queue_full():
+            return
+        if self.path == '/push/':
+            return self.push(post_data)
+        if self.path == '/bulk/':
+            return self.bulk(post_data)
         # [{"docset": "15ga", "lang": "en-us", "product": "sles", "target": "external"}. ]
-        post_data = self.rfile.read(content_length)
         try:
             build_jobs = json.loads(post_data)
             for job in build_jobs:
                 if self.server.docserv.queue_build_instruction(job):
                     logger.info("Queueing %s", json.dumps(job))
                 else:
-                    logger.info("Not queueing %s", json.dumps(job))
+                    logger.info("Not queueing %s, it is already queued.", json.dumps(job))
             self._set_headers()
         except json.decoder.JSONDecodeError:
             # do not print the details of the request, when we add an
@@ -41,6 +241,61 @@ class RESTServer(BaseHTTPRequestHandler):
             logger.warning("Invalid JSON data submitted to REST API as build instruction. Ignoring.")
             self._set_headers(400)
 
+    def bulk(self, post_data):
+        """
+        Queue build instructions with wildcards:
+        [{"target": "external", "product": "sles", "docset": "15-SP6", "lang": "*"},
+         {"product": "sle-micro", "lifecycle": "supported"}]
+        """
+        try:
+            patterns = json.loads(post_data)
+            if not isinstance(patterns, list):
+                raise TypeError
+        except (json.decoder.JSONDecodeError, TypeError):
+            logger.warning("Invalid JSON data submitted to REST API as bulk build instruction. Ignoring.")
+            self._set_headers(400)
+            return
+        self._send_json(self.server.docserv.queue_bulk(patterns))
+
+    def push(self, post_data):
+        """
+        Queue all build instructions affected by a push to a Git branch.
+        {"remote": "https://github.com/SUSE/doc-sle", "branch": "main",
+         "paths": ["xml/book.xml"]}, "paths" is optional.
+        """
+        try:
+            push = json.loads(post_data)
+            remote = push['remote']
+            branch = push['branch']
+            paths = push.get('paths')
+            if not isinstance(remote, str) or not isinstance(branch, str) or \
+                    not (paths is None or isinstance(paths, list)):
+                raise TypeError
+        except (json.decoder.JSONDecodeError, KeyError, TypeError):
+            logger.warning("Invalid JSON data submitted to REST API as push notification. Ignoring.")
+            self._set_headers(400)
+            return
+        self._send_json(self.server.docserv.queue_push(remote, branch, paths))
+
+    def rollback(self, post_data):
+        """
+        Publish the previous version of a docset again:
+        {"target": "external", "product": "sles", "docset": "15-SP6", "lang": "en-us"}
+        """
+        try:
+            build_instruction = json.loads(post_data)
+            if not isinstance(build_instruction, dict):
+                raise TypeError
+        except (json.decoder.JSONDecodeError, TypeError):
+            logger.warning("Invalid JSON data submitted to REST API as rollback. Ignoring.")
+            self._set_headers(400)
+            return
+        version = self.server.docserv.rollback(build_instruction)
+        if version is None:
+            self._set_headers(404)
+            return
+        self._send_json({'version': version})
+
 
 class ThreadedRESTServer(ThreadingMixIn, HTTPServer):
     def __init__(self, server_address, RequestHandlerClass, docserv, bind_and_activate=True):
@@ -49,3 +304,106 @@ class ThreadedRESTServer(ThreadingMixIn, HTTPServer):
         logger.info("Starting HTTP server on %s:%i",
                     server_address[0], server_address[1])
         self.docserv = docserv
+
+    def start_waiting(self):
+        # every connection has its own thread
+        return True
+
+
+class BoundedRESTServer(HTTPServer):
+    """
+    HTTP server that handles connections in a fixed number of threads
+    instead of one new thread per connection. If more connections are
+    waiting than there are threads, new connections are answered with
+    503 right away, so bursts of requests can not take resources from
+    the builds.
+    Requests that wait for events leave the pool, another thread takes
+    their place until they are finished. At most max_waiting of them
+    are handled at a time, more are answered with 503.
+    """
+
+    def __init__(self, server_address, RequestHandlerClass, docserv, max_threads, max_waiting=100,
+                 bind_and_activate=True):
+        HTTPServer.__init__(self, server_address,
+                            RequestHandlerClass, bind_and_activate)
+        logger.info("Starting HTTP server on %s:%i with %i threads",
+                    server_address[0], server_address[1], max_threads)
+        self.docserv = docserv
+        self.requests = queue.Queue()
+        # connections that are being handled or waiting for a thread
+        self.slots = threading.BoundedSemaphore(max_threads * 2)
+        self.waiting_slots = threading.BoundedSemaphore(max_waiting)
+        # whether the request of the current thread waits for events
+        self.local = threading.local()
+        # threads to stop when they are done with their request, because
+        # a request that waited for events is finished
+        self.surplus_threads = 0
+        self.threads = 0
+        self.threads_lock = threading.Lock()
+        for i in range(max_threads):
+            self.start_thread()
+
+    def start_thread(self):
+        with self.threads_lock:
+            self.threads += 1
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    def worker(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            self.process_request_thread(*item)
+            with self.threads_lock:
+                if self.surplus_threads > 0:
+                    self.surplus_threads -= 1
+                    self.threads -= 1
+                    return
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            try:
+                request.sendall(b"HTTP/1.1 503 Service Unavailable\r\n"
+                                b"Content-Length: 0\r\nRetry-After: 1\r\n"
+                                b"Connection: close\r\n\r\n")
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self.requests.put((request, client_address))
+
+    def process_request_thread(self, request, client_address):
+        self.local.waiting = False
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            if self.local.waiting:
+                self.waiting_slots.release()
+                with self.threads_lock:
+                    self.surplus_threads += 1
+            else:
+                self.slots.release()
+
+    def start_waiting(self):
+        """
+        Called by request handlers before they wait for events. Returns
+        False if too many requests are waiting already.
+        """
+        if self.local.waiting:
+            return True
+        if not self.waiting_slots.acquire(blocking=False):
+            return False
+        self.local.waiting = True
+        self.slots.release()
+        self.start_thread()
+        return True
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        with self.threads_lock:
+            threads = self.threads
+        for i in range(threads):
+            self.requests.put(None)
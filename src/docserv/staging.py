@@ -0,0 +1,107 @@
+import datetime
+import glob
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger('docserv')
+
+# Versions of a docset directory are called DOCSET.publish-TIMESTAMP and
+# live next to DOCSET, which is a symlink to the current version.
+VERSION_INFIX = '.publish-'
+
+# Locks of docset directories, see docset_lock
+locks = {}
+locks_lock = threading.Lock()
+
+
+def docset_lock(docset_path):
+    """
+    Lock that serializes switching between the versions of the docset
+    directory docset_path, so publishing and rolling back the same
+    docset can not interleave.
+    """
+    with locks_lock:
+        return locks.setdefault(os.path.normpath(docset_path), threading.Lock())
+
+
+def staged_dir(docset_path):
+    """
+    Path of a new version of the docset directory docset_path.
+    """
+    return docset_path + VERSION_INFIX + datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+
+
+def versions(docset_path):
+    """
+    All versions of the docset directory docset_path, oldest first.
+    """
+    return sorted(path for path in glob.glob(glob.escape(docset_path) + VERSION_INFIX + '*')
+                  if os.path.isdir(path) and not os.path.islink(path))
+
+
+def current_version(docset_path):
+    if not os.path.islink(docset_path):
+        return None
+    return os.path.join(os.path.dirname(docset_path), os.readlink(docset_path))
+
+
+def switch(docset_path, version_path):
+    """
+    Atomically point the docset_path symlink to version_path. A docset
+    directory that was published without staging is moved aside and
+    becomes the first version.
+    """
+    if os.path.isdir(docset_path) and not os.path.islink(docset_path):
+        os.rename(docset_path, docset_path + VERSION_INFIX + '0')
+    tmp_link = docset_path + '.switching'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    # relative, so copies of the backup path stay intact
+    os.symlink(os.path.basename(version_path), tmp_link)
+    os.replace(tmp_link, docset_path)
+
+
+def collect_garbage(docset_path, keep):
+    """
+    Remove all but the keep newest versions besides the current one.
+    """
+    current = current_version(docset_path)
+    old = [path for path in versions(docset_path) if path != current]
+    for path in old[:max(len(old) - keep, 0)]:
+        logger.debug("Removing old published version %s", path)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def publish(docset_path, version_path, keep):
+    """
+    Switch to a staged version and remove old versions. Returns a tuple
+    like run_command, so it can be used as a publishing command.
+    """
+    started_at = time.time()
+    returncode, err = 0, b''
+    try:
+        with docset_lock(docset_path):
+            switch(docset_path, version_path)
+            collect_garbage(docset_path, keep)
+    except OSError as error:
+        returncode, err = 1, str(error).encode('utf-8')
+    usage = {'wall_time': round(time.time() - started_at, 3), 'cpu_time': 0, 'max_rss': 0}
+    return returncode, b'', err, usage
+
+
+def rollback(docset_path):
+    """
+    Point docset_path back to the version published before the current
+    one. Returns the path of that version or None if there is none.
+    """
+    with docset_lock(docset_path):
+        current = current_version(docset_path)
+        older = [path for path in versions(docset_path)
+                 if current is None or path < current]
+        if current is None or not older:
+            return None
+        switch(docset_path, older[-1])
+        return older[-1]
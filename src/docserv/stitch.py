@@ -0,0 +1,326 @@
+import copy
+import glob
+import hashlib
+import logging
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree
+
+from docserv.metrics import metrics
+from docserv.productconfig import ProductConfigIndex
+logger = logging.getLogger('docserv')
+
+BIN_DIR = os.getenv('DOCSERV_BIN_DIR', "/usr/bin/")
+CONF_DIR = os.getenv('DOCSERV_CONFIG_DIR', "/etc/docserv/")
+SHARE_DIR = os.getenv('DOCSERV_SHARE_DIR', "/usr/share/docserv/")
+CACHE_DIR = os.getenv('DOCSERV_CACHE_DIR', "/var/cache/docserv/")
+
+XINCLUDE_NS = 'http://www.w3.org/2001/XInclude'
+
+
+class ConfigStitcher:
+    """
+    In-process replacement for the 'docserv-stitch --simplify' command.
+    Validates the XML files of a product configuration directory one by
+    one and stitches them together into a single simplified file.
+    The stitcher remembers which files it has validated and checked
+    already. When stitching again, only files that changed since are
+    validated and checked, all other files are reused as they are.
+    Validation with Jing and the check-*.sh scripts still run as separate
+    processes, everything else is done with lxml.
+    One ConfigStitcher exists per target and is shared by all threads.
+    """
+
+    def __init__(self, config_dir, valid_languages, valid_site_sections, max_workers=8):
+        """
+        config_dir -- directory with the product configuration files
+        valid_languages -- space-separated list of valid language codes
+        valid_site_sections -- space-separated list of valid site sections
+        max_workers -- number of files/checks to process in parallel
+        """
+        self.config_dir = config_dir
+        self.valid_languages = valid_languages
+        self.valid_site_sections = valid_site_sections
+        self.max_workers = max_workers
+
+        self.schema_file = os.path.join(
+            SHARE_DIR, 'validate-product-config', 'product-config-schema.rnc')
+        self.checks_dir = os.path.join(
+            SHARE_DIR, 'validate-product-config', 'checks')
+        self.references_stylesheet = os.path.join(
+            SHARE_DIR, 'validate-product-config', 'global-check-ref-list.xsl')
+        self.simplify_stylesheet = os.path.join(
+            SHARE_DIR, 'simplify-product-config', 'simplify.xsl')
+
+        # Map of file names to dicts with the keys 'signature' (size and
+        # modification time), 'hash' (MD5 of the file and files it
+        # includes), 'raw_hash' (MD5 of the file alone), 'includes'
+        # (paths of included files) and 'element' (the validated root
+        # element)
+        self.fragments = {}
+        # Hashes of the files the last output file was created from
+        self.output_hashes = {}
+        # ProductConfigIndex of the last output file, replaced as a whole
+        # whenever the output changes
+        self.index = None
+        # Compiled stylesheets of each thread, see xslt()
+        self.xslt_cache = threading.local()
+        # Long-lived, so the threads keep their compiled stylesheets.
+        # Files and the checks of a file have separate executors, since
+        # files wait for their checks.
+        self.file_executor = ThreadPoolExecutor(max_workers=max_workers,
+                                                thread_name_prefix='stitch')
+        self.check_executor = ThreadPoolExecutor(max_workers=max_workers,
+                                                 thread_name_prefix='stitch-check')
+        self.work_dir = tempfile.mkdtemp(prefix='docserv_stitch_work_')
+        self.lock = threading.Lock()
+
+    def stitch(self, output_file):
+        """
+        Validate changed configuration files and write the stitched and
+        simplified configuration to output_file. Returns True on success.
+        """
+        with self.lock:
+            started = time.monotonic()
+            try:
+                result = self._stitch(output_file)
+            except (OSError, etree.Error) as error:
+                logger.warning("Stitching of %s failed: %s", self.config_dir, error)
+                result = False
+            labels = {'config_dir': self.config_dir}
+            metrics.observe('docserv_stitch_duration_seconds',
+                            time.monotonic() - started, labels)
+            if not result:
+                metrics.inc('docserv_stitch_failures_total', labels)
+            return result
+
+    def _stitch(self, output_file):
+        if not self.validate_parameters():
+            return False
+
+        files = sorted(glob.glob(os.path.join(self.config_dir, '[a-z]*.xml')))
+        if not files:
+            logger.warning("There are no product configuration files in %s.",
+                           self.config_dir)
+            return False
+
+        names = [os.path.basename(path) for path in files]
+        for name in list(self.fragments):
+            if name not in names:
+                self.fragments.pop(name)
+
+        hashes = {}
+        raw_hashes = {}
+        changed = []
+        for path in files:
+            name = os.path.basename(path)
+            signature, raw_hash, file_hash = self.file_hash(path)
+            hashes[name] = file_hash
+            raw_hashes[name] = raw_hash
+            if (name not in self.fragments or
+                    self.fragments[name]['hash'] != file_hash):
+                changed.append((path, signature, raw_hash, file_hash))
+            else:
+                self.fragments[name]['signature'] = signature
+
+        if not changed and hashes == self.output_hashes and os.path.isfile(output_file):
+            logger.debug("Configuration in %s is unchanged.", self.config_dir)
+            return True
+
+        logger.debug("Validating %i changed configuration file(s) in %s.",
+                     len(changed), self.config_dir)
+        results = list(self.file_executor.map(lambda args: self.validate_file(*args), changed))
+        if not all(results):
+            return False
+
+        tree = self.assemble(names, raw_hashes)
+        if not self.global_checks(tree):
+            return False
+
+        simplified = self.xslt(self.simplify_stylesheet)(tree)
+        tmp_output_file = output_file + '.tmp'
+        with open(tmp_output_file, 'wb') as f:
+            f.write(bytes(simplified))
+        os.replace(tmp_output_file, output_file)
+        self.index = ProductConfigIndex(simplified)
+        self.output_hashes = hashes
+        logger.debug("Stitched %s to %s.", self.config_dir, output_file)
+        return True
+
+    def validate_parameters(self):
+        # matches ds.type.lang in product-config-schema.rnc
+        if not re.match(r'^( +[a-z]{2}(-[a-z]{2,8})?)+$', ' ' + self.valid_languages):
+            logger.warning("Language codes parameter string does not conform to scheme (must be la-ng scheme, space-separated).")
+            return False
+        # matches ds.type.alphanumeric in product-config-schema.rnc
+        if not re.match(r'^( +[-_a-zA-Z0-9]+)+$', ' ' + self.valid_site_sections):
+            logger.warning("Site sections parameter string does not conform to scheme (must be alphanumeric-_, space-separated).")
+            return False
+        return True
+
+    def file_hash(self, path):
+        """
+        Return the signature (size and modification time), the MD5 hash of
+        a configuration file and the MD5 hash of the file together with
+        the files it includes via XInclude, so changing them invalidates
+        the including file. The hashes are only recalculated if the
+        signature changed.
+        """
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        name = os.path.basename(path)
+        if (name in self.fragments and
+                self.fragments[name]['signature'] == signature and
+                not self.fragments[name]['includes']):
+            return signature, self.fragments[name]['raw_hash'], self.fragments[name]['hash']
+        with open(path, 'rb') as f:
+            content = f.read()
+        raw_hash = hashlib.md5(content).hexdigest()
+        md5 = hashlib.md5(content)
+        for include in self.included_files(path, content):
+            try:
+                with open(include, 'rb') as f:
+                    md5.update(f.read())
+            except OSError:
+                pass
+        return signature, raw_hash, md5.hexdigest()
+
+    def included_files(self, path, content):
+        try:
+            root = etree.fromstring(content, base_url=path)
+        except etree.XMLSyntaxError:
+            return []
+        includes = []
+        for href in root.xpath('//xi:include/@href', namespaces={'xi': XINCLUDE_NS}):
+            includes.append(os.path.join(os.path.dirname(path), href))
+        return includes
+
+    def validate_file(self, path, signature, raw_hash, file_hash):
+        """
+        Resolve XIncludes, validate and check a single configuration file.
+        Only on success, the file is remembered as validated.
+        """
+        name = os.path.basename(path)
+        logger.debug("Validating configuration file %s", path)
+        try:
+            tree = etree.parse(path)
+            tree.xinclude()
+        except (etree.XMLSyntaxError, etree.XIncludeError) as error:
+            logger.warning("%s: Problems with resolving XInclude: %s", path, error)
+            return False
+        resolved_path = os.path.join(self.work_dir, name)
+        tree.write(resolved_path, xml_declaration=True, encoding='UTF-8')
+
+        out, err, rc = self.run(['jing', '-ci', self.schema_file, resolved_path])
+        if rc != 0:
+            logger.warning("%s: File is not valid:\n%s%s", path, out, err)
+            return False
+
+        checks = sorted(glob.glob(os.path.join(self.checks_dir, 'check-*.sh')) +
+                        glob.glob(os.path.join(self.checks_dir, 'check-*.xsl')))
+        results = list(self.check_executor.map(
+            lambda check: self.check_file(check, path, resolved_path, tree), checks))
+        if not all(results):
+            return False
+
+        with open(path, 'rb') as f:
+            includes = self.included_files(path, f.read())
+        self.fragments[name] = {
+            'signature': signature,
+            'hash': file_hash,
+            'raw_hash': raw_hash,
+            'includes': includes,
+            'element': tree.getroot(),
+        }
+        return True
+
+    def check_file(self, check_file, path, resolved_path, tree):
+        """
+        Run a single check on a configuration file. Like in
+        docserv-stitch, problems reported by a check are only logged,
+        while a failing check or output on stderr fails the validation.
+        """
+        if check_file.endswith('.xsl'):
+            transform = self.xslt(check_file)
+            try:
+                result = str(transform(tree)).strip()
+            except etree.XSLTApplyError as error:
+                logger.warning("Problem in %s: %s: %s", path,
+                               os.path.basename(check_file), error)
+                return False
+            if len(transform.error_log) > 0:
+                logger.warning("Problem in %s: %s: %s", path,
+                               os.path.basename(check_file), transform.error_log)
+                return False
+        else:
+            env = dict(os.environ,
+                       xmllint='xmllint', jing='jing', starlet='xmlstarlet',
+                       valid_languages=self.sorted_lines(self.valid_languages),
+                       valid_site_sections=self.sorted_lines(self.valid_site_sections))
+            result, err, rc = self.run(['bash', check_file, resolved_path], env)
+            result = result.strip()
+            if rc != 0 or err:
+                logger.warning("Problem in %s: %s: %s", path,
+                               os.path.basename(check_file), err)
+                return False
+        if result:
+            logger.warning("%s: %s: %s", path, os.path.basename(check_file), result)
+        return True
+
+    def assemble(self, names, hashes):
+        """
+        Stitch the validated root elements of all files together.
+        hashes -- map of file names to the MD5 hashes of the files alone
+        """
+        root = etree.Element('docservconfig')
+        # Same format as the md5sum output in docserv-stitch, so
+        # docserv-stitch --revalidate-only also accepts our output.
+        etree.SubElement(root, 'hashes').text = ''.join(
+            '%s!' % file_hash for file_hash in sorted(hashes.values()))
+        categories_file = os.path.join(self.config_dir, '_categories.xml')
+        if os.path.isfile(categories_file):
+            root.append(etree.parse(categories_file).getroot())
+        for name in names:
+            root.append(copy.deepcopy(self.fragments[name]['element']))
+        return etree.ElementTree(root)
+
+    def global_checks(self, tree):
+        """
+        Checks that can only run on the stitched configuration.
+        """
+        productids = tree.xpath('//@productid')
+        duplicates = sorted(set(str(productid) for productid in productids
+                                if productids.count(productid) > 1))
+        if duplicates:
+            logger.warning("(global check): Some productid values in %s are not unique. Check for the following productid values: %s.",
+                           self.config_dir, ' '.join(duplicates))
+            return False
+        referencecheck = str(self.xslt(self.references_stylesheet)(tree)).strip()
+        if referencecheck:
+            logger.warning("(global check): %s", referencecheck)
+        return True
+
+    def xslt(self, stylesheet):
+        # XSLT objects must not be used by several threads at once, so
+        # compile them once per thread.
+        if not hasattr(self.xslt_cache, 'stylesheets'):
+            self.xslt_cache.stylesheets = {}
+        if stylesheet not in self.xslt_cache.stylesheets:
+            self.xslt_cache.stylesheets[stylesheet] = etree.XSLT(etree.parse(stylesheet))
+        return self.xslt_cache.stylesheets[stylesheet]
+
+    def sorted_lines(self, value):
+        return '\n'.join(sorted(set(value.split())))
+
+    def run(self, cmd, env=None):
+        logger.debug("Stitching command: %s", ' '.join(shlex.quote(c) for c in cmd))
+        s = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, env=env)
+        out, err = s.communicate()
+        return out.decode('utf-8'), err.decode('utf-8'), int(s.returncode)
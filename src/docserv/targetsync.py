@@ -0,0 +1,140 @@
+import logging
+import os
+import shlex
+import tempfile
+import threading
+import time
+
+from docserv import staging
+from docserv.functions import run_command
+
+SHARE_DIR = os.getenv('DOCSERV_SHARE_DIR', "/usr/share/docserv/")
+
+logger = logging.getLogger('docserv')
+
+NO_USAGE = {'wall_time': 0, 'cpu_time': 0, 'max_rss': 0}
+
+
+class TargetSync:
+    """
+    Synchronizes the backup path of a target with its target path.
+    Instead of comparing the whole site after every build instruction,
+    only the paths that a build instruction changed are transferred
+    (scope 'docset'). With scope 'full', the whole backup path is
+    synchronized, like earlier versions did.
+    Build instructions that finish within the batching window of each
+    other are published with a single transfer: the first one waits for
+    the window to pass, then transfers the paths of all of them, and all
+    of them get the result of that transfer.
+    """
+
+    def __init__(self, backup_path, target_path, scope='docset', window=0, staged=False, hard_links=False):
+        """
+        backup_path -- local directory with all publication-ready content
+        target_path -- local or SSH path the content is published to
+        scope -- 'docset' to only transfer changed paths, 'full' to
+                 always transfer the whole backup path
+        window -- seconds to wait for other build instructions before
+                  starting a transfer, 0 disables batching
+        staged -- docsets are published as symlinks to versioned
+                  directories, see staging; only the content of the
+                  current versions is transferred
+        hard_links -- files in the backup path are deduplicated with hard
+                      links, see ObjectStore; files that are linked to
+                      each other are transferred once
+        """
+        self.backup_path = backup_path
+        self.target_path = target_path
+        self.scope = scope
+        self.window = window
+        self.staged = staged
+        self.hard_links = hard_links
+        self.excludes = os.path.join(SHARE_DIR, 'rsync', 'rsync_excludes.txt')
+        # The batch that is currently collecting paths, a dict with the
+        # keys 'paths' (set of paths relative to backup_path), 'full',
+        # 'done' (threading.Event) and 'result'
+        self.batch = None
+        self.lock = threading.Lock()
+        # Only one transfer to the target path at a time
+        self.transfer_lock = threading.Lock()
+
+    def sync(self, paths=None):
+        """
+        Publish paths relative to the backup path, or everything if paths
+        is None. Blocks until the transfer containing the paths is
+        finished and returns its (returncode, out, err, usage), see
+        run_command.
+        """
+        leader = False
+        with self.lock:
+            if self.batch is None:
+                self.batch = {'paths': set(), 'full': False,
+                              'done': threading.Event(), 'result': None}
+                leader = True
+            batch = self.batch
+            if paths is None or self.scope == 'full':
+                batch['full'] = True
+            else:
+                batch['paths'].update(paths)
+        if leader:
+            self.run_batch(batch)
+        else:
+            batch['done'].wait()
+        returncode, out, err, usage = batch['result']
+        # every build instruction records the usage of the transfer
+        return returncode, out, err, dict(usage)
+
+    def run_batch(self, batch):
+        try:
+            if self.window:
+                time.sleep(self.window)
+            with self.lock:
+                self.batch = None
+            with self.transfer_lock:
+                batch['result'] = self.transfer(batch['paths'], batch['full'])
+        finally:
+            if batch['result'] is None:
+                batch['result'] = (1, b'', b'Synchronizing the target failed.', NO_USAGE)
+            batch['done'].set()
+
+    def transfer(self, paths, full):
+        cmd = "rsync --exclude-from '%s' --delete-after -lr" % self.excludes
+        if self.hard_links:
+            cmd += " -H"
+        if self.staged:
+            cmd += " --copy-dirlinks --exclude '*%s*' --exclude '*.switching'" % staging.VERSION_INFIX
+        if full:
+            logger.debug("Synchronizing %s with %s", self.backup_path, self.target_path)
+            return run_command(shlex.split("%s %s/ %s" % (cmd, self.backup_path, self.target_path)))
+        # Paths that were removed from the backup path would make rsync
+        # fail and stay on the target. Their closest parent directory that
+        # still exists is transferred instead, which deletes them there.
+        existing = set()
+        for path in paths:
+            while path and not os.path.lexists(os.path.join(self.backup_path, path)):
+                path = os.path.dirname(path)
+            if not path:
+                return self.transfer(paths, True)
+            existing.add(path)
+        # paths below other paths are transferred anyway
+        paths = sorted(path for path in existing
+                       if not self.has_parent_in(path, existing))
+        if not paths:
+            return (0, b'', b'', NO_USAGE)
+        logger.debug("Synchronizing %i paths of %s with %s", len(paths),
+                     self.backup_path, self.target_path)
+        # With --files-from, rsync only deletes files inside the listed
+        # directories, not in the rest of the target path.
+        with tempfile.NamedTemporaryFile('w', prefix='docserv_sync_', suffix='.txt') as f:
+            f.write("\n".join(paths) + "\n")
+            f.flush()
+            return run_command(shlex.split("%s --files-from='%s' %s/ %s" % (
+                cmd, f.name, self.backup_path, self.target_path)))
+
+    def has_parent_in(self, path, paths):
+        parent = os.path.dirname(path)
+        while parent:
+            if parent in paths:
+                return True
+            parent = os.path.dirname(parent)
+        return False
@@ -0,0 +1,35 @@
+import pytest
+
+from docserv.archive import BuildArchive
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return BuildArchive(str(tmp_path / 'archive.jsonl'), max_per_build_instruction=2,
+                        compaction_threshold=5)
+
+
+def test_query(archive):
+    assert archive.query() == []
+    archive.append([{'id': 'a', 'n': 1}, {'id': 'b', 'n': 2}])
+    archive.append([])
+    archive.append([{'id': 'a', 'n': 3}])
+    assert [record['n'] for record in archive.query()] == [3, 2, 1]
+    assert [record['n'] for record in archive.query('a')] == [3, 1]
+    assert [record['n'] for record in archive.query(offset=1, limit=1)] == [2]
+
+
+def test_compaction(archive):
+    archive.append([{'id': 'a', 'n': n} for n in range(4)])
+    assert len(archive.query()) == 4
+    # the threshold is reached, only the newest records of each ID stay
+    archive.append([{'id': 'b', 'n': 4}])
+    assert [record['n'] for record in archive.query()] == [4, 3, 2]
+    assert archive.appended == 0
+
+
+def test_damaged_entry(archive, tmp_path):
+    archive.append([{'id': 'a', 'n': 1}])
+    with open(str(tmp_path / 'archive.jsonl'), 'a') as f:
+        f.write('{"id": "a", "n"')
+    assert [record['n'] for record in archive.query()] == [1]
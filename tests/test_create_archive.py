@@ -0,0 +1,85 @@
+import importlib.machinery
+import importlib.util
+import os
+import zipfile
+
+import pytest
+
+path = os.path.join(os.path.dirname(__file__), '..', 'bin', 'docserv-create-archive')
+loader = importlib.machinery.SourceFileLoader('docserv_create_archive', path)
+spec = importlib.util.spec_from_loader(loader.name, loader)
+create_archive = importlib.util.module_from_spec(spec)
+loader.exec_module(create_archive)
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+@pytest.fixture
+def input_path(tmp_path):
+    write(str(tmp_path / 'input' / 'html' / 'book' / 'index.html'), b'<html/>' * 100)
+    write(str(tmp_path / 'input' / 'pdf' / 'book.pdf'), b'%PDF' * 100)
+    write(str(tmp_path / 'input' / 'pdf' / 'images' / 'logo.png'), b'PNG' * 100)
+    write(str(tmp_path / 'input' / 'epub' / 'book.epub'), b'EPUB')
+    write(str(tmp_path / 'input' / 'index.html'), b'navigation')
+    return str(tmp_path / 'input')
+
+
+def test_file_paths(input_path):
+    paths = [os.path.relpath(path, input_path)
+             for path in create_archive.file_paths(input_path, ['pdf', 'html'])]
+    # only the directories of the formats, not other formats or files
+    # at the top level
+    assert paths == ['html/book/index.html', 'pdf/book.pdf', 'pdf/images/logo.png']
+
+
+def test_compress_type(input_path, tmp_path):
+    output_path = str(tmp_path / 'docset.zip')
+    create_archive.create_zip_archive(input_path, output_path, 'html,pdf', jobs=2)
+    with zipfile.ZipFile(output_path) as archive:
+        assert archive.testzip() is None
+        compress_types = {zinfo.filename: zinfo.compress_type for zinfo in archive.infolist()}
+        assert archive.read('pdf/book.pdf') == b'%PDF' * 100
+    # already compressed formats are stored
+    assert compress_types == {'html/book/index.html': zipfile.ZIP_DEFLATED,
+                              'pdf/book.pdf': zipfile.ZIP_STORED,
+                              'pdf/images/logo.png': zipfile.ZIP_STORED}
+
+
+def test_reuse_previous_archive(input_path, tmp_path, monkeypatch):
+    previous_path = str(tmp_path / 'previous.zip')
+    create_archive.create_zip_archive(input_path, previous_path, 'html,pdf')
+    with zipfile.ZipFile(previous_path) as previous:
+        digests = [create_archive.member_hash(zinfo) for zinfo in previous.infolist()]
+    assert all(len(digest) == 32 for digest in digests)
+
+    write(os.path.join(input_path, 'pdf', 'book.pdf'), b'%PDF changed')
+    opened = []
+    real_open = open
+
+    def tracking_open(file, *args, **kwargs):
+        opened.append(os.path.relpath(file, input_path))
+        return real_open(file, *args, **kwargs)
+    monkeypatch.setattr(create_archive, 'open', tracking_open, raising=False)
+    output_path = str(tmp_path / 'docset.zip')
+    create_archive.create_zip_archive(input_path, output_path, 'html,pdf', previous_path)
+    # unchanged members are copied from the previous archive, only the
+    # changed file is read again after hashing
+    assert sorted(opened) == ['html/book/index.html', 'pdf/book.pdf',
+                              'pdf/book.pdf', 'pdf/images/logo.png']
+    with zipfile.ZipFile(output_path) as archive:
+        assert archive.testzip() is None
+        assert archive.read('pdf/book.pdf') == b'%PDF changed'
+        assert archive.read('html/book/index.html') == b'<html/>' * 100
+
+
+def test_damaged_previous_archive(input_path, tmp_path):
+    previous_path = str(tmp_path / 'previous.zip')
+    write(previous_path, b'not a zip archive')
+    output_path = str(tmp_path / 'docset.zip')
+    create_archive.create_zip_archive(input_path, output_path, 'epub', previous_path)
+    with zipfile.ZipFile(output_path) as archive:
+        assert archive.namelist() == ['epub/book.epub']
@@ -0,0 +1,107 @@
+import json
+import os
+import subprocess
+
+import pytest
+
+from docserv.deliverable import Deliverable
+
+
+class FakeBIH:
+    def __init__(self, repo_dir):
+        self.local_repo_build_dir = repo_dir
+
+
+def git(repo, *args):
+    subprocess.run(['git', '-C', repo, '-c', 'user.name=test', '-c', 'user.email=test@example.com'] +
+                   list(args), check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def deliverable(repo, source_subdir):
+    deliverable = Deliverable.__new__(Deliverable)
+    deliverable.parent = FakeBIH(repo)
+    deliverable.source_dir = os.path.join(repo, source_subdir)
+    deliverable.id = 'test'
+    return deliverable
+
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = str(tmp_path / 'repo')
+    os.makedirs(os.path.join(repo, 'doc', 'xml'))
+    os.makedirs(os.path.join(repo, 'common', 'images'))
+    with open(os.path.join(repo, 'common', 'entities.ent'), 'w') as f:
+        f.write('<!ENTITY product "SLES">\n')
+    with open(os.path.join(repo, 'common', 'images', 'logo.svg'), 'w') as f:
+        f.write('<svg/>\n')
+    os.symlink('../../common/entities.ent', os.path.join(repo, 'doc', 'xml', 'entities.ent'))
+    os.symlink('../common/images', os.path.join(repo, 'doc', 'images'))
+    git(repo, 'init', '-q')
+    git(repo, 'add', '.')
+    git(repo, 'commit', '-q', '-m', 'first')
+    return repo
+
+
+def test_symlink_target_hashes(repo):
+    hashes = deliverable(repo, 'doc').symlink_target_hashes()
+    assert [target for target, target_hash in hashes] == ['common/entities.ent', 'common/images']
+    with open(os.path.join(repo, 'common', 'images', 'logo.svg'), 'w') as f:
+        f.write('<svg></svg>\n')
+    git(repo, 'commit', '-q', '-a', '-m', 'second')
+    assert deliverable(repo, 'doc').symlink_target_hashes() != hashes
+
+
+def test_symlink_target_hashes_outside_repository(repo, tmp_path):
+    os.symlink(str(tmp_path), os.path.join(repo, 'doc', 'outside'))
+    assert deliverable(repo, 'doc').symlink_target_hashes() is None
+
+
+def test_symlink_target_hashes_inside_source_dir(repo):
+    assert deliverable(repo, 'common').symlink_target_hashes() == []
+
+
+def fake_rsync(tmp_path, monkeypatch, script):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    rsync = bin_dir / 'rsync'
+    rsync.write_text('#!/bin/sh\n' + script)
+    rsync.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (bin_dir, os.environ['PATH']))
+
+
+def cached_deliverable(tmp_path):
+    deliverable = Deliverable.__new__(Deliverable)
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    (out_dir / 'book.pdf').write_text('pdf')
+    deliverable.d2d_out_dir = str(out_dir / 'book.pdf')
+    deliverable.title = 'Book'
+    deliverable.subtitle = None
+    deliverable.product_from_document = None
+    deliverable.root_id = 'book'
+    deliverable.dc_hash = 'abc'
+    deliverable.path = 'sles/15/pdf/book.pdf'
+    deliverable.subdeliverable_info = {}
+    cache_dir = tmp_path / 'cache' / 'deliverable'
+    cache_dir.mkdir(parents=True)
+    (cache_dir / 'oldkey').mkdir()
+    return deliverable, {'build_cache_entry': str(cache_dir / 'newkey')}
+
+
+def test_write_build_cache(tmp_path, monkeypatch):
+    fake_rsync(tmp_path, monkeypatch, 'cp -r "$2" "$3"\n')
+    deliverable, command = cached_deliverable(tmp_path)
+    assert deliverable.write_build_cache(command, 0)
+    entry = command['build_cache_entry']
+    assert os.listdir(os.path.dirname(entry)) == ['newkey']
+    assert os.path.isfile(os.path.join(entry, 'output', 'book.pdf'))
+    with open(os.path.join(entry, 'deliverable.json')) as f:
+        assert json.loads(f.read())['title'] == 'Book'
+
+
+def test_write_build_cache_failure(tmp_path, monkeypatch):
+    fake_rsync(tmp_path, monkeypatch, 'exit 23\n')
+    deliverable, command = cached_deliverable(tmp_path)
+    # the build does not fail and no temporary entry is left behind
+    assert deliverable.write_build_cache(command, 0)
+    assert os.listdir(os.path.dirname(command['build_cache_entry'])) == ['oldkey']
@@ -0,0 +1,63 @@
+import pytest
+
+from docserv.deliverableindex import DeliverableIndex
+from docserv.functions import deliverable_id
+
+
+def build_instruction(status, path=None, title=None, commit=None):
+    deliverable = {
+        'build_format': 'pdf',
+        'dc': 'DC-SLES-admin',
+        'status': status,
+        'path': path,
+        'title': title,
+        'successful_build_commit': commit,
+        'last_build': 1700000000,
+    }
+    return {'target': 'external', 'product': 'sles', 'docset': '15', 'lang': 'en-us',
+            'deliverables': {'d1': deliverable,
+                             'd2': dict(deliverable, build_format='html', status='building')}}
+
+
+@pytest.fixture
+def index():
+    return DeliverableIndex()
+
+
+def test_update_from_build_instruction(index):
+    index.update_from_build_instruction(build_instruction(
+        'success', 'en-us/sles/15/pdf/admin.pdf', 'Administration Guide', 'abc'))
+    # deliverables that are still building are not indexed
+    assert [record['id'] for record in index.query({})] == ['d1']
+    [record] = index.query({'product': 'sles', 'format': 'pdf'})
+    assert record['path'] == 'en-us/sles/15/pdf/admin.pdf'
+    assert record['title'] == 'Administration Guide'
+    assert index.query({'product': 'sles', 'format': 'html'}) == []
+    assert index.query({'lang': 'de-de'}) == []
+
+
+def test_failed_build_keeps_last_success(index):
+    index.update_from_build_instruction(build_instruction(
+        'success', 'en-us/sles/15/pdf/admin.pdf', 'Administration Guide', 'abc'))
+    index.update_from_build_instruction(build_instruction('fail'))
+    [record] = index.query({'status': 'fail'})
+    assert record['path'] == 'en-us/sles/15/pdf/admin.pdf'
+    assert record['commit'] == 'abc'
+    # the record moved from one status to the other
+    assert index.query({'status': 'success'}) == []
+
+
+def test_load_deliverable_cache(index, tmp_path):
+    cache_dir = tmp_path / 'external' / 'en-us' / 'sles' / '15' / 'pdf'
+    cache_dir.mkdir(parents=True)
+    (cache_dir / 'DC-SLES-admin.xml').write_text(
+        '<document lang="en-us" productid="sles" setid="15" dc="DC-SLES-admin" cachedate="1700000000">'
+        '<commit>abc</commit><path format="pdf">en-us/sles/15/pdf/admin.pdf</path>'
+        '<title hash="x">Administration Guide</title></document>')
+    (cache_dir / 'DC-broken.xml').write_text('<document')
+    index.load_deliverable_cache(str(tmp_path))
+    [record] = index.query({'target': 'external'})
+    assert record['id'] == deliverable_id('external', '15', 'en-us', 'sles', 'DC-SLES-admin', 'pdf')
+    assert record['title'] == 'Administration Guide'
+    assert record['commit'] == 'abc'
+    assert record['last_build'] == 1700000000
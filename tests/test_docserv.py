@@ -0,0 +1,436 @@
+import collections
+import os
+import queue
+import subprocess
+import threading
+import time
+
+import pytest
+from lxml import etree
+
+from docserv.bih import BuildInstructionHandler
+from docserv.docserv import Docserv, DocservState
+from docserv.productconfig import ProductConfigIndex
+
+
+class FakeArchive:
+    def __init__(self):
+        self.records = []
+
+    def append(self, build_instructions):
+        self.records.extend(build_instructions)
+
+
+@pytest.fixture
+def state():
+    # DocservState keeps its state in class attributes, shadow them so
+    # tests do not share state.
+    state = DocservState()
+    state.scheduled_build_instruction = {}
+    state.updating_build_instruction = []
+    state.bih_dict = {}
+    state.past_builds = {}
+    state.pending_rebuilds = {}
+    state.supersede_checks = {}
+    state.supersede_rechecks = set()
+    state.retired_build_instructions = set()
+    state.dirty_build_instructions = set()
+    state.events = collections.deque(maxlen=100)
+    state.event_sequence = 0
+    state.archive = FakeArchive()
+    state.state_version = 0
+    state.status_cache = None
+    state.config = {'server': {'past_builds_max_age': 0, 'past_builds_max_count': 0}}
+    return state
+
+
+class FakeBIH:
+    def __init__(self, build_instruction_id, newer_commit):
+        self.build_instruction = {'id': build_instruction_id}
+        self.newer_commit = newer_commit
+        self.superseded = False
+
+    def newer_commit_available(self):
+        return self.newer_commit
+
+    def supersede(self):
+        self.superseded = True
+
+
+class PreparedBIH(FakeBIH):
+    def __init__(self, state, build_instruction, newer_commit):
+        FakeBIH.__init__(self, build_instruction['id'], newer_commit)
+        self.initialized = True
+        self.build_docs = False
+        # triggered again while the repository is prepared
+        [(_, result)] = state.queue_build_instructions([dict(build_instruction)])
+        assert result == 'rebuild'
+
+    def update_priority(self):
+        pass
+
+
+def wait_for_checks(state):
+    for thread in list(state.supersede_checks.values()):
+        thread.join(10)
+
+
+def build_instruction():
+    return {'target': 'external', 'product': 'sles', 'docset': '15', 'lang': 'en-us'}
+
+
+def test_queue_new(state):
+    [(build_instruction_id, result)] = state.queue_build_instructions([build_instruction()])
+    assert result == 'queued'
+    assert build_instruction_id in state.scheduled_build_instruction
+    assert build_instruction_id in state.dirty_build_instructions
+    assert [event['event'] for event in state.events] == ['queued']
+
+
+def test_queue_coalesced_refreshes_queued_at(state):
+    [(build_instruction_id, _)] = state.queue_build_instructions([build_instruction()])
+    state.scheduled_build_instruction[build_instruction_id]['queued_at'] = 0
+    [(_, result)] = state.queue_build_instructions([build_instruction()])
+    assert result == 'coalesced'
+    assert len(state.scheduled_build_instruction) == 1
+    assert state.scheduled_build_instruction[build_instruction_id]['queued_at'] > 0
+
+
+def test_queue_while_updating(state):
+    [(build_instruction_id, _)] = state.queue_build_instructions([build_instruction()])
+    state.updating_build_instruction.append(build_instruction_id)
+    [(_, result)] = state.queue_build_instructions([build_instruction()])
+    assert result == 'rebuild'
+    assert build_instruction_id in state.pending_rebuilds
+
+
+def test_queue_reuses_past_build(state):
+    [(build_instruction_id, _)] = state.queue_build_instructions([build_instruction()])
+    past = state.scheduled_build_instruction.pop(build_instruction_id)
+    past['status'] = 'finished'
+    state.past_builds[build_instruction_id] = past
+    [(_, result)] = state.queue_build_instructions([build_instruction()])
+    assert result == 'queued'
+    assert build_instruction_id not in state.past_builds
+    assert state.archive.records[0]['status'] == 'finished'
+
+
+@pytest.mark.parametrize('newer_commit', [False, True])
+def test_queue_while_building(state, newer_commit):
+    [(build_instruction_id, _)] = state.queue_build_instructions([build_instruction()])
+    del state.scheduled_build_instruction[build_instruction_id]
+    bih = FakeBIH(build_instruction_id, newer_commit)
+    state.bih_dict[build_instruction_id] = bih
+    for i in range(2):
+        [(_, result)] = state.queue_build_instructions([build_instruction()])
+        assert result == 'rebuild'
+        wait_for_checks(state)
+    # the running build is only cancelled for a newer commit
+    assert bih.superseded == newer_commit
+    assert list(state.pending_rebuilds) == [build_instruction_id]
+    assert state.supersede_checks == {}
+
+
+def test_coalesced_changes_state_version(state):
+    state.queue_build_instructions([build_instruction()])
+    version, snapshot = state.status_snapshot()
+    state.queue_build_instructions([build_instruction()])
+    new_version, new_snapshot = state.status_snapshot()
+    assert new_version != version
+    assert new_snapshot[0]['queued_at'] >= snapshot[0]['queued_at']
+
+
+def test_status_of_aborted_build_instruction(state):
+    state.queue_build_instructions([build_instruction()])
+    build_instruction_id = state.get_scheduled_build_instruction()['id']
+    state.abort_build_instruction(build_instruction_id)
+    version, [past] = state.status_snapshot()
+    assert past['status'] == 'fail'
+
+
+class FinishedBIH:
+    def __init__(self, build_instruction, overall_status):
+        self.build_instruction = build_instruction
+        self.overall_status = overall_status
+
+    def cleanup(self):
+        pass
+
+    def dict(self):
+        # deliverables of superseded builds did not fail
+        return dict(self.build_instruction, deliverables={'a': {'status': 'superseded'}})
+
+
+@pytest.mark.parametrize('overall_status', ['success', 'fail', 'superseded'])
+def test_status_of_finished_build_instruction(state, overall_status):
+    [(build_instruction_id, _)] = state.queue_build_instructions([build_instruction()])
+    bih = FinishedBIH(state.scheduled_build_instruction.pop(build_instruction_id), overall_status)
+    state.bih_dict[build_instruction_id] = bih
+    state.finish_build_instruction(build_instruction_id)
+    version, [past] = state.status_snapshot()
+    assert past['status'] == overall_status
+
+
+@pytest.mark.parametrize('newer_commit', [False, True])
+def test_queue_while_preparing(state, monkeypatch, newer_commit):
+    monkeypatch.setattr(
+        'docserv.docserv.BuildInstructionHandler',
+        lambda build_instruction, *args: PreparedBIH(state, build_instruction, newer_commit))
+    for attribute in ['stitch_tmp_dir', 'config_stitchers', 'gitLocks', 'gitLocksLock',
+                      'repo_fetches', 'build_history', 'target_syncs', 'object_stores',
+                      'navigation_caches']:
+        setattr(state, attribute, None)
+    state.bih_queue = queue.Queue()
+    [(build_instruction_id, _)] = state.queue_build_instructions([build_instruction()])
+    state.parse_build_instruction(0)
+    wait_for_checks(state)
+    assert state.bih_dict[build_instruction_id].superseded == newer_commit
+    assert list(state.pending_rebuilds) == [build_instruction_id]
+
+
+def test_publish_worker_survives_failure(state, monkeypatch):
+    docserv = Docserv.__new__(Docserv)
+    docserv.__dict__.update(state.__dict__)
+    docserv.publish_queue = queue.Queue()
+    [(build_instruction_id, _)] = docserv.queue_build_instructions([build_instruction()])
+    bih = FinishedBIH(docserv.scheduled_build_instruction.pop(build_instruction_id), 'success')
+    docserv.bih_dict[build_instruction_id] = bih
+
+    def cleanup():
+        raise OSError("No space left on device")
+    bih.cleanup = cleanup
+    docserv.publish_queue.put(build_instruction_id)
+    docserv.publish_queue.put(None)
+    assert docserv.publish_worker(0)
+    version, [past] = docserv.status_snapshot()
+    assert past['status'] == 'fail'
+    assert build_instruction_id not in docserv.bih_dict
+
+
+def parse_config(tmp_path, monkeypatch, extra):
+    with open(os.path.join(os.path.dirname(__file__), '..', 'config', 'my-site.ini')) as f:
+        ini = f.read()
+    (tmp_path / 'test-site.ini').write_text(ini.replace('[server]\n', '[server]\n' + extra, 1))
+    monkeypatch.setattr('docserv.docserv.CONF_DIR', str(tmp_path))
+    docserv = Docserv.__new__(Docserv)
+    docserv.parse_config(['docserv', 'test-site'])
+    return docserv.config
+
+
+@pytest.mark.parametrize('option', ['prepare_threads', 'publish_threads'])
+def test_stage_threads(tmp_path, monkeypatch, option):
+    config = parse_config(tmp_path, monkeypatch, '%s = 2\n' % option)
+    assert config['server'][option] == 2
+    with pytest.raises(SystemExit):
+        parse_config(tmp_path, monkeypatch, '%s = 0\n' % option)
+
+
+@pytest.fixture
+def docserv(state):
+    docserv = Docserv.__new__(Docserv)
+    docserv.__dict__.update(state.__dict__)
+    docserv.end_all = queue.Queue()
+    docserv.work_condition = threading.Condition()
+    docserv.work_generation = 0
+    return docserv
+
+
+def start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_wait_for_work(docserv):
+    waiter = start_thread(docserv.wait_for_work, docserv.work_generation)
+    waiter.join(0.1)
+    assert waiter.is_alive()
+    docserv.notify_workers()
+    waiter.join(10)
+    assert not waiter.is_alive()
+
+
+def test_wait_for_work_after_notification(docserv):
+    generation = docserv.work_generation
+    # work that arrived after the snapshot is not missed
+    docserv.notify_workers()
+    waiter = start_thread(docserv.wait_for_work, generation)
+    waiter.join(10)
+    assert not waiter.is_alive()
+
+
+def test_workers_end(docserv):
+    class FakeFetches:
+        def stop(self):
+            pass
+    docserv.config['server'].update(publish_threads=2)
+    docserv.publish_queue = queue.Queue()
+    docserv.bih_queue = queue.Queue()
+    docserv.state_dirty = threading.Event()
+    docserv.repo_fetches = FakeFetches()
+    docserv.parse_build_instruction = lambda thread_id: None
+    threads = [start_thread(docserv.prepare_worker, 0), start_thread(docserv.build_worker, 1),
+               start_thread(docserv.publish_worker, 2), start_thread(docserv.publish_worker, 3)]
+    for thread in threads:
+        thread.join(0.1)
+        assert thread.is_alive()
+    docserv.exit()
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
+
+
+PRODUCT_CONFIG = """<docservconfig>
+  <product productid="sles">
+    <docset setid="15" lifecycle="supported">
+      <builddocs>
+        <git remote="https://github.com/SUSE/doc-sle.git"/>
+        <language lang="en-us" default="true"><branch>main</branch><subdir>en</subdir></language>
+        <language lang="de-de"><branch>main</branch><subdir>de</subdir></language>
+      </builddocs>
+    </docset>
+  </product>
+</docservconfig>
+"""
+
+
+class FakeStitcher:
+    def __init__(self, config):
+        self.index = config and ProductConfigIndex(etree.ElementTree(etree.fromstring(config)))
+
+
+@pytest.mark.parametrize('paths,languages', [
+    (None, ['de-de', 'en-us']),
+    (['de/xml/book.xml'], ['de-de']),
+    (['entities/product.ent'], ['de-de', 'en-us']),
+    ([], []),
+])
+def test_queue_push(docserv, paths, languages):
+    docserv.config['targets'] = {'external': {'active': 'yes'}, 'internal': {'active': 'no'},
+                               'new': {'active': 'yes'}}
+    docserv.config_stitchers = {'external': FakeStitcher(PRODUCT_CONFIG),
+                              'internal': FakeStitcher(PRODUCT_CONFIG),
+                              # not stitched yet
+                              'new': FakeStitcher(None)}
+    build_instructions = docserv.queue_push('https://github.com/SUSE/doc-sle', 'main', paths)
+    # only active targets
+    assert {build_instruction['target'] for build_instruction in build_instructions} <= {'external'}
+    assert sorted(build_instruction['lang'] for build_instruction in build_instructions) == languages
+    assert sorted(build_instruction['lang'] for build_instruction in
+                  docserv.scheduled_build_instruction.values()) == languages
+
+
+def git(*args):
+    return subprocess.run(['git'] + list(args), check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE).stdout.decode('utf-8').strip()
+
+
+def test_newer_commit_available(tmp_path):
+    repo = str(tmp_path)
+    git('init', '-q', '-b', 'main', repo)
+    git('-C', repo, '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+        'commit', '-q', '--allow-empty', '-m', 'first')
+    bih = BuildInstructionHandler.__new__(BuildInstructionHandler)
+    bih.cleanup_done = True
+    bih.remote_repo = repo
+    bih.branch = 'main'
+    # the commit is not resolved while the repository is prepared
+    assert not bih.newer_commit_available()
+    bih.resolved_commit = git('-C', repo, 'rev-parse', 'HEAD')
+    assert not bih.newer_commit_available()
+    git('-C', repo, '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+        'commit', '-q', '--allow-empty', '-m', 'second')
+    assert bih.newer_commit_available()
+
+
+def test_queue_build_instruction_result(state):
+    assert state.queue_build_instruction(build_instruction())
+    assert not state.queue_build_instruction(build_instruction())
+
+
+class FailingJournal:
+    def __init__(self, failures):
+        self.failures = failures
+        self.changes = []
+
+    def append(self, changes):
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("No space left on device")
+        self.changes.append(changes)
+
+    def needs_compaction(self):
+        return False
+
+
+def test_save_state_failure_keeps_changes(state):
+    [(build_instruction_id, _)] = state.queue_build_instructions([build_instruction()])
+    state.journal = FailingJournal(1)
+    with pytest.raises(OSError):
+        state.save_state()
+    assert build_instruction_id in state.dirty_build_instructions
+    state.save_state()
+    assert list(state.journal.changes[0]) == [build_instruction_id]
+    assert state.dirty_build_instructions == set()
+
+
+class CompactingJournal(FailingJournal):
+    def __init__(self):
+        FailingJournal.__init__(self, 0)
+        self.snapshots = []
+
+    def needs_compaction(self):
+        return True
+
+    def compact(self, state):
+        self.snapshots.append(state)
+
+
+def test_save_state_copies(state):
+    [(build_instruction_id, _)] = state.queue_build_instructions([build_instruction()])
+    state.journal = CompactingJournal()
+    state.save_state()
+    # workers keep changing the build instructions after they were
+    # handed to the journal
+    state.scheduled_build_instruction[build_instruction_id]['lang'] = 'de-de'
+    assert state.journal.changes[0][build_instruction_id]['lang'] == 'en-us'
+    assert state.journal.snapshots[0][0]['lang'] == 'en-us'
+
+
+def test_state_saver_retries(state):
+    docserv = Docserv.__new__(Docserv)
+    docserv.__dict__.update(state.__dict__)
+    docserv.end_all = queue.Queue()
+    docserv.state_dirty = threading.Event()
+    docserv.save_state_delay = 0.01
+    docserv.journal = FailingJournal(2)
+    docserv.queue_build_instructions([build_instruction()])
+    saver = threading.Thread(target=docserv.state_saver, daemon=True)
+    saver.start()
+    for i in range(500):
+        if docserv.journal.changes:
+            break
+        time.sleep(0.01)
+    docserv.end_all.put("now")
+    docserv.state_dirty.set()
+    saver.join(10)
+    assert not saver.is_alive()
+    assert len(docserv.journal.changes) == 1
+
+
+def test_publish_commands(tmp_path):
+    bih = BuildInstructionHandler.__new__(BuildInstructionHandler)
+    bih.cleanup_done = False
+    bih.cleanup_lock = threading.Lock()
+    bih.initialized = False
+    bih.superseded = False
+    bih.build_instruction = {'id': 'a'}
+    bih.tmp_dir_bi = str(tmp_path)
+    bih.tmp_bi_path = str(tmp_path / 'en-us' / 'sles' / '15')
+    bih.cleanup()
+    assert bih.overall_status == 'fail'
+    [usage] = bih.build_instruction['publish_commands']
+    assert usage['cmd'] == 'echo rm -rf %s' % tmp_path
+    assert usage['return_value'] == 0
+    assert usage['wall_time'] >= 0
+    assert usage['max_rss'] > 0
@@ -0,0 +1,125 @@
+import os
+import subprocess
+import threading
+
+import pytest
+
+from docserv.bih import BuildInstructionHandler
+from docserv.fetch import FetchScheduler
+from docserv.repolock import RepoLock
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    return FetchScheduler(str(tmp_path / 'repos'), {}, threading.Lock(), freshness=10)
+
+
+def test_is_fresh(scheduler):
+    mirror_dir = scheduler.mirror_dir('https://github.com/SUSE/doc-sle.git')
+    assert not scheduler.is_fresh(mirror_dir, 1000)
+    scheduler.fetched(mirror_dir, 1000)
+    assert scheduler.is_fresh(mirror_dir, 1000)
+    # within the freshness window
+    assert scheduler.is_fresh(mirror_dir, 1010)
+    assert not scheduler.is_fresh(mirror_dir, 1011)
+    assert not scheduler.is_fresh(mirror_dir, None)
+    # an older fetch that finished later does not count
+    scheduler.fetched(mirror_dir, 900)
+    assert scheduler.is_fresh(mirror_dir, 1010)
+    stats = scheduler.dict()[os.path.basename(mirror_dir)]
+    assert stats['fetches'] == 2
+    assert stats['coalesced'] == 3
+
+
+def test_update_mirror(scheduler, tmp_path):
+    remote = str(tmp_path / 'remote')
+    subprocess.run(['git', 'init', '-q', remote], check=True)
+    subprocess.run(['git', '-C', remote, '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                    'commit', '-q', '--allow-empty', '-m', 'first'], check=True)
+    os.makedirs(scheduler.repo_dir)
+    mirror_dir = scheduler.mirror_dir(remote)
+    scheduler.update_mirror(remote)
+    assert os.path.isfile(os.path.join(mirror_dir, 'HEAD'))
+    scheduler.update_mirror(remote)
+    assert scheduler.dict()[os.path.basename(mirror_dir)]['fetches'] == 2
+
+
+def git(*args):
+    return subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] +
+                          list(args), check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE).stdout.decode('utf-8').strip()
+
+
+@pytest.fixture
+def remote(tmp_path):
+    remote = str(tmp_path / 'remote')
+    git('init', '-q', '-b', 'main', remote)
+    for path in ['en/xml/book.xml', 'de/xml/book.xml', 'common/entities.ent']:
+        os.makedirs(os.path.join(remote, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(remote, path), 'w') as f:
+            f.write(path)
+    os.symlink('../../common/entities.ent', os.path.join(remote, 'en', 'xml', 'entities.ent'))
+    git('-C', remote, 'add', '.')
+    git('-C', remote, 'commit', '-q', '-m', 'first')
+    # allow partial clones from this repository
+    git('-C', remote, 'config', 'uploadpack.allowFilter', 'true')
+    return remote
+
+
+def prepared_bih(tmp_path, remote, sparse_checkout='no', partial_clone=False):
+    os.makedirs(str(tmp_path / 'repos'), exist_ok=True)
+    locks = {}
+    locks_lock = threading.Lock()
+    bih = BuildInstructionHandler.__new__(BuildInstructionHandler)
+    bih.cleanup_done = True
+    bih.build_instruction = {'id': 'a', 'queued_at': None}
+    bih.config = {'server': {'sparse_checkout': sparse_checkout}}
+    bih.language_config = {'subdir': 'en'}
+    bih.remote_repo = 'file://' + remote
+    bih.branch = 'main'
+    bih.local_repo_build_dir = str(tmp_path / 'build')
+    bih.repo_fetches = FetchScheduler(str(tmp_path / 'repos'), locks, locks_lock,
+                                      partial_clone=partial_clone)
+    bih.git_lock = RepoLock(bih.remote_repo, 0, locks, locks_lock)
+    bih.mail = lambda command, out, err: None
+    return bih
+
+
+def test_prepare_repo_lock_scope(tmp_path, remote, monkeypatch):
+    bih = prepared_bih(tmp_path, remote)
+    locked = []
+    real_popen = subprocess.Popen
+
+    def popen(cmd, *args, **kwargs):
+        locked.append((cmd[1] if cmd[1] != '-C' else cmd[3], bih.git_lock.acquired))
+        return real_popen(cmd, *args, **kwargs)
+    monkeypatch.setattr('docserv.bih.subprocess.Popen', popen)
+    assert bih.prepare_repo(0)
+    # only the mirror is updated while holding the lock
+    assert locked == [('clone', True), ('fetch', True), ('rev-parse', True),
+                      ('clone', False), ('checkout', False)]
+    assert not bih.git_lock.acquired
+    # the build directory borrows the objects of the mirror
+    alternates = os.path.join(bih.local_repo_build_dir, '.git', 'objects', 'info', 'alternates')
+    assert os.path.isfile(alternates)
+    assert git('-C', bih.local_repo_build_dir, 'rev-parse', 'HEAD') == bih.resolved_commit
+    assert os.path.isfile(os.path.join(bih.local_repo_build_dir, 'de', 'xml', 'book.xml'))
+
+
+def test_prepare_repo_failure_releases_lock(tmp_path, remote):
+    bih = prepared_bih(tmp_path, remote)
+    bih.branch = 'missing'
+    assert not bih.prepare_repo(0)
+    assert not bih.initialized
+    assert not bih.git_lock.acquired
+
+
+def test_prepare_repo_sparse_checkout(tmp_path, remote):
+    bih = prepared_bih(tmp_path, remote, sparse_checkout='yes', partial_clone=True)
+    assert bih.prepare_repo(0)
+    assert bih.mirror_is_partial(bih.repo_fetches.mirror_dir(bih.remote_repo))
+    build_dir = bih.local_repo_build_dir
+    # only the subdir of the language and the targets of its symlinks
+    assert os.path.isfile(os.path.join(build_dir, 'en', 'xml', 'book.xml'))
+    assert os.path.isfile(os.path.join(build_dir, 'en', 'xml', 'entities.ent'))
+    assert not os.path.exists(os.path.join(build_dir, 'de'))
@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from docserv.history import BuildHistory
+
+
+@pytest.fixture
+def history(tmp_path):
+    return BuildHistory(str(tmp_path / 'history.json'))
+
+
+def test_estimate_without_history(history):
+    assert history.estimate('a', 'pdf') == 0
+
+
+def test_estimate_moving_average(history):
+    history.record('a', 'pdf', 10)
+    history.record('a', 'pdf', 20)
+    assert history.estimate('a', 'pdf') == 15
+
+
+def test_estimate_unknown_deliverable(history):
+    history.record('a', 'pdf', 10)
+    history.record('b', 'pdf', 20)
+    history.record('c', 'html', 60)
+    # average of the same format
+    assert history.estimate('d', 'pdf') == 15
+    history.record('a', 'pdf', 30)
+    assert history.estimate('d', 'pdf') == 20
+    # average of all deliverables for formats without history
+    assert history.estimate('d', 'epub') == pytest.approx(100 / 3)
+
+
+def test_save_interval(tmp_path):
+    path = tmp_path / 'history.json'
+    history = BuildHistory(str(path), save_interval=3600)
+    history.record('a', 'pdf', 10)
+    assert not path.exists()
+    history.flush()
+    assert json.loads(path.read_text())['a']['duration'] == 10
+    history.record('b', 'html', 20)
+    # estimates of reloaded histories use the same averages
+    history.flush()
+    reloaded = BuildHistory(str(path))
+    assert reloaded.estimate('c', 'pdf') == 10
+    assert reloaded.estimate('c', 'epub') == 15
+
+
+def test_save_without_interval(tmp_path):
+    path = tmp_path / 'history.json'
+    history = BuildHistory(str(path), save_interval=0)
+    history.record('a', 'pdf', 10)
+    assert json.loads(path.read_text())['a']['builds'] == 1
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from docserv.journal import StateJournal
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return StateJournal(str(tmp_path / 'server.json'), compaction_threshold=3)
+
+
+def test_load_without_state(journal):
+    assert journal.load() is None
+
+
+def test_replay(journal, tmp_path):
+    journal.append({'a': {'id': 'a', 'status': 'building'}})
+    journal.append({'a': {'id': 'a', 'status': 'finished'},
+                    'b': {'id': 'b', 'status': 'building'}})
+    journal.append({'b': None})
+    loaded = StateJournal(str(tmp_path / 'server.json'))
+    assert loaded.load() == [{'id': 'a', 'status': 'finished'}]
+    assert loaded.journal_entries == 4
+
+
+def test_replay_on_top_of_snapshot(journal, tmp_path):
+    journal.compact([{'id': 'a', 'status': 'building'}, {'id': 'b', 'status': 'building'}])
+    journal.append({'b': {'id': 'b', 'status': 'finished'}})
+    state = StateJournal(str(tmp_path / 'server.json')).load()
+    assert sorted(state, key=lambda build_instruction: build_instruction['id']) == [
+        {'id': 'a', 'status': 'building'}, {'id': 'b', 'status': 'finished'}]
+
+
+def test_compaction(journal, tmp_path):
+    journal.append({'a': {'id': 'a'}, 'b': {'id': 'b'}})
+    assert not journal.needs_compaction()
+    journal.append({'c': {'id': 'c'}})
+    assert journal.needs_compaction()
+    journal.compact([{'id': 'a'}, {'id': 'c'}])
+    assert not journal.needs_compaction()
+    assert not (tmp_path / 'server.journal').exists()
+    assert json.loads((tmp_path / 'server.json').read_text()) == [{'id': 'a'}, {'id': 'c'}]
+    assert StateJournal(str(tmp_path / 'server.json')).load() == [{'id': 'a'}, {'id': 'c'}]
+
+
+def test_truncated_last_line(journal, tmp_path):
+    journal.append({'a': {'id': 'a', 'status': 'building'}})
+    journal.append({'a': {'id': 'a', 'status': 'finished'}})
+    path = tmp_path / 'server.journal'
+    # a crash while the last entry was written
+    path.write_text(path.read_text()[:-10])
+    assert StateJournal(str(tmp_path / 'server.json')).load() == [
+        {'id': 'a', 'status': 'building'}]
+
+
+def test_unreadable_snapshot(journal, tmp_path):
+    (tmp_path / 'server.json').write_text('[{"id": ')
+    journal.append({'a': {'id': 'a'}})
+    assert StateJournal(str(tmp_path / 'server.json')).load() == [{'id': 'a'}]
@@ -0,0 +1,100 @@
+import sys
+
+import pytest
+
+from docserv.functions import run_command
+from docserv.metrics import Metrics, command_name
+
+
+@pytest.fixture
+def metrics():
+    metrics = Metrics()
+    metrics.describe('docserv_test_total', 'counter', 'Test counter.')
+    metrics.describe('docserv_test_seconds', 'histogram', 'Test histogram.')
+    return metrics
+
+
+def test_counter(metrics):
+    metrics.inc('docserv_test_total', {'status': 'fail'})
+    metrics.inc('docserv_test_total', {'status': 'fail'}, 2)
+    metrics.inc('docserv_test_total', {'status': 'success'})
+    assert metrics.render().splitlines() == [
+        '# HELP docserv_test_total Test counter.',
+        '# TYPE docserv_test_total counter',
+        'docserv_test_total{status="fail"} 3',
+        'docserv_test_total{status="success"} 1',
+    ]
+
+
+def test_histogram(metrics):
+    metrics.observe('docserv_test_seconds', 0.2)
+    metrics.observe('docserv_test_seconds', 7)
+    metrics.observe('docserv_test_seconds', 5000)
+    lines = metrics.render().splitlines()
+    assert '# TYPE docserv_test_seconds histogram' in lines
+    assert 'docserv_test_seconds_bucket{le="0.1"} 0' in lines
+    assert 'docserv_test_seconds_bucket{le="0.5"} 1' in lines
+    assert 'docserv_test_seconds_bucket{le="10"} 2' in lines
+    assert 'docserv_test_seconds_bucket{le="3600"} 2' in lines
+    assert 'docserv_test_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'docserv_test_seconds_sum 5007.2' in lines
+    assert 'docserv_test_seconds_count 3' in lines
+
+
+def test_gauges_and_escaping(metrics):
+    lines = metrics.render([('docserv_test_queue', 'Test gauge.',
+                             {(('path', 'a"b\\c'),): 4})]).splitlines()
+    assert lines == [
+        '# HELP docserv_test_queue Test gauge.',
+        '# TYPE docserv_test_queue gauge',
+        'docserv_test_queue{path="a\\"b\\\\c"} 4',
+    ]
+
+
+def test_undescribed_metric(metrics):
+    metrics.inc('docserv_other')
+    assert metrics.render().splitlines() == [
+        '# HELP docserv_other ',
+        '# TYPE docserv_other untyped',
+        'docserv_other 1',
+    ]
+
+
+@pytest.mark.parametrize('cmd,name', [
+    (['/usr/bin/git', 'fetch'], 'git'),
+    (['echo', 'rm', '-rf', '/tmp/x'], 'rm'),
+    (['echo'], 'echo'),
+    ([], 'none'),
+])
+def test_command_name(cmd, name):
+    assert command_name(cmd) == name
+
+
+def test_run_command_output():
+    # more output than fits into the pipes on both streams
+    returncode, out, err, usage = run_command([
+        sys.executable, '-c',
+        'import sys; sys.stdout.write("o" * 1000000); sys.stderr.write("e" * 1000000); sys.exit(3)'])
+    assert returncode == 3
+    assert out == b'o' * 1000000
+    assert err == b'e' * 1000000
+    assert set(usage) == {'wall_time', 'cpu_time', 'max_rss'}
+
+
+def test_run_command_usage():
+    returncode, out, err, usage = run_command([
+        sys.executable, '-c',
+        'import time\n'
+        'data = bytearray(64 * 1024 * 1024)\n'
+        'started = time.process_time()\n'
+        'while time.process_time() - started < 0.2: pass'])
+    assert returncode == 0
+    assert usage['cpu_time'] >= 0.2
+    assert usage['wall_time'] >= usage['cpu_time'] - 0.05
+    # in KiB
+    assert usage['max_rss'] >= 64 * 1024
+
+
+def test_run_command_signal():
+    returncode, out, err, usage = run_command(['sh', '-c', 'kill -TERM $$'])
+    assert returncode == -15
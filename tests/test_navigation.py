@@ -0,0 +1,68 @@
+import os
+
+import pytest
+from lxml import etree
+
+from docserv.navigation import NavigationCache, template_key
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return NavigationCache(str(tmp_path / 'cache'), str(tmp_path / 'navigation-cache.xml'))
+
+
+def write(cache, relative_path, content):
+    path = os.path.join(cache.cache_dir, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+def documents(cache):
+    root = etree.parse(cache.update()).getroot()
+    assert root.tag == 'docservcache'
+    return [element.get('dc') for element in root]
+
+
+def test_update(cache):
+    assert documents(cache) == []
+    write(cache, 'en-us/sles/15/pdf/DC-a.xml', '<?xml version="1.0"?>\n<document dc="DC-a"/>')
+    write(cache, 'en-us/sles/15/pdf/DC-b.xml', '<document dc="DC-b"/>')
+    write(cache, 'en-us/sles/15/pdf/notes.txt', 'not a cache file')
+    assert documents(cache) == ['DC-a', 'DC-b']
+    os.remove(os.path.join(cache.cache_dir, 'en-us/sles/15/pdf/DC-a.xml'))
+    assert documents(cache) == ['DC-b']
+
+
+def test_update_only_rereads_changed_files(cache):
+    path = write(cache, 'en-us/sles/15/pdf/DC-a.xml', '<document dc="DC-a"/>')
+    cache.update()
+    mtime = os.stat(cache.path).st_mtime_ns
+    os.utime(cache.path, ns=(mtime - 10 ** 9, mtime - 10 ** 9))
+    # unchanged, the stitched file is not written again
+    cache.update()
+    assert os.stat(cache.path).st_mtime_ns == mtime - 10 ** 9
+    write(cache, 'en-us/sles/15/pdf/DC-a.xml', '<document dc="DC-changed"/>')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert documents(cache) == ['DC-changed']
+
+
+def test_unreadable_file(cache):
+    write(cache, 'en-us/sles/15/pdf/DC-a.xml', '<document dc="DC-a"')
+    write(cache, 'en-us/sles/15/pdf/DC-b.xml', '<other dc="DC-b"/>')
+    assert documents(cache) == []
+
+
+def test_section_pages(cache, tmp_path):
+    templates = tmp_path / 'templates'
+    templates.mkdir()
+    (templates / 'index.html').write_text('template')
+    key = template_key(str(templates), 'en-us', 'yes')
+    assert not cache.section_pages_current(key)
+    cache.section_pages_published(key)
+    assert cache.section_pages_current(template_key(str(templates), 'en-us', 'yes'))
+    assert not cache.section_pages_current(template_key(str(templates), 'de-de', 'yes'))
+    os.utime(str(templates / 'index.html'), ns=(0, 0))
+    assert not cache.section_pages_current(template_key(str(templates), 'en-us', 'yes'))
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from docserv.objectstore import ObjectStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ObjectStore(str(tmp_path / 'store'), min_size=4)
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+def test_deduplicate(store, tmp_path):
+    backup = str(tmp_path / 'backup')
+    first = write(os.path.join(backup, 'en-us', 'logo.svg'), '<svg/>')
+    second = write(os.path.join(backup, 'de-de', 'logo.svg'), '<svg/>')
+    other = write(os.path.join(backup, 'de-de', 'other.svg'), '<svg></svg>')
+    small = write(os.path.join(backup, 'de-de', 'a.txt'), 'a')
+    os.symlink('logo.svg', os.path.join(backup, 'de-de', 'link.svg'))
+    returncode, out, err, usage = store.deduplicate(backup)
+    assert returncode == 0
+    assert os.stat(first).st_ino == os.stat(second).st_ino
+    # both copies and the object
+    assert os.stat(first).st_nlink == 3
+    assert os.stat(other).st_nlink == 2
+    assert os.stat(small).st_nlink == 1
+    with open(second) as f:
+        assert f.read() == '<svg/>'
+
+
+def test_add_again(store, tmp_path):
+    path = write(str(tmp_path / 'backup' / 'logo.svg'), '<svg/>')
+    assert store.add(path) == 0
+    assert store.add(path) == 0
+    copy = write(str(tmp_path / 'backup' / 'copy.svg'), '<svg/>')
+    assert store.add(copy) == len('<svg/>')
+
+
+def test_collect_garbage(store, tmp_path):
+    backup = str(tmp_path / 'backup')
+    kept = write(os.path.join(backup, 'kept.svg'), '<svg/>')
+    removed = write(os.path.join(backup, 'removed.svg'), '<svg></svg>')
+    store.deduplicate(backup)
+    os.remove(removed)
+    store.collect_garbage()
+    objects = [os.path.join(root, filename) for root, dirs, filenames in os.walk(store.path)
+               for filename in filenames]
+    assert len(objects) == 1
+    assert os.stat(objects[0]).st_ino == os.stat(kept).st_ino
+
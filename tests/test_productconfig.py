@@ -0,0 +1,106 @@
+import pytest
+from lxml import etree
+
+from docserv.productconfig import ProductConfigIndex
+
+CONFIG = """<docservconfig>
+  <product productid="sles">
+    <maintainers><contact>doc-team@example.com</contact></maintainers>
+    <docset setid="15" lifecycle="supported">
+      <builddocs>
+        <git remote="https://github.com/SUSE/doc-sle.git"/>
+        <buildcontainer image="registry.example.com/daps:latest"/>
+        <language lang="en-us" default="true">
+          <branch>main</branch>
+          <subdir>en</subdir>
+          <deliverable>
+            <dc>DC-SLES-admin</dc>
+            <format html="1" pdf="1"/>
+            <subdeliverable>book-admin</subdeliverable>
+            <param name="homepage">https://www.suse.com</param>
+          </deliverable>
+        </language>
+        <language lang="de-de">
+          <branch>main</branch>
+          <subdir>de</subdir>
+        </language>
+        <language lang="en-us">
+          <branch>ignored</branch>
+        </language>
+      </builddocs>
+    </docset>
+    <docset setid="12" lifecycle="unsupported" navigation="hidden">
+      <builddocs>
+        <git remote="git@github.com:SUSE/doc-sle.git"/>
+        <language lang="en-us">
+          <branch>maintenance/12</branch>
+        </language>
+      </builddocs>
+    </docset>
+    <docset setid="archive" lifecycle="unsupported"/>
+  </product>
+</docservconfig>
+"""
+
+
+@pytest.fixture
+def index():
+    return ProductConfigIndex(etree.ElementTree(etree.fromstring(CONFIG)))
+
+
+def test_product(index):
+    assert index.get_product('sles')['maintainers'] == ['doc-team@example.com']
+    assert index.get_product('sled') is None
+    assert index.get_docset('sled', '15') is None
+    assert index.get_docset('sles', '16') is None
+
+
+def test_docset(index):
+    docset = index.get_docset('sles', '15')
+    assert docset['lifecycle'] == 'supported'
+    assert docset['navigation'] == 'linked'
+    assert docset['build_container'] == 'registry.example.com/daps:latest'
+    assert index.get_docset('sles', '12')['navigation'] == 'hidden'
+    assert index.get_docset('sles', '12')['build_container'] is False
+    assert index.get_docset('sles', 'archive') == {
+        'lifecycle': 'unsupported', 'navigation': 'linked', 'remote': None,
+        'build_container': False, 'languages': {}}
+
+
+def test_language(index):
+    language = index.get_language('sles', '15', 'en-us')
+    # the first language element wins
+    assert language['branch'] == 'main'
+    assert language['subdir'] == 'en'
+    assert language['deliverables'] == [{
+        'dc': 'DC-SLES-admin',
+        'formats': {'html': '1', 'pdf': '1'},
+        'subdir': None,
+        'subdeliverables': ['book-admin'],
+        'params': [('homepage', 'https://www.suse.com')],
+    }]
+    assert index.get_language('sles', '15', 'fr-fr') is None
+    assert index.get_language('sles', '16', 'en-us') is None
+
+
+@pytest.mark.parametrize('remote', [
+    'https://github.com/SUSE/doc-sle.git',
+    'https://github.com/SUSE/doc-sle',
+])
+def test_affected_languages(index, remote):
+    assert sorted(index.get_affected_languages(remote, 'main')) == [
+        ('sles', '15', 'de-de'), ('sles', '15', 'en-us')]
+    assert index.get_affected_languages(remote, 'unknown') == []
+
+
+@pytest.mark.parametrize('paths,languages', [
+    (['en/xml/book.xml'], [('sles', '15', 'en-us')]),
+    (['/de/xml/book.xml', 'en/DC-SLES-admin'], [('sles', '15', 'de-de'), ('sles', '15', 'en-us')]),
+    # shared files outside of all subdirs affect all languages
+    (['entities/product.ent'], [('sles', '15', 'de-de'), ('sles', '15', 'en-us')]),
+    (['english.txt'], [('sles', '15', 'de-de'), ('sles', '15', 'en-us')]),
+    ([], []),
+])
+def test_affected_languages_by_path(index, paths, languages):
+    assert sorted(index.get_affected_languages(
+        'https://github.com/SUSE/doc-sle.git', 'main', paths)) == languages
@@ -0,0 +1,140 @@
+import http.client
+import json
+import queue
+import threading
+import time
+
+import pytest
+
+from docserv.rest import BoundedRESTServer, RESTServer
+
+
+class FakeFetches:
+    def dict(self):
+        return {}
+
+
+class FakeDocserv:
+    def __init__(self):
+        self.config = {'server': {'rest_max_request_size': 1024,
+                                  'max_queued_build_instructions': 0}}
+        self.repo_fetches = FakeFetches()
+        self.event_sequence = 42
+        self.cursors = []
+        self.pushes = []
+        self.state_epoch = 'test'
+        self.end_all = queue.Queue()
+        # requests for events wait until this is set
+        self.release = threading.Event()
+
+    def get_metrics(self):
+        return "docserv_test 1\n"
+
+    def schedule(self):
+        return []
+
+    def queue_push(self, remote, branch, paths=None):
+        self.pushes.append((remote, branch, paths))
+        return []
+
+    def query_build_instructions(self, filters, offset=0, limit=None):
+        return 1, 0, []
+
+    def get_events(self, cursor, timeout, build_instruction_id=None):
+        self.cursors.append(cursor)
+        self.release.wait(timeout)
+        return [], self.event_sequence, False
+
+
+@pytest.fixture
+def server():
+    docserv = FakeDocserv()
+    rest = BoundedRESTServer(('127.0.0.1', 0), RESTServer, docserv, 2, 2)
+    thread = threading.Thread(target=rest.serve_forever, daemon=True)
+    thread.start()
+    yield rest
+    docserv.end_all.put(True)
+    docserv.release.set()
+    rest.shutdown()
+    rest.server_close()
+
+
+def get(server, path):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    connection.request('GET', path)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response.status, body
+
+
+@pytest.mark.parametrize("path", ['/metrics', '/metrics?x=1', '/schedule/?a=b', '/fetches/?a=b'])
+def test_query_parameters(server, path):
+    status, body = get(server, path)
+    assert status == 200
+
+
+def test_unknown_path(server):
+    assert get(server, '/nothing/')[0] == 404
+
+
+def test_events_default_to_new_events(server):
+    status, body = get(server, '/events/?timeout=0')
+    assert status == 200
+    assert server.docserv.cursors == [42]
+    assert json.loads(body)['cursor'] == 42
+    get(server, '/events/?cursor=3&timeout=0')
+    assert server.docserv.cursors == [42, 3]
+
+
+def post(server, path, body):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    connection.request('POST', path, body=body)
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.status
+
+
+@pytest.mark.parametrize("body", [
+    '{"remote": "https://github.com/SUSE/doc-sle"}',
+    '{"remote": "https://github.com/SUSE/doc-sle", "branch": "main", "paths": "en"}',
+    '[]',
+])
+def test_invalid_push(server, body):
+    assert post(server, '/push/', body) == 400
+    assert server.docserv.pushes == []
+
+
+def test_push(server):
+    assert post(server, '/push/', '{"remote": "r", "branch": "main", "paths": ["en/a.xml"]}') == 200
+    assert post(server, '/push/', '{"remote": "r", "branch": "main"}') == 200
+    assert server.docserv.pushes == [('r', 'main', ['en/a.xml']), ('r', 'main', None)]
+
+
+def open_stream(server):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    connection.request('GET', '/events/stream')
+    return connection, connection.getresponse()
+
+
+def test_event_streams_leave_threads_free(server):
+    streams = [open_stream(server) for i in range(2)]
+    assert [response.status for connection, response in streams] == [200, 200]
+    assert get(server, '/build_instructions/')[0] == 200
+    assert get(server, '/metrics')[0] == 200
+    # more waiting clients than allowed
+    assert open_stream(server)[1].status == 503
+    assert get(server, '/events/?timeout=5')[0] == 503
+    server.docserv.end_all.put(True)
+    server.docserv.release.set()
+    for connection, response in streams:
+        response.read()
+        connection.close()
+    # the threads that replaced the streams in the pool are stopped
+    for i in range(100):
+        if server.threads == 2:
+            break
+        time.sleep(0.05)
+    assert server.threads == 2
+    assert get(server, '/events/?timeout=0')[0] == 200
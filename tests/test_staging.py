@@ -0,0 +1,82 @@
+import os
+import threading
+
+import pytest
+
+from docserv import staging
+
+
+@pytest.fixture
+def docset(tmp_path):
+    return str(tmp_path / 'en-us' / 'sles' / '15')
+
+
+def new_version(docset, content):
+    version = staging.staged_dir(docset)
+    os.makedirs(version)
+    with open(os.path.join(version, 'index.html'), 'w') as f:
+        f.write(content)
+    return version
+
+
+def read(docset):
+    with open(os.path.join(docset, 'index.html')) as f:
+        return f.read()
+
+
+def test_publish(docset):
+    first = new_version(docset, 'first')
+    returncode, out, err, usage = staging.publish(docset, first, 1)
+    assert returncode == 0
+    assert os.readlink(docset) == os.path.basename(first)
+    second = new_version(docset, 'second')
+    staging.publish(docset, second, 1)
+    assert read(docset) == 'second'
+    assert staging.current_version(docset) == second
+    assert staging.versions(docset) == [first, second]
+
+
+def test_publish_collects_garbage(docset):
+    versions = []
+    for i in range(4):
+        versions.append(new_version(docset, str(i)))
+        staging.publish(docset, versions[-1], 1)
+    assert staging.versions(docset) == versions[2:]
+
+
+def test_publish_unstaged_docset(docset):
+    os.makedirs(docset)
+    with open(os.path.join(docset, 'index.html'), 'w') as f:
+        f.write('unstaged')
+    version = new_version(docset, 'staged')
+    staging.publish(docset, version, 1)
+    assert read(docset) == 'staged'
+    # the old directory becomes the first version
+    assert staging.versions(docset) == [docset + staging.VERSION_INFIX + '0', version]
+
+
+def test_rollback(docset):
+    first = new_version(docset, 'first')
+    staging.publish(docset, first, 2)
+    assert staging.rollback(docset) is None
+    second = new_version(docset, 'second')
+    staging.publish(docset, second, 2)
+    assert staging.rollback(docset) == first
+    assert read(docset) == 'first'
+    assert staging.rollback(docset) is None
+
+
+def test_rollback_waits_for_publish(docset):
+    first = new_version(docset, 'first')
+    staging.publish(docset, first, 2)
+    staging.publish(docset, new_version(docset, 'second'), 2)
+    lock = staging.docset_lock(os.path.join(docset, '..', '15'))
+    assert lock is staging.docset_lock(docset)
+    with lock:
+        rollback = threading.Thread(target=staging.rollback, args=(docset,))
+        rollback.start()
+        rollback.join(0.2)
+        assert rollback.is_alive()
+        assert read(docset) == 'second'
+    rollback.join(10)
+    assert read(docset) == 'first'
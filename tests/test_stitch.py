@@ -0,0 +1,50 @@
+import hashlib
+import threading
+
+import pytest
+
+from docserv.stitch import ConfigStitcher
+
+STYLESHEET = """<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:template match="/"><out/></xsl:template>
+</xsl:stylesheet>
+"""
+
+
+@pytest.fixture
+def stitcher(tmp_path):
+    return ConfigStitcher(str(tmp_path), 'en-us', 'main', max_workers=2)
+
+
+def test_file_hash_with_includes(stitcher, tmp_path):
+    included = tmp_path / 'include.xml'
+    included.write_text('<docset/>')
+    product = tmp_path / 'sles.xml'
+    product.write_text('<product xmlns:xi="http://www.w3.org/2001/XInclude">'
+                       '<xi:include href="include.xml"/></product>')
+    signature, raw_hash, file_hash = stitcher.file_hash(str(product))
+    # the hash in <hashes> is the same as md5sum's
+    assert raw_hash == hashlib.md5(product.read_bytes()).hexdigest()
+    assert file_hash != raw_hash
+    # changing an included file changes the hash of the including file
+    included.write_text('<docset id="changed"/>')
+    signature, changed_raw_hash, changed_file_hash = stitcher.file_hash(str(product))
+    assert changed_raw_hash == raw_hash
+    assert changed_file_hash != file_hash
+
+
+def test_assemble_hashes(stitcher):
+    tree = stitcher.assemble([], {'b.xml': 'bbb', 'a.xml': 'aaa'})
+    assert tree.find('hashes').text == 'aaa!bbb!'
+
+
+def test_xslt_cache_per_thread(stitcher, tmp_path):
+    stylesheet = tmp_path / 'check.xsl'
+    stylesheet.write_text(STYLESHEET)
+    transform = stitcher.xslt(str(stylesheet))
+    assert stitcher.xslt(str(stylesheet)) is transform
+    other = []
+    thread = threading.Thread(target=lambda: other.append(stitcher.xslt(str(stylesheet))))
+    thread.start()
+    thread.join()
+    assert other[0] is not transform
@@ -0,0 +1,108 @@
+import os
+import threading
+
+import pytest
+
+from docserv.targetsync import TargetSync
+
+
+@pytest.fixture
+def rsync_log(tmp_path, monkeypatch):
+    """
+    Replace rsync with a script that logs its arguments and the files
+    it was asked to transfer.
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    log = tmp_path / 'rsync.log'
+    rsync = bin_dir / 'rsync'
+    rsync.write_text('#!/bin/sh\n'
+                     'echo "$@" >> "%s"\n'
+                     'for arg in "$@"; do\n'
+                     '  case "$arg" in --files-from=*) cat "${arg#--files-from=}" >> "%s";; esac\n'
+                     'done\n' % (log, log))
+    rsync.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (bin_dir, os.environ['PATH']))
+    return log
+
+
+@pytest.fixture
+def backup_path(tmp_path):
+    for path in ['en-us/sles/15', 'en-us/sles/12', 'de-de/sles/15']:
+        os.makedirs(str(tmp_path / 'backup' / path))
+    return str(tmp_path / 'backup')
+
+
+def transfers(rsync_log):
+    return rsync_log.read_text().splitlines()
+
+
+def test_sync_paths(rsync_log, backup_path):
+    sync = TargetSync(backup_path, 'target:/srv/www')
+    returncode, out, err, usage = sync.sync(['en-us/sles/15', 'de-de/sles/15/index.html'])
+    assert returncode == 0
+    lines = transfers(rsync_log)
+    assert '--files-from=' in lines[0]
+    assert '--delete-after' in lines[0]
+    assert lines[0].endswith('%s/ target:/srv/www' % backup_path)
+    # paths that do not exist anymore are deleted with their parent
+    assert lines[1:] == ['de-de/sles/15', 'en-us/sles/15']
+
+
+def test_sync_removed_path(rsync_log, backup_path):
+    sync = TargetSync(backup_path, 'target:/srv/www')
+    assert sync.sync(['en-us/sles/missing', 'en-us/sles/15'])[0] == 0
+    # the removed path is deleted by transferring its parent, which
+    # contains the other path
+    assert transfers(rsync_log)[1:] == ['en-us/sles']
+
+
+def test_sync_removed_language(rsync_log, backup_path):
+    sync = TargetSync(backup_path, 'target:/srv/www')
+    sync.sync(['fr-fr/sles/15'])
+    [line] = transfers(rsync_log)
+    assert '--files-from' not in line
+
+
+def test_sync_nothing(rsync_log, backup_path):
+    sync = TargetSync(backup_path, 'target:/srv/www')
+    assert sync.sync([])[0] == 0
+    assert not rsync_log.exists()
+
+
+@pytest.mark.parametrize('scope,paths', [('docset', None), ('full', ['en-us/sles/15'])])
+def test_sync_full(rsync_log, backup_path, scope, paths):
+    sync = TargetSync(backup_path, 'target:/srv/www', scope=scope, staged=True, hard_links=True)
+    sync.sync(paths)
+    [line] = transfers(rsync_log)
+    assert '--files-from' not in line
+    assert ' -H ' in line
+    assert '--copy-dirlinks' in line
+
+
+def test_batching(rsync_log, backup_path):
+    sync = TargetSync(backup_path, 'target:/srv/www', window=0.5)
+    results = []
+    threads = [threading.Thread(target=lambda path=path: results.append(sync.sync([path])))
+               for path in ['en-us/sles/15', 'en-us/sles/12', 'de-de/sles/15']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    # a single transfer for all build instructions
+    lines = transfers(rsync_log)
+    assert sorted(lines[1:]) == ['de-de/sles/15', 'en-us/sles/12', 'en-us/sles/15']
+    assert [result[0] for result in results] == [0, 0, 0]
+
+
+def test_failed_transfer(tmp_path, backup_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    rsync = bin_dir / 'rsync'
+    rsync.write_text('#!/bin/sh\necho "connection refused" >&2\nexit 23\n')
+    rsync.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (bin_dir, os.environ['PATH']))
+    sync = TargetSync(backup_path, 'target:/srv/www')
+    returncode, out, err, usage = sync.sync(['en-us/sles/15'])
+    assert returncode == 23
+    assert err == b'connection refused\n'